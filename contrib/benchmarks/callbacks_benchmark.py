@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+"""
+Offline benchmark of the mail plugin callbacks
+
+Runs useradd_pre_callback, usermod_pre_callback, normalize_mail_attrs and the
+user_migrate_mail pre-callback against an in-memory stand-in for the LDAP backend and
+api.Command, so no running IPA server is needed. Only the IPA python libraries have to be
+installed.
+
+Reports operations per second, LDAP calls and command dispatches per operation and the
+allocated memory per operation for single entry and bulk workloads. Results are stored as
+JSON per version so regressions can be spotted by comparing two runs.
+"""
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(TOPDIR, 'plugin'))
+
+from ipapython.dn import DN  # noqa: E402
+
+import ipaserver.plugins  # noqa: E402
+
+# load the plugin from the source tree instead of an installed copy
+ipaserver.plugins.__path__.insert(0, os.path.join(TOPDIR, 'plugin', 'ipaserver', 'plugins'))
+from ipaserver.plugins import mailserver  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+BASEDN = DN(('dc', 'example'), ('dc', 'test'))
+
+
+class FakeEntry(dict):
+    """
+    Minimal stand-in for ipapython.ipaldap.LDAPEntry
+    """
+
+    def __init__(self, dn, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dn = dn
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name.lower(), value)
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+    @property
+    def single_value(self):
+        return {k: v[0] if isinstance(v, list) and v else v for k, v in self.items()}
+
+    @property
+    def raw(self):
+        entry = self
+
+        class RawView:
+            def __setitem__(self, name, values):
+                entry[name] = [v.decode() for v in values]
+
+        return RawView()
+
+    def reset_modlist(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def search_ext(self, *args, **kwargs):
+        self.stats['ldap'] += 1
+        return 1
+
+    def modify_ext(self, *args, **kwargs):
+        self.stats['ldap'] += 1
+        return 1
+
+    def result3(self, msgid):
+        return None, [], msgid, []
+
+
+class FakeLDAP:
+    """
+    In-memory LDAP backend counting every round trip
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.entries = {}
+        self.conn = FakeConnection(stats)
+
+    def add(self, entry):
+        self.entries[entry.dn] = entry
+
+    def get_entry(self, dn, attrs_list=None):
+        self.stats['ldap'] += 1
+        entry = self.entries[dn]
+        if attrs_list is None:
+            attrs = dict(entry)
+        else:
+            attrs = {a.lower(): list(entry[a]) for a in attrs_list if a in entry}
+        return FakeEntry(dn, attrs)
+
+    def update_entry(self, entry):
+        self.stats['ldap'] += 1
+        self.entries.setdefault(entry.dn, FakeEntry(entry.dn)).update(entry)
+
+    def get_ipa_config(self):
+        self.stats['ldap'] += 1
+        return FakeEntry(DN(('cn', 'ipaconfig'), ('cn', 'etc'), BASEDN),
+                         ipadefaultemaildomain=['example.test'])
+
+    def make_entry(self, dn, *args, **kwargs):
+        return FakeEntry(dn, *args, **kwargs)
+
+    def encode(self, value):
+        return str(value).encode()
+
+    @contextlib.contextmanager
+    def error_handler(self, arg_desc=None):
+        yield
+
+
+class FakeAPI:
+    def __init__(self, ldap, stats):
+        self.env = type('env', (), dict(basedn=BASEDN,
+                                        container_user=DN(('cn', 'users'), ('cn', 'accounts')),
+                                        container_group=DN(('cn', 'groups'), ('cn', 'accounts'))))
+        self.Backend = type('Backend', (), dict(ldap2=ldap))
+
+        def command(result):
+            def dispatch(*args, **kwargs):
+                stats['dispatch'] += 1
+                stats['ldap'] += 1
+                return dict(result=dict(result))
+            return dispatch
+
+        self.Command = {
+            'postfixconfig_show': command(dict(virtualdomain=['example.test'],
+                                               defaultmailboxtransport=['lmtp:unix:private/dovecot-lmtp'])),
+            'dovecotconfig_show': command(dict(defaultmailboxquota=['1024'])),
+        }
+
+
+class Workload:
+    def __init__(self):
+        self.stats = dict(ldap=0, dispatch=0)
+        self.ldap = FakeLDAP(self.stats)
+        self.command = type('command', (), dict(api=FakeAPI(self.ldap, self.stats)))()
+
+    def user_dn(self, i):
+        return DN(('uid', 'user{}'.format(i)), ('cn', 'users'), ('cn', 'accounts'), BASEDN)
+
+    def add_user(self, i, mail_enabled):
+        obj_classes = ['top', 'person', 'inetorgperson', 'posixaccount']
+        if mail_enabled:
+            obj_classes += ['mailsenderentity', 'mailreceiverentity', 'mailboxentity']
+        self.ldap.add(FakeEntry(self.user_dn(i), objectclass=obj_classes,
+                                mail=['user{}@example.test'.format(i)]))
+
+    def new_user_attrs(self, i):
+        return FakeEntry(self.user_dn(i),
+                         objectclass=['top', 'person', 'inetorgperson', 'posixaccount'],
+                         mail=['user{}@example.test'.format(i)],
+                         alias=['user{}.alias@example.test'.format(i)],
+                         sendalias=['user{}.send@example.test'.format(i)])
+
+
+def op_useradd(workload, i):
+    entry_attrs = workload.new_user_attrs(i)
+    mailserver.useradd_pre_callback(workload.command, workload.ldap, entry_attrs.dn, entry_attrs, [])
+
+
+def op_usermod(workload, i):
+    entry_attrs = FakeEntry(workload.user_dn(i), primarymail='user{}.new@example.test'.format(i),
+                            alias=['user{}.other@example.test'.format(i)])
+    mailserver.usermod_pre_callback(workload.command, workload.ldap, entry_attrs.dn, entry_attrs, [])
+
+
+def op_normalize(workload, i):
+    mailserver.normalize_mail_attrs(FakeEntry(workload.user_dn(i), mail=['user{}@example.test'.format(i)]))
+
+
+def op_migrate(workload, i):
+    entry_attrs = FakeEntry(workload.user_dn(i))
+    mailserver.user_migrate_mail.pre_callback(workload.command, workload.ldap, entry_attrs.dn, entry_attrs, [])
+
+
+OPERATIONS = {
+    'useradd_pre_callback': (op_useradd, None),
+    'usermod_pre_callback': (op_usermod, True),
+    'normalize_mail_attrs': (op_normalize, None),
+    'user_migrate_mail': (op_migrate, False),
+}
+
+
+def run(name, count, bulk):
+    """
+    Run an operation count times, either on the same entry (single) or on count distinct entries (bulk)
+    """
+    op, mail_enabled = OPERATIONS[name]
+    workload = Workload()
+    if mail_enabled is not None:
+        for i in range(count if bulk else 1):
+            workload.add_user(i, mail_enabled)
+
+    mailserver.config_cache.invalidate()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(count):
+        if name == 'user_migrate_mail' and not bulk:
+            # a user can only be migrated once
+            workload.add_user(0, False)
+        # every operation is a request of its own
+        mailserver.reset_request_cache()
+        op(workload, i if bulk else 0)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(
+        ops_per_sec=count / elapsed,
+        ldap_per_op=workload.stats['ldap'] / count,
+        dispatch_per_op=workload.stats['dispatch'] / count,
+        peak_alloc_bytes=peak,
+    )
+
+
+def plugin_version():
+    with open(os.path.join(TOPDIR, 'freeipa-mailserver.spec')) as f:
+        spec = f.read()
+    version = re.search(r'^Version:\s*(\S+)', spec, re.M).group(1)
+    release = re.search(r'^Release:\s*(\d+)', spec, re.M).group(1)
+    return '{}-{}'.format(version, release)
+
+
+def compare(previous, current, threshold):
+    regressions = []
+    for key, metrics in current.items():
+        before = previous.get(key)
+        if before is None:
+            continue
+        if metrics['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            regressions.append('{}: {:.0f} -> {:.0f} ops/s'.format(key, before['ops_per_sec'],
+                                                                   metrics['ops_per_sec']))
+        for metric in ('ldap_per_op', 'dispatch_per_op'):
+            if metrics[metric] > before[metric]:
+                regressions.append('{}: {} {} -> {}'.format(key, metric, before[metric], metrics[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=10000, help='operations per workload')
+    parser.add_argument('--label', default=None, help='name of the result file, defaults to the spec version')
+    parser.add_argument('--compare', default=None, help='label of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative ops/s slowdown')
+    args = parser.parse_args()
+
+    results = {}
+    print('{:<28} {:>12} {:>10} {:>10} {:>14}'.format('workload', 'ops/s', 'ldap/op', 'cmd/op', 'peak alloc'))
+    for name in OPERATIONS:
+        for bulk in (False, True):
+            key = '{}:{}'.format(name, 'bulk' if bulk else 'single')
+            results[key] = run(name, args.count, bulk)
+            r = results[key]
+            print('{:<28} {:>12.0f} {:>10.2f} {:>10.2f} {:>12d} B'.format(
+                key, r['ops_per_sec'], r['ldap_per_op'], r['dispatch_per_op'], r['peak_alloc_bytes']))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    label = args.label or plugin_version()
+    with open(os.path.join(RESULTS_DIR, '{}.json'.format(label)), 'w') as f:
+        json.dump(dict(count=args.count, results=results), f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(os.path.join(RESULTS_DIR, '{}.json'.format(args.compare))) as f:
+            previous = json.load(f)['results']
+        regressions = compare(previous, results, args.threshold)
+        for r in regressions:
+            print('REGRESSION {}'.format(r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
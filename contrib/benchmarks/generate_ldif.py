@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+"""
+Generate a synthetic mail directory as LDIF
+
+Writes users with primary addresses, aliases and sender aliases, hosts with mailSenderEntity
+and trees of nested groups, some of them mail enabled, following 75-mailserver.ldif. The
+number of aliases, sender aliases and group memberships per entry is drawn from configurable
+distributions given as comma separated count:weight pairs, e.g. "0:50,1:30,3:20".
+
+Derived attributes are written the way the plugin maintains them: memberOf contains all direct
+and indirect group memberships and mailRecipient the primary addresses of all members of a mail
+enabled group including its nested groups. IPA specific object classes are replaced by standard
+ones (inetOrgPerson, groupOfNames, device), so the LDIF can be imported into a plain 389-ds
+instance which only has the mail schema loaded.
+
+Only the standard library is needed.
+"""
+import argparse
+import bisect
+import itertools
+import random
+import sys
+
+DEFAULT_QUOTAS = ('*:storage=512M', '*:storage=2048M', '*:storage=5120M', '*:storage=10240M')
+DEFAULT_TRANSPORT = 'lmtp:unix:private/dovecot-lmtp'
+
+
+class Distribution:
+    """
+    Discrete distribution of counts given as "count:weight,count:weight"
+    """
+
+    def __init__(self, spec):
+        self.counts = []
+        weights = []
+        for pair in spec.split(','):
+            count, _sep, weight = pair.partition(':')
+            self.counts.append(int(count))
+            weights.append(float(weight or 1))
+
+        total = sum(weights)
+        self.cumulative = list(itertools.accumulate(w / total for w in weights))
+        self.mean = sum(c * w / total for c, w in zip(self.counts, weights))
+
+    def sample(self, rng):
+        i = bisect.bisect_left(self.cumulative, rng.random())
+        return self.counts[min(i, len(self.counts) - 1)]
+
+
+class Reservoir:
+    """
+    Uniform sample of at most size values of a stream of unknown length
+    """
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.values = []
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = self.rng.randrange(self.seen)
+            if i < self.size:
+                self.values[i] = value
+
+
+class Generator:
+    """
+    Stream the entries of a synthetic mail directory to a file
+
+    Users are written first, groups last, as their members and recipients are only known once
+    all users were generated. A sample of the generated lookup keys is kept for benchmarks.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.domains = args.domains.split(',')
+        self.aliases = Distribution(args.alias_dist)
+        self.sendaliases = Distribution(args.sendalias_dist)
+        self.memberships = Distribution(args.membership_dist)
+        self.group_aliases = Distribution(args.group_alias_dist)
+
+        self.users = args.users if args.users is not None else self.users_for_addresses(args.addresses)
+        self.groups = max(1, self.users // args.users_per_group)
+        self.hosts = self.users // args.users_per_host if args.users_per_host else 0
+        self.tree_size = sum(args.group_fanout ** d for d in range(args.group_depth))
+
+        sample_rng = random.Random(args.seed + 1)
+        self.samples = {name: Reservoir(args.sample, sample_rng)
+                        for name in ('uid', 'primary', 'alias', 'sendalias', 'group_alias', 'host')}
+        self.addresses = 0
+
+        # group index -> indexes of the users which are direct members
+        self._direct_members = {}
+
+    def users_for_addresses(self, addresses):
+        """
+        Estimate the number of users needed for a directory with the given number of addresses
+        """
+        args = self.args
+        per_user = 1 + self.aliases.mean + self.sendaliases.mean
+        per_user += self.group_aliases.mean * args.mail_group_ratio / args.users_per_group
+        if args.users_per_host:
+            per_user += (1 + self.sendaliases.mean) / args.users_per_host
+
+        return max(1, int(addresses / per_user))
+
+    def dn(self, kind, i):
+        suffix = self.args.suffix
+        if kind == 'user':
+            return 'uid=user{},cn=users,cn=accounts,{}'.format(i, suffix)
+        if kind == 'group':
+            return 'cn=group{},cn=groups,cn=accounts,{}'.format(i, suffix)
+        return 'cn=host{}.{},cn=computers,cn=accounts,{}'.format(i, self.domains[0], suffix)
+
+    def parent(self, group):
+        k = group % self.tree_size
+        if k == 0:
+            return None
+        return group - k + (k - 1) // self.args.group_fanout
+
+    def ancestors(self, group):
+        while group is not None:
+            yield group
+            group = self.parent(group)
+
+    def is_mail_group(self, group):
+        # deterministic, so the decision doesn't depend on the order the groups are visited in
+        return random.Random(self.args.seed * 1000003 + group).random() < self.args.mail_group_ratio
+
+    def primary(self, user):
+        return 'user{}@{}'.format(user, self.domains[0])
+
+    def domain(self):
+        # most addresses are in the first domain
+        if len(self.domains) == 1 or self.rng.random() < 0.8:
+            return self.domains[0]
+        return self.rng.choice(self.domains[1:])
+
+    def write(self, out):
+        if not self.args.no_containers:
+            self._write_containers(out)
+
+        for i in range(self.users):
+            self._write_user(out, i)
+        for i in range(self.hosts):
+            self._write_host(out, i)
+        for i in range(self.groups):
+            self._write_group(out, i)
+
+        return dict(users=self.users, groups=self.groups, hosts=self.hosts, addresses=self.addresses)
+
+    def _write_containers(self, out):
+        suffix = self.args.suffix
+        rdn_attr, _sep, rdn_value = suffix.split(',')[0].partition('=')
+        if rdn_attr.lower() == 'dc':
+            write_entry(out, suffix, objectClass=['top', 'domain'], dc=[rdn_value])
+        else:
+            write_entry(out, suffix, objectClass=['top', 'organization'], o=[rdn_value])
+
+        for container in ('cn=accounts', 'cn=users,cn=accounts', 'cn=groups,cn=accounts',
+                          'cn=computers,cn=accounts', 'cn=etc', 'cn=mailserver,cn=etc'):
+            object_classes = ['top', 'nsContainer']
+            attrs = {}
+            if container == 'cn=mailserver,cn=etc':
+                object_classes.append('mailDirectoryState')
+                attrs['mailDirectorySerial'] = ['0']
+            write_entry(out, '{},{}'.format(container, suffix), objectClass=object_classes,
+                        cn=[container.split(',')[0][3:]], **attrs)
+
+        write_entry(out, 'cn=postfix,cn=mailserver,cn=etc,{}'.format(suffix),
+                    objectClass=['top', 'nsContainer', 'postfixConfiguration'], cn=['postfix'],
+                    virtualDomain=self.domains, defaultMailboxTransport=[DEFAULT_TRANSPORT])
+        write_entry(out, 'cn=dovecot,cn=mailserver,cn=etc,{}'.format(suffix),
+                    objectClass=['top', 'nsContainer', 'dovecotConfiguration'], cn=['dovecot'],
+                    defaultMailboxQuota=['*:storage=1024M'])
+
+    def _addresses(self, local, distribution, sample):
+        addresses = ['{}.{}@{}'.format(local, k, self.domain()) for k in range(distribution.sample(self.rng))]
+        for address in addresses:
+            self.samples[sample].add(address)
+        self.addresses += len(addresses)
+        return addresses
+
+    def _write_user(self, out, i):
+        uid = 'user{}'.format(i)
+        primary = self.primary(i)
+        self.samples['uid'].add(uid)
+        self.samples['primary'].add(primary)
+        self.addresses += 1
+
+        attrs = dict(
+            objectClass=['top', 'person', 'organizationalPerson', 'inetOrgPerson', 'inetUser',
+                         'mailSenderEntity', 'mailReceiverEntity', 'mailboxEntity'],
+            uid=[uid],
+            cn=[uid],
+            sn=[uid],
+            mail=[primary],
+            primaryMail=[primary],
+            alias=self._addresses(uid, self.aliases, 'alias'),
+            sendAlias=self._addresses(uid + '.send', self.sendaliases, 'sendalias'),
+            canSendExternally=['TRUE' if self.rng.random() < 0.95 else 'FALSE'],
+            canReceiveExternally=['TRUE' if self.rng.random() < 0.98 else 'FALSE'],
+        )
+
+        # most users inherit the default quota and transport
+        if self.rng.random() < self.args.explicit_quota_ratio:
+            attrs['mailboxQuota'] = [self.rng.choice(DEFAULT_QUOTAS)]
+        if self.rng.random() < self.args.explicit_transport_ratio:
+            attrs['mailboxTransport'] = ['lmtp:inet:mx{}.{}:24'.format(self.rng.randrange(4), self.domains[0])]
+
+        groups = set()
+        for _ in range(self.memberships.sample(self.rng)):
+            group = self.rng.randrange(self.groups)
+            if group not in groups:
+                groups.add(group)
+                self._direct_members.setdefault(group, []).append(i)
+        if not self.args.no_memberof:
+            attrs['memberOf'] = sorted({self.dn('group', g) for group in groups for g in self.ancestors(group)})
+
+        write_entry(out, self.dn('user', i), **attrs)
+
+    def _write_host(self, out, i):
+        fqdn = 'host{}.{}'.format(i, self.domains[0])
+        primary = 'host{}@{}'.format(i, self.domains[0])
+        self.samples['host'].add(primary)
+        self.addresses += 1
+
+        write_entry(out, self.dn('host', i),
+                    objectClass=['top', 'device', 'mailSenderEntity'],
+                    cn=[fqdn],
+                    primaryMail=[primary],
+                    sendAlias=self._addresses('host{}.send'.format(i), self.sendaliases, 'sendalias'),
+                    canSendExternally=['TRUE' if self.rng.random() < 0.5 else 'FALSE'])
+
+    def _write_group(self, out, i):
+        cn = 'group{}'.format(i)
+        members = [self.dn('user', u) for u in self._direct_members.get(i, [])]
+        members.extend(self.dn('group', c) for c in self._children(i))
+
+        attrs = dict(objectClass=['top', 'groupOfNames', 'inetUser'], cn=[cn], member=members)
+
+        parent = self.parent(i)
+        if parent is not None and not self.args.no_memberof:
+            attrs['memberOf'] = [self.dn('group', g) for g in self.ancestors(parent)]
+
+        if self.is_mail_group(i):
+            attrs['objectClass'].append('mailenabledGroup')
+            aliases = ['{}@{}'.format(cn, self.domain())]
+            aliases += ['{}.{}@{}'.format(cn, k, self.domain()) for k in range(1, self.group_aliases.sample(self.rng))]
+            for alias in aliases:
+                self.samples['group_alias'].add(alias)
+            self.addresses += len(aliases)
+
+            attrs['alias'] = aliases
+            attrs['mailRecipient'] = sorted(self._recipients(i))
+
+        write_entry(out, self.dn('group', i), **attrs)
+
+    def _children(self, group):
+        tree, k = divmod(group, self.tree_size)
+        first = k * self.args.group_fanout + 1
+        for child in range(first, first + self.args.group_fanout):
+            if child < self.tree_size and tree * self.tree_size + child < self.groups:
+                yield tree * self.tree_size + child
+
+    def _recipients(self, group):
+        recipients = {self.primary(u) for u in self._direct_members.get(group, [])}
+        for child in self._children(group):
+            recipients.update(self._recipients(child))
+        return recipients
+
+
+def write_entry(out, dn, **attrs):
+    lines = ['dn: {}'.format(dn)]
+    for name, values in attrs.items():
+        lines.extend('{}: {}'.format(name, v) for v in values)
+    out.write('\n'.join(lines))
+    out.write('\n\n')
+
+
+def add_arguments(parser):
+    """
+    Add the options describing the generated data except its size
+    """
+    parser.add_argument('--suffix', default='dc=example,dc=test')
+    parser.add_argument('--domains', default='example.test,example.org,example.net',
+                        help='comma separated virtual domains, the first one is the main domain')
+    parser.add_argument('--alias-dist', default='0:40,1:35,2:15,3:7,8:3', help='aliases per user')
+    parser.add_argument('--sendalias-dist', default='0:70,1:25,3:5', help='sender aliases per user and host')
+    parser.add_argument('--membership-dist', default='0:30,1:45,2:20,5:5', help='direct group memberships per user')
+    parser.add_argument('--group-alias-dist', default='1:80,2:15,4:5', help='aliases per mail enabled group')
+    parser.add_argument('--users-per-group', type=int, default=50, help='ratio of users to groups')
+    parser.add_argument('--users-per-host', type=int, default=100, help='ratio of users to hosts, 0 for no hosts')
+    parser.add_argument('--group-fanout', type=int, default=4, help='child groups per group')
+    parser.add_argument('--group-depth', type=int, default=3, help='levels of a group tree')
+    parser.add_argument('--mail-group-ratio', type=float, default=0.5, help='share of mail enabled groups')
+    parser.add_argument('--explicit-quota-ratio', type=float, default=0.1, help='share of users with an own quota')
+    parser.add_argument('--explicit-transport-ratio', type=float, default=0.01,
+                        help='share of users with an own transport')
+    parser.add_argument('--no-memberof', action='store_true',
+                        help="don't write memberOf, e.g. when the memberOf plugin computes it")
+    parser.add_argument('--no-containers', action='store_true',
+                        help="don't write the suffix, container and configuration entries")
+    parser.add_argument('--sample', type=int, default=10000, help='lookup keys sampled per kind')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', nargs='?', default='-', help='LDIF file, defaults to stdout')
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--users', type=int, default=None, help='number of users')
+    size.add_argument('--addresses', type=int, default=10000,
+                      help='approximate number of addresses, the number of users is derived from it')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    generator = Generator(args)
+    if args.output == '-':
+        counts = generator.write(sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            counts = generator.write(f)
+
+    print('{users} users, {groups} groups, {hosts} hosts, {addresses} addresses'.format(**counts), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""
+Measure the lookup latency of the mail attributes with and without the shipped indexes
+
+A throwaway 389-ds instance is created with dscreate, loaded with the mail schema and a
+number of synthetic users. The lookups Postfix and the Web UI issue are timed first without
+indexes, then again after the indexes from 75-mailserver.update were added and built.
+
+Requires 389-ds-base, python3-lib389, python3-ldap and openldap-clients. Has to run as root.
+"""
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import ldap
+import ldap.modlist
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+SCHEMA = os.path.join(TOPDIR, 'plugin', 'schema.d', '75-mailserver.ldif')
+UPDATE = os.path.join(TOPDIR, 'plugin', 'updates', '75-mailserver.update')
+
+INSTANCE_INF = """
+[general]
+full_machine_name = localhost
+
+[slapd]
+instance_name = {instance}
+port = {port}
+secure_port = {secure_port}
+root_password = {password}
+self_sign_cert = False
+
+[backend-userroot]
+suffix = {suffix}
+create_suffix_entry = True
+sample_entries = no
+"""
+
+LOOKUPS = {
+    'primaryMail eq': '(primaryMail={primary})',
+    'alias eq': '(alias={alias})',
+    'sendAlias eq': '(sendAlias={sendalias})',
+    'alias sub': '(alias=*{alias_part}*)',
+}
+
+
+class Instance:
+    def __init__(self, args):
+        self.args = args
+        self.uri = 'ldap://localhost:{}'.format(args.port)
+        self.conn = None
+
+    def create(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.inf') as inf:
+            inf.write(INSTANCE_INF.format(instance=self.args.instance, port=self.args.port,
+                                          secure_port=self.args.port + 1, password=self.args.password,
+                                          suffix=self.args.suffix))
+            inf.flush()
+            subprocess.run(['dscreate', 'from-file', inf.name], check=True)
+
+        self.conn = ldap.initialize(self.uri)
+        self.conn.simple_bind_s('cn=Directory Manager', self.args.password)
+
+    def remove(self):
+        subprocess.run(['dsctl', self.args.instance, 'remove', '--do-it'], check=False)
+
+    def load_schema(self):
+        subprocess.run(['ldapmodify', '-H', self.uri, '-x', '-D', 'cn=Directory Manager',
+                        '-w', self.args.password, '-f', SCHEMA], check=True)
+
+    def load_users(self, count):
+        for container in ('cn=accounts', 'cn=users,cn=accounts'):
+            dn = '{},{}'.format(container, self.args.suffix)
+            self.conn.add_s(dn, ldap.modlist.addModlist({
+                'objectClass': [b'top', b'nsContainer'],
+                'cn': [container.split(',')[0][3:].encode()],
+            }))
+
+        for i in range(count):
+            uid = 'user{}'.format(i)
+            attrs = {
+                'objectClass': [b'top', b'inetOrgPerson', b'mailSenderEntity', b'mailReceiverEntity',
+                                b'mailboxEntity'],
+                'uid': [uid.encode()],
+                'cn': [uid.encode()],
+                'sn': [uid.encode()],
+                'primaryMail': ['{}@example.test'.format(uid).encode()],
+                'alias': ['{}.alias@example.test'.format(uid).encode()],
+                'sendAlias': ['{}.send@example.test'.format(uid).encode()],
+                'canSendExternally': [b'TRUE'],
+                'canReceiveExternally': [b'TRUE'],
+                'mailboxTransport': [b'lmtp:unix:private/dovecot-lmtp'],
+                'mailboxQuota': [b'*:storage=1024M'],
+            }
+            self.conn.add_s('uid={},cn=users,cn=accounts,{}'.format(uid, self.args.suffix),
+                            ldap.modlist.addModlist(attrs))
+
+    def add_indexes(self):
+        attributes = []
+        for dn, attrs in read_update_file(UPDATE):
+            if ',cn=index,cn=userroot,' not in dn.lower():
+                continue
+
+            self.conn.add_s(dn, ldap.modlist.addModlist(
+                {name: [v.encode() for v in values] for name, values in attrs.items()}))
+            attributes.append(attrs['cn'][0])
+
+        task_dn = 'cn=mailserver-index,cn=index,cn=tasks,cn=config'
+        self.conn.add_s(task_dn, ldap.modlist.addModlist({
+            'objectClass': [b'top', b'extensibleObject'],
+            'cn': [b'mailserver-index'],
+            'nsInstance': [b'userRoot'],
+            'nsIndexAttribute': [a.encode() for a in attributes],
+        }))
+        self._wait_for_task(task_dn)
+
+    def _wait_for_task(self, task_dn):
+        while True:
+            try:
+                _dn, attrs = self.conn.search_s(task_dn, ldap.SCOPE_BASE, attrlist=['nsTaskExitCode'])[0]
+            except ldap.NO_SUCH_OBJECT:
+                return
+            if 'nsTaskExitCode' in attrs:
+                return
+            time.sleep(0.5)
+
+    def measure(self, count, lookups):
+        base = 'cn=accounts,{}'.format(self.args.suffix)
+        rng = random.Random(self.args.seed)
+        results = {}
+
+        for name, template in LOOKUPS.items():
+            timings = []
+            for _ in range(lookups):
+                i = rng.randrange(count)
+                search_filter = template.format(primary='user{}@example.test'.format(i),
+                                                alias='user{}.alias@example.test'.format(i),
+                                                sendalias='user{}.send@example.test'.format(i),
+                                                alias_part='er{}.al'.format(i))
+                start = time.perf_counter()
+                self.conn.search_s(base, ldap.SCOPE_SUBTREE, search_filter, ['primaryMail'])
+                timings.append(time.perf_counter() - start)
+
+            timings.sort()
+            results[name] = dict(
+                p50=statistics.median(timings),
+                p99=timings[int(len(timings) * 0.99) - 1],
+                mean=statistics.mean(timings),
+            )
+
+        return results
+
+
+def read_update_file(path):
+    """
+    Minimal reader for the entries of an IPA update file, only "default:" and "add:" are supported
+    """
+    dn = None
+    attrs = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                if dn is not None:
+                    yield dn, attrs
+                dn = None
+                attrs = {}
+                continue
+
+            if line.startswith('dn:'):
+                dn = line[3:].strip()
+            else:
+                _action, name, value = (p.strip() for p in line.split(':', 2))
+                attrs.setdefault(name, []).append(value)
+
+    if dn is not None:
+        yield dn, attrs
+
+
+def print_results(before, after):
+    print('{:<16} {:>12} {:>12} {:>12} {:>12}'.format('lookup', 'p50 before', 'p50 after',
+                                                     'p99 before', 'p99 after'))
+    for name in LOOKUPS:
+        print('{:<16} {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms {:>10.3f}ms'.format(
+            name, before[name]['p50'] * 1000, after[name]['p50'] * 1000,
+            before[name]['p99'] * 1000, after[name]['p99'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000, help='number of users to create')
+    parser.add_argument('--lookups', type=int, default=1000, help='lookups per pattern')
+    parser.add_argument('--instance', default='mailbench', help='name of the throwaway instance')
+    parser.add_argument('--port', type=int, default=38900)
+    parser.add_argument('--suffix', default='dc=example,dc=test')
+    parser.add_argument('--password', default='mailbench-password')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the instance after the run')
+    args = parser.parse_args()
+
+    instance = Instance(args)
+    instance.create()
+    try:
+        instance.load_schema()
+        instance.load_users(args.users)
+
+        before = instance.measure(args.users, args.lookups)
+        instance.add_indexes()
+        after = instance.measure(args.users, args.lookups)
+
+        print_results(before, after)
+    finally:
+        if not args.keep:
+            instance.remove()
+
+
+if __name__ == '__main__':
+    main()
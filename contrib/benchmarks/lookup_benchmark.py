@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+Measure the latency and throughput of the Postfix and Dovecot lookups on a synthetic directory
+
+For every size a synthetic directory is generated with generate_ldif.py and imported into a
+throwaway 389-ds instance which has the mail schema and the indexes of 75-mailserver.update.
+Each lookup pattern Postfix and Dovecot issue against the directory is then timed sequentially
+on a single connection (p50/p99 latency) and in a mixed workload from several concurrent
+clients (throughput). A share of the lookups uses keys which don't exist, as most of the
+lookups of a mail server miss.
+
+Requires 389-ds-base, python3-lib389, python3-ldap and openldap-clients. Has to run as root.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import subprocess
+import threading
+import time
+
+import ldap
+import ldap.filter
+
+from generate_ldif import Generator, add_arguments
+from index_benchmark import Instance
+
+# name: (search base below the suffix, filter template, attributes, sampled key kinds)
+LOOKUPS = {
+    'postfix virtual_mailbox_domains': ('cn=mailserver,cn=etc', '(&(objectClass=postfixConfiguration)'
+                                        '(virtualDomain={key}))', ['virtualDomain'], ('domain',)),
+    'postfix virtual_alias_maps': ('cn=accounts', '(&(objectClass=mailReceiverEntity)(alias={key}))',
+                                   ['primaryMail'], ('alias',)),
+    'postfix virtual_alias_maps group': ('cn=accounts', '(&(objectClass=mailenabledGroup)(alias={key}))',
+                                         ['mailRecipient'], ('group_alias',)),
+    'postfix transport_maps': ('cn=accounts', '(&(objectClass=mailReceiverEntity)(primaryMail={key}))',
+                               ['mailboxTransport'], ('primary',)),
+    'postfix smtpd_sender_login_maps': ('cn=accounts', '(&(objectClass=mailSenderEntity)'
+                                        '(|(primaryMail={key})(sendAlias={key})))', ['uid', 'cn'],
+                                        ('primary', 'sendalias', 'host')),
+    'dovecot userdb': ('cn=accounts', '(&(objectClass=mailboxEntity)(uid={key}))',
+                       ['uid', 'mailboxQuota', 'mailboxTransport'], ('uid',)),
+    'dovecot passdb by address': ('cn=accounts', '(&(objectClass=mailboxEntity)(primaryMail={key}))',
+                                  ['uid', 'userPassword'], ('primary',)),
+}
+
+
+class LookupInstance(Instance):
+    def connect(self):
+        self.conn = self.new_connection()
+
+    def new_connection(self):
+        conn = ldap.initialize(self.uri)
+        conn.simple_bind_s('cn=Directory Manager', self.args.password)
+        return conn
+
+    def ldif_dir(self):
+        return '/var/lib/dirsrv/slapd-{}/ldif'.format(self.args.instance)
+
+    def import_ldif(self, path):
+        """
+        Replace the content of the backend with path, the configured indexes are built during the import
+        """
+        self.conn.unbind_s()
+        subprocess.run(['dsctl', self.args.instance, 'stop'], check=True)
+        subprocess.run(['dsctl', self.args.instance, 'ldif2db', 'userRoot', path], check=True)
+        subprocess.run(['dsctl', self.args.instance, 'start'], check=True)
+        self.connect()
+
+
+class Workload:
+    """
+    Random lookups of the patterns in LOOKUPS, a share of them with keys which don't exist
+    """
+
+    def __init__(self, args, samples, domains):
+        self.args = args
+        keys = {kind: reservoir.values for kind, reservoir in samples.items()}
+        keys['domain'] = domains
+        self.keys = {name: [k for kind in lookup[3] for k in keys[kind]] for name, lookup in LOOKUPS.items()}
+
+    def lookup(self, name, rng):
+        base, template, attrs, _kinds = LOOKUPS[name]
+        keys = self.keys[name]
+
+        if not keys or rng.random() < self.args.miss_ratio:
+            key = 'nobody{}@example.invalid'.format(rng.randrange(1 << 30))
+        else:
+            key = rng.choice(keys)
+
+        return '{},{}'.format(base, self.args.suffix), template.format(key=ldap.filter.escape_filter_chars(key)), attrs
+
+
+def search(conn, base, search_filter, attrs):
+    return conn.search_ext_s(base, ldap.SCOPE_SUBTREE, search_filter, attrs)
+
+
+def measure_latency(conn, workload, lookups, seed):
+    rng = random.Random(seed)
+    results = {}
+
+    for name in LOOKUPS:
+        timings = []
+        for _ in range(lookups):
+            base, search_filter, attrs = workload.lookup(name, rng)
+            start = time.perf_counter()
+            search(conn, base, search_filter, attrs)
+            timings.append(time.perf_counter() - start)
+
+        timings.sort()
+        results[name] = dict(
+            p50=statistics.median(timings),
+            p99=timings[max(0, int(len(timings) * 0.99) - 1)],
+            mean=statistics.mean(timings),
+        )
+
+    return results
+
+
+def measure_throughput(instance, workload, clients, duration, seed):
+    """
+    Run a mix of all lookups from clients concurrent connections for duration seconds
+    """
+    names = list(LOOKUPS)
+    counts = [dict.fromkeys(names, 0) for _ in range(clients)]
+    connections = [instance.new_connection() for _ in range(clients)]
+    deadline = time.perf_counter() + duration
+
+    def client(i):
+        rng = random.Random(seed + i)
+        while time.perf_counter() < deadline:
+            name = rng.choice(names)
+            search(connections[i], *workload.lookup(name, rng))
+            counts[i][name] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    for conn in connections:
+        conn.unbind_s()
+
+    per_lookup = {name: sum(c[name] for c in counts) / elapsed for name in names}
+    return dict(total=sum(per_lookup.values()), lookups=per_lookup)
+
+
+def print_results(counts, latency, throughput):
+    print()
+    print('{addresses} addresses: {users} users, {groups} groups, {hosts} hosts'.format(**counts))
+    print('{:<36} {:>10} {:>10} {:>12}'.format('lookup', 'p50', 'p99', 'lookups/s'))
+    for name in LOOKUPS:
+        print('{:<36} {:>8.3f}ms {:>8.3f}ms {:>12.0f}'.format(
+            name, latency[name]['p50'] * 1000, latency[name]['p99'] * 1000, throughput['lookups'][name]))
+    print('{:<36} {:>10} {:>10} {:>12.0f}'.format('total', '', '', throughput['total']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated numbers of addresses to measure')
+    parser.add_argument('--lookups', type=int, default=2000, help='sequential lookups per pattern')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent connections of the throughput test')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of the throughput test')
+    parser.add_argument('--miss-ratio', type=float, default=0.2, help='share of lookups with unknown keys')
+    parser.add_argument('--output', default=None, help='also write the results as JSON to this file')
+    parser.add_argument('--instance', default='mailbench', help='name of the throwaway instance')
+    parser.add_argument('--port', type=int, default=38900)
+    parser.add_argument('--password', default='mailbench-password')
+    parser.add_argument('--keep', action='store_true', help='keep the instance after the run')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    instance = LookupInstance(args)
+    instance.create()
+    results = {}
+    try:
+        instance.load_schema()
+        instance.add_indexes()
+
+        for size in (int(s) for s in args.sizes.split(',')):
+            gen_args = copy.copy(args)
+            gen_args.users = None
+            gen_args.addresses = size
+            generator = Generator(gen_args)
+
+            path = os.path.join(instance.ldif_dir(), 'mailbench-{}.ldif'.format(size))
+            with open(path, 'w') as f:
+                counts = generator.write(f)
+            os.chmod(path, 0o644)
+            try:
+                instance.import_ldif(path)
+            finally:
+                os.unlink(path)
+
+            workload = Workload(args, generator.samples, generator.domains)
+            latency = measure_latency(instance.conn, workload, args.lookups, args.seed)
+            throughput = measure_throughput(instance, workload, args.clients, args.duration, args.seed)
+
+            print_results(counts, latency, throughput)
+            results[size] = dict(counts=counts, latency=latency, throughput=throughput)
+    finally:
+        if not args.keep:
+            instance.remove()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
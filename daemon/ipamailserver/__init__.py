@@ -0,0 +1,5 @@
+"""
+Companion daemons of the FreeIPA mail server extension
+
+They run on the mail servers and only depend on the standard library and python-ldap.
+"""
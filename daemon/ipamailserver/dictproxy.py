@@ -0,0 +1,403 @@
+"""
+Dovecot dict proxy server answering userdb lookups from a bounded in-memory cache
+
+Dovecot connects with the proxy dict driver over a UNIX socket. Supported keys are::
+
+    shared/userdb/<user>      userdb fields as JSON (quota_rule, quota_rule2, ..., mailbox_transport)
+    shared/quota/<user>       quota rules in canonical Dovecot notation
+    shared/transport/<user>   mailbox transport
+
+<user> is the uid or the primary mail address. Users are looked up in LDAP on the first
+request and kept in an LRU cache afterwards. A persistent search updates the cached users
+and the defaults of the Dovecot and Postfix configuration, so changes in IPA take effect
+without waiting for an expiry. Concurrent requests for the same uncached user share a single
+LDAP query.
+
+Dovecot configuration example (``dovecot-dict-userdb.conf.ext``)::
+
+    uri = proxy:/run/ipa-mailserver-dict/dict.sock:ipa
+    iterate_disable = yes
+
+    key user {
+      key = userdb/%u
+      format = json
+    }
+    userdb_objects = $user
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import configparser
+import json
+import logging
+import os
+import signal
+import threading
+from collections import OrderedDict
+
+import ldap
+from ldap.filter import escape_filter_chars
+
+from ipamailserver.ldapsource import LDAPSource, connect, connection_options, normalize_attrs
+from ipamailserver.quota import format_quota_rules, parse_quota_rules, storage_rule
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = '/etc/ipa-mailserver/dict.conf'
+
+USER_FILTER = '(objectclass=mailboxentity)'
+CONFIG_FILTER = '(|(objectclass=dovecotconfiguration)(objectclass=postfixconfiguration))'
+FOLLOW_FILTER = '(|{}{})'.format(USER_FILTER, CONFIG_FILTER)
+ATTRS = [
+    'objectclass', 'uid', 'primarymail', 'mailboxquota', 'mailboxtransport', 'defaultmailboxquota',
+    'defaultmailboxtransport',
+]
+DEFAULT_ATTRS = ('defaultmailboxquota', 'defaultmailboxtransport')
+# configuration object class: default it holds
+CONFIG_DEFAULTS = {
+    'dovecotconfiguration': 'defaultmailboxquota',
+    'postfixconfiguration': 'defaultmailboxtransport',
+}
+
+_escapes = {'\x01': '\x011', '\t': '\x01t', '\n': '\x01n', '\r': '\x01r'}
+_unescapes = {v[1]: k for k, v in _escapes.items()}
+
+
+def tabescape(value):
+    return ''.join(_escapes.get(c, c) for c in value)
+
+
+def tabunescape(value):
+    parts = value.split('\x01')
+    return parts[0] + ''.join(_unescapes.get(p[:1], p[:1]) + p[1:] for p in parts[1:])
+
+
+def user_keys(attrs):
+    return {v.lower() for v in attrs.get('uid', []) + attrs.get('primarymail', [])}
+
+
+def user_record(attrs):
+    return dict(
+        quota=(attrs.get('mailboxquota') or [None])[0],
+        transport=(attrs.get('mailboxtransport') or [None])[0],
+    )
+
+
+def quota_fields(value):
+    """
+    Return the userdb quota_rule fields of a stored quota value
+    """
+    # very old entries store the storage limit in megabytes
+    if value.isdigit():
+        value = storage_rule(value)
+
+    fields = {}
+    for i, rule in enumerate(parse_quota_rules(value)):
+        fields['quota_rule{}'.format(i + 1 if i else '')] = format_quota_rules([rule])
+    return fields
+
+
+class UserCache:
+    """
+    LRU cache of user records keyed by login name, unknown users are cached as None
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._records = OrderedDict()
+        self._keys = {}
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def get(self, key):
+        """
+        Return (found, record)
+        """
+        try:
+            dn, record = self._records[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        self._records.move_to_end(key)
+        self.hits += 1
+        return True, record
+
+    def put(self, key, dn, record):
+        self.discard(key)
+        self._records[key] = (dn, record)
+        if dn is not None:
+            self._keys.setdefault(dn, set()).add(key)
+
+        while len(self._records) > self.maxsize:
+            self.discard(next(iter(self._records)))
+            self.evictions += 1
+
+    def discard(self, key):
+        cached = self._records.pop(key, None)
+        if cached is not None and cached[0] is not None:
+            keys = self._keys.get(cached[0])
+            keys.discard(key)
+            if not keys:
+                del self._keys[cached[0]]
+
+    def holds(self, dn):
+        return dn in self._keys
+
+    def discard_dn(self, dn):
+        for key in list(self._keys.get(dn, ())):
+            self.discard(key)
+
+    def clear(self):
+        self._records.clear()
+        self._keys.clear()
+
+
+class UserLookup:
+    """
+    Look up single users, every executor thread uses a connection of its own
+    """
+
+    def __init__(self, uri, base, bind_dn=None, bind_password=None):
+        self.uri = uri
+        self.base = base
+        self.bind_dn = bind_dn
+        self.bind_password = bind_password
+        self._local = threading.local()
+
+    def find_user(self, key):
+        search_filter = '(&{}(|(uid={key})(primarymail={key})))'.format(USER_FILTER, key=escape_filter_chars(key))
+
+        for retry in (False, True):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = connect(self.uri, self.bind_dn, self.bind_password)
+            try:
+                results = conn.search_s(self.base, ldap.SCOPE_SUBTREE, search_filter, ATTRS)
+                break
+            except ldap.SERVER_DOWN:
+                self._local.conn = None
+                if retry:
+                    raise
+
+        for dn, attrs in results:
+            if dn is not None:
+                return dn.lower(), normalize_attrs(attrs)
+
+        return None
+
+
+class DictProxy:
+    def __init__(self, loop, lookup, cache_size, executor):
+        self.loop = loop
+        self.lookup = lookup
+        self.executor = executor
+        self.cache = UserCache(cache_size)
+        self.defaults = {}
+        self._pending = {}
+        # incremented for every change, a lookup racing with a change is not cached
+        self._generation = 0
+
+    def sync(self, source):
+        defaults = {}
+        for _dn, attrs in source.iter_entries(CONFIG_FILTER):
+            for name in DEFAULT_ATTRS:
+                if attrs.get(name):
+                    defaults[name] = attrs[name][0]
+
+        self.loop.call_soon_threadsafe(self._reset, defaults)
+
+    def _reset(self, defaults):
+        # changes may have been missed while the connection was down
+        self._generation += 1
+        self.defaults = defaults
+        self.cache.clear()
+
+    def apply(self, dn, attrs, previous_dn):
+        self.loop.call_soon_threadsafe(self._apply, dn.lower(), attrs, previous_dn)
+
+    def _apply(self, dn, attrs, previous_dn):
+        self._generation += 1
+
+        if previous_dn is not None:
+            self.cache.discard_dn(previous_dn.lower())
+
+        if attrs is None:
+            self.cache.discard_dn(dn)
+            return
+
+        obj_classes = {o.lower() for o in attrs.get('objectclass', [])}
+        if obj_classes & set(CONFIG_DEFAULTS):
+            # a change of one configuration must not reset the default held by the other one
+            for obj_class, name in CONFIG_DEFAULTS.items():
+                if obj_class in obj_classes:
+                    self.defaults[name] = (attrs.get(name) or [None])[0]
+            return
+
+        # only users which are cached are kept current, the others are loaded on demand
+        keys = user_keys(attrs)
+        if not self.cache.holds(dn) and not any(k in self.cache for k in keys):
+            return
+
+        self.cache.discard_dn(dn)
+        record = user_record(attrs) if 'mailboxentity' in obj_classes else None
+        for key in keys:
+            self.cache.put(key, dn if record is not None else None, record)
+
+    async def get_user(self, key):
+        key = key.lower()
+        found, record = self.cache.get(key)
+        if found:
+            return record
+
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._load_user(key))
+            future.add_done_callback(lambda f: self._pending.pop(key, None))
+
+        return await future
+
+    async def _load_user(self, key):
+        generation = self._generation
+        result = await self.loop.run_in_executor(self.executor, self.lookup.find_user, key)
+
+        if result is None:
+            if generation == self._generation:
+                self.cache.put(key, None, None)
+            return None
+
+        dn, attrs = result
+        record = user_record(attrs)
+        if generation == self._generation:
+            for k in user_keys(attrs) | {key}:
+                self.cache.put(k, dn, record)
+
+        return record
+
+    def userdb_fields(self, record):
+        fields = {}
+
+        quota = record['quota'] or self.defaults.get('defaultmailboxquota')
+        if quota:
+            try:
+                fields.update(quota_fields(quota))
+            except ValueError as e:
+                logger.warning('Ignoring invalid quota rule %r: %s', quota, e)
+
+        transport = record['transport'] or self.defaults.get('defaultmailboxtransport')
+        if transport:
+            fields['mailbox_transport'] = transport
+
+        return fields
+
+    async def lookup_key(self, key):
+        """
+        Return the value of a dict key or None
+        """
+        _scope, _sep, path = key.partition('/')
+        kind, _sep, user = path.partition('/')
+        if kind not in ('userdb', 'quota', 'transport') or not user:
+            return None
+
+        record = await self.get_user(user)
+        if record is None:
+            return None
+
+        fields = self.userdb_fields(record)
+        if kind == 'userdb':
+            return json.dumps(fields, sort_keys=True)
+        if kind == 'quota':
+            quota = [v for k, v in sorted(fields.items()) if k.startswith('quota_rule')]
+            return ' '.join(quota) or None
+        return fields.get('mailbox_transport')
+
+    async def respond(self, line):
+        command, args = line[:1], line[1:].split('\t')
+        if command == 'H':
+            # hello, no reply
+            return None
+        if command != 'L':
+            return 'F{}'.format(tabescape('unsupported dict command {}'.format(command)))
+
+        try:
+            value = await self.lookup_key(tabunescape(args[0]))
+        except ldap.LDAPError as e:
+            logger.warning('LDAP lookup failed: %s', e)
+            return 'F{}'.format(tabescape('LDAP lookup failed'))
+
+        if value is None:
+            return 'N'
+        return 'O{}'.format(tabescape(value))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.respond(line.decode('utf-8').rstrip('\n'))
+                if reply is not None:
+                    writer.write(reply.encode('utf-8') + b'\n')
+                    await writer.drain()
+        except (UnicodeDecodeError, ValueError) as e:
+            logger.warning('Closing dict connection: %s', e)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(config):
+    loop = asyncio.get_running_loop()
+    section = config['ldap']
+    options = connection_options(section)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config['dict'].getint('lookup_threads', 4))
+    proxy = DictProxy(loop, UserLookup(section['uri'], section['base'], **options),
+                      config['dict'].getint('cache_size', 100000), executor)
+
+    source = LDAPSource(section['uri'], section['base'], FOLLOW_FILTER, ATTRS, proxy.sync, proxy.apply,
+                        page_size=section.getint('page_size', 1000), **options)
+    source.start()
+
+    path = config['dict'].get('listen', '/run/ipa-mailserver-dict/dict.sock')
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = await asyncio.start_unix_server(proxy.handle, path)
+    os.chmod(path, 0o660)
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info('Listening on %s', path)
+    async with listener:
+        await stop.wait()
+
+    source.stop()
+    executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dovecot dict proxy for the FreeIPA mail server extension')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG, help='configuration file')
+    parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(levelname)s %(name)s: %(message)s')
+
+    config = configparser.ConfigParser()
+    config.read_dict({'ldap': {}, 'dict': {}})
+    if not config.read(args.config):
+        parser.error('cannot read {}'.format(args.config))
+
+    asyncio.run(serve(config))
+
+
+if __name__ == '__main__':
+    main()
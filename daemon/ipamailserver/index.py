@@ -0,0 +1,166 @@
+"""
+In-memory index of the Postfix lookup tables
+
+The tables are built from the LDAP entries of the mail schema with the same semantics as
+the files written by ``ipa mailserver-export-maps``. Every entry remembers the rows it
+contributed, so an entry can be replaced or removed without rebuilding the index.
+"""
+from collections import OrderedDict
+
+# map name: join multiple values
+MAPS = OrderedDict([
+    ('virtual_alias', True),
+    ('sender_login', True),
+    ('transport', False),
+    ('send_external', False),
+    ('receive_external', False),
+    ('virtual_domains', False),
+])
+
+# entries which may carry mail attributes, also entries which are not mail enabled (anymore)
+# have to be seen to remove them from the index
+CANDIDATE_FILTER = ('(|(objectclass=person)(objectclass=ipausergroup)(objectclass=ipahost)'
+                    '(objectclass=postfixconfiguration))')
+
+ENTRY_ATTRS = [
+    'objectclass', 'uid', 'fqdn', 'primarymail', 'alias', 'sendalias', 'mailrecipient',
+    'mailboxtransport', 'cansendexternally', 'canreceiveexternally', 'effectivecansendexternally',
+    'effectivecanreceiveexternally', 'virtualdomain', 'defaultmailboxtransport',
+]
+
+# transport value of receivers without an own transport, resolved against the default on lookup
+INHERIT = None
+
+
+def _single(attrs, name):
+    values = attrs.get(name)
+    return values[0] if values else None
+
+
+def _true(attrs, name):
+    return (_single(attrs, name) or '').upper() == 'TRUE'
+
+
+def _effective_true(attrs, name):
+    # the effective flag includes the group policies, entries written before them only have their own flag
+    if attrs.get('effective' + name):
+        return _true(attrs, 'effective' + name)
+    return _true(attrs, name)
+
+
+def entry_rows(attrs):
+    """
+    Return the (map, key, value) rows of an entry given as normalized attributes
+    """
+    obj_classes = {o.lower() for o in attrs.get('objectclass', [])}
+    rows = []
+
+    if 'postfixconfiguration' in obj_classes:
+        for domain in attrs.get('virtualdomain', []):
+            rows.append(('virtual_domains', domain.lower(), 'OK'))
+
+    if 'mailenabledgroup' in obj_classes:
+        # mailRecipient holds the expanded primary addresses of all (nested) members
+        for alias in attrs.get('alias', []):
+            for recipient in attrs.get('mailrecipient', []):
+                rows.append(('virtual_alias', alias.lower(), recipient.lower()))
+        return rows
+
+    primary = _single(attrs, 'primarymail')
+    if not primary:
+        return rows
+    primary = primary.lower()
+
+    if 'mailreceiverentity' in obj_classes:
+        for alias in attrs.get('alias', []):
+            rows.append(('virtual_alias', alias.lower(), primary))
+
+        rows.append(('transport', primary, _single(attrs, 'mailboxtransport') or INHERIT))
+
+        if _effective_true(attrs, 'canreceiveexternally'):
+            rows.append(('receive_external', primary, 'OK'))
+
+    if 'mailsenderentity' in obj_classes:
+        login = _single(attrs, 'uid') or _single(attrs, 'fqdn')
+        if login:
+            for address in [primary] + attrs.get('sendalias', []):
+                rows.append(('sender_login', address.lower(), login))
+
+        if _effective_true(attrs, 'cansendexternally'):
+            rows.append(('send_external', primary, 'OK'))
+
+    return rows
+
+
+class MailIndex:
+    """
+    Lookup tables keyed by map name and lowercased key
+
+    Not thread safe, all methods have to be called from the thread running the event loop.
+    """
+
+    def __init__(self):
+        # map -> key -> {dn: [values]}
+        self._maps = {name: {} for name in MAPS}
+        # dn -> rows contributed by the entry
+        self._rows = {}
+        # defaultMailboxTransport of the Postfix configuration
+        self.default_transport = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def update(self, dn, attrs):
+        """
+        Add or replace the entry dn with the normalized attributes attrs
+        """
+        self.remove(dn)
+
+        if 'postfixconfiguration' in {o.lower() for o in attrs.get('objectclass', [])}:
+            self.default_transport = _single(attrs, 'defaultmailboxtransport')
+
+        rows = entry_rows(attrs)
+        if not rows:
+            return
+
+        dn = dn.lower()
+        self._rows[dn] = rows
+        for name, key, value in rows:
+            self._maps[name].setdefault(key, {}).setdefault(dn, []).append(value)
+
+    def remove(self, dn):
+        dn = dn.lower()
+        for name, key, _value in self._rows.pop(dn, []):
+            owners = self._maps[name].get(key)
+            if owners is None:
+                continue
+            owners.pop(dn, None)
+            if not owners:
+                del self._maps[name][key]
+
+    def lookup(self, name, key):
+        """
+        Return the value of key in map name or None, raises KeyError for unknown maps
+        """
+        owners = self._maps[name].get(key.lower())
+        if not owners:
+            return None
+
+        values = []
+        for dn in sorted(owners):
+            for value in owners[dn]:
+                if value is INHERIT:
+                    value = self.default_transport
+                if value is not None and value not in values:
+                    values.append(value)
+
+        if not values:
+            return None
+
+        if not MAPS[name]:
+            return values[0]
+
+        return ','.join(values)
+
+    def stats(self):
+        return {name: len(keys) for name, keys in self._maps.items()}
@@ -0,0 +1,182 @@
+"""
+Follow the mail entries of the IPA directory
+
+A persistent search is started before the entries are loaded, so no change between the
+load and the start of the change stream is lost. Changes which happened during the load are
+delivered afterwards and applied in order, which leaves every entry in its latest state.
+After a connection failure the entries are loaded again while the consumers keep answering
+from their current state.
+"""
+import logging
+import threading
+import time
+
+import ldap
+import ldap.sasl
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.psearch import EntryChangeNotificationControl, PersistentSearchControl
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 1000
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+POLL_TIMEOUT = 1
+
+CHANGE_TYPE_DELETE = 2
+CHANGE_TYPE_MODDN = 8
+
+_change_controls = {EntryChangeNotificationControl.controlType: EntryChangeNotificationControl}
+
+
+def normalize_attrs(attrs):
+    """
+    Convert the raw attributes of python-ldap to lowercased names and str values
+    """
+    return {name.lower(): [v.decode('utf-8') for v in values] for name, values in attrs.items()}
+
+
+def connect(uri, bind_dn=None, bind_password=None):
+    conn = ldap.initialize(uri)
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, 10)
+    if bind_dn:
+        conn.simple_bind_s(bind_dn, bind_password)
+    else:
+        # credentials come from the keytab in KRB5_CLIENT_KTNAME
+        conn.sasl_interactive_bind_s('', ldap.sasl.sasl({}, 'GSSAPI'))
+    return conn
+
+
+def connection_options(section):
+    """
+    Return the connect() keyword arguments from the [ldap] section of a daemon configuration
+    """
+    password = None
+    if section.get('bind_password_file'):
+        with open(section['bind_password_file']) as f:
+            password = f.read().strip()
+
+    return dict(bind_dn=section.get('bind_dn') or None, bind_password=password)
+
+
+def iter_paged_entries(conn, base, search_filter, attrs, page_size=PAGE_SIZE):
+    """
+    Yield (dn, normalized attributes) of all entries matching search_filter page by page
+    """
+    page = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = conn.search_ext(base, ldap.SCOPE_SUBTREE, search_filter, attrs, serverctrls=[page])
+        _rtype, rdata, _msgid, ctrls = conn.result3(msgid)
+        for dn, entry_attrs in rdata:
+            if dn is not None:
+                yield dn, normalize_attrs(entry_attrs)
+
+        cookie = None
+        for ctrl in ctrls:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                cookie = ctrl.cookie
+        if not cookie:
+            return
+        page.cookie = cookie
+
+
+class LDAPSource:
+    """
+    Follow the entries below base matching search_filter
+
+    on_sync(source) is called after every (re)connect once the change stream was started and
+    can load the current entries with source.iter_entries(). apply(dn, attrs, previous_dn) is
+    called for every change afterwards, attrs is None for deleted entries. Both are called
+    from the thread running run().
+    """
+
+    def __init__(self, uri, base, search_filter, attrs, on_sync, apply, bind_dn=None, bind_password=None,
+                 page_size=PAGE_SIZE):
+        self.uri = uri
+        self.base = base
+        self.search_filter = search_filter
+        self.attrs = attrs
+        self.on_sync = on_sync
+        self.apply = apply
+        self.bind_dn = bind_dn
+        self.bind_password = bind_password
+        self.page_size = page_size
+        self._conn = None
+        self._stopped = False
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='ldap', daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._stopped:
+            try:
+                self._conn = connect(self.uri, self.bind_dn, self.bind_password)
+                self._sync()
+            except ldap.LDAPError as e:
+                if self._stopped:
+                    break
+                logger.warning('LDAP connection to %s failed: %s, retrying in %ds', self.uri, e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            else:
+                delay = RECONNECT_MIN_DELAY
+            finally:
+                self._close()
+
+    def stop(self):
+        # picked up by run() within POLL_TIMEOUT
+        self._stopped = True
+
+    def iter_entries(self, search_filter=None):
+        return iter_paged_entries(self._conn, self.base, search_filter or self.search_filter, self.attrs,
+                                  self.page_size)
+
+    def _close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+    def _sync(self):
+        psearch = PersistentSearchControl(criticality=True, changesOnly=True, returnECs=True)
+        msgid = self._conn.search_ext(self.base, ldap.SCOPE_SUBTREE, self.search_filter, self.attrs,
+                                      serverctrls=[psearch])
+
+        self.on_sync(self)
+
+        while not self._stopped:
+            try:
+                rtype, rdata, _msgid, _ctrls, _name, _value = self._conn.result4(
+                    msgid, all=0, timeout=POLL_TIMEOUT, add_ctrls=1, resp_ctrl_classes=_change_controls)
+            except ldap.TIMEOUT:
+                continue
+
+            if rtype == ldap.RES_SEARCH_RESULT:
+                logger.warning('Persistent search on %s ended, reloading', self.uri)
+                return
+
+            for dn, attrs, ctrls in rdata:
+                if dn is not None:
+                    self._apply_change(dn, attrs, ctrls)
+
+    def _apply_change(self, dn, attrs, ctrls):
+        change_type = None
+        previous_dn = None
+        for ctrl in ctrls:
+            if isinstance(ctrl, EntryChangeNotificationControl):
+                change_type = ctrl.changeType
+                previous_dn = ctrl.previousDN
+
+        if change_type != CHANGE_TYPE_MODDN:
+            previous_dn = None
+
+        if change_type == CHANGE_TYPE_DELETE:
+            self.apply(dn, None, None)
+        else:
+            self.apply(dn, normalize_attrs(attrs), previous_dn)
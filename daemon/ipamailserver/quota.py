@@ -0,0 +1 @@
+../../plugin/ipaserver/plugins/mailserver_quota.py
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+Postfix socketmap server answering lookups from an in-memory MailIndex
+
+Requests and responses are netstrings as described in socketmap_table(5). A request is
+"<map> <key>", e.g. "virtual_alias user@example.test". Until the initial load from LDAP is
+complete every lookup is answered with TEMP, so Postfix defers the mail instead of rejecting it.
+
+Postfix configuration example::
+
+    virtual_alias_maps = socketmap:unix:/run/ipa-mailserver-socketmap/socketmap.sock:virtual_alias
+    smtpd_sender_login_maps = socketmap:unix:/run/ipa-mailserver-socketmap/socketmap.sock:sender_login
+"""
+import argparse
+import asyncio
+import configparser
+import logging
+import os
+import signal
+import time
+
+from ipamailserver.index import CANDIDATE_FILTER, ENTRY_ATTRS, MAPS, MailIndex
+from ipamailserver.ldapsource import LDAPSource, connection_options
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = '/etc/ipa-mailserver/socketmap.conf'
+# the maximum request size Postfix sends
+MAX_NETSTRING_LENGTH = 100000
+
+
+class ProtocolError(Exception):
+    pass
+
+
+async def read_netstring(reader):
+    length = await reader.readuntil(b':')
+    try:
+        length = int(length[:-1])
+    except ValueError:
+        raise ProtocolError('invalid netstring length')
+
+    if length > MAX_NETSTRING_LENGTH:
+        raise ProtocolError('netstring too long')
+
+    data = await reader.readexactly(length + 1)
+    if data[-1:] != b',':
+        raise ProtocolError('missing netstring terminator')
+
+    return data[:-1].decode('utf-8')
+
+
+def netstring(value):
+    data = value.encode('utf-8')
+    return str(len(data)).encode() + b':' + data + b','
+
+
+class SocketmapServer:
+    """
+    Serve lookups from the current index, which is replaced after every full load
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.index = None
+
+    def load(self, source):
+        # build the new index in the LDAP thread, lookups are served from the old one meanwhile
+        start = time.monotonic()
+        index = MailIndex()
+        for dn, attrs in source.iter_entries():
+            index.update(dn, attrs)
+
+        self.loop.call_soon_threadsafe(setattr, self, 'index', index)
+        logger.info('Loaded %d mail entries in %.1fs', len(index), time.monotonic() - start)
+
+    def apply(self, dn, attrs, previous_dn):
+        self.loop.call_soon_threadsafe(self._apply, dn, attrs, previous_dn)
+
+    def _apply(self, dn, attrs, previous_dn):
+        if self.index is None:
+            return
+
+        if previous_dn is not None:
+            self.index.remove(previous_dn)
+
+        if attrs is None:
+            self.index.remove(dn)
+        else:
+            self.index.update(dn, attrs)
+
+    def respond(self, request):
+        name, sep, key = request.partition(' ')
+        if not sep or not key:
+            return 'PERM invalid request'
+        if name not in MAPS:
+            return 'PERM unknown map {}'.format(name)
+        if self.index is None:
+            return 'TEMP index not loaded yet'
+
+        value = self.index.lookup(name, key)
+        if value is None:
+            return 'NOTFOUND '
+
+        return 'OK {}'.format(value)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_netstring(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                writer.write(netstring(self.respond(request)))
+                await writer.drain()
+        except (ProtocolError, UnicodeDecodeError, asyncio.LimitOverrunError) as e:
+            logger.warning('Closing socketmap connection: %s', e)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(config):
+    loop = asyncio.get_running_loop()
+    server = SocketmapServer(loop)
+
+    section = config['ldap']
+    source = LDAPSource(section['uri'], section['base'], CANDIDATE_FILTER, ENTRY_ATTRS, server.load, server.apply,
+                        page_size=section.getint('page_size', 1000), **connection_options(section))
+    source.start()
+
+    listen = config['socketmap'].get('listen', 'unix:/run/ipa-mailserver-socketmap/socketmap.sock')
+    if listen.startswith('unix:'):
+        path = listen[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = await asyncio.start_unix_server(server.handle, path)
+        os.chmod(path, 0o660)
+    else:
+        host, _sep, port = listen.rpartition(':')
+        listener = await asyncio.start_server(server.handle, host or None, int(port))
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info('Listening on %s', listen)
+    async with listener:
+        await stop.wait()
+
+    source.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Postfix socketmap server for the FreeIPA mail server extension')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG, help='configuration file')
+    parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(levelname)s %(name)s: %(message)s')
+
+    config = configparser.ConfigParser()
+    config.read_dict({'ldap': {}, 'socketmap': {}})
+    if not config.read(args.config):
+        parser.error('cannot read {}'.format(args.config))
+
+    asyncio.run(serve(config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+pytest.importorskip('ldap')
+
+from ipamailserver.dictproxy import DictProxy, UserCache, quota_fields, tabescape, tabunescape  # noqa: E402
+
+USER_DN = 'uid=jdoe,cn=users,cn=accounts,dc=example,dc=test'
+DOVECOT_DN = 'cn=dovecot,cn=mailserver,cn=etc,dc=example,dc=test'
+DEFAULTS = {'defaultmailboxquota': '*:storage=1G', 'defaultmailboxtransport': 'lmtp:unix:private/dovecot-lmtp'}
+
+
+def user(**attrs):
+    entry = {'objectclass': ['person', 'mailboxEntity'], 'uid': ['jdoe'], 'primarymail': ['JDoe@example.test']}
+    entry.update(attrs)
+    return entry
+
+
+class FakeLookup:
+    """
+    Stand-in for UserLookup, blocks every lookup until released
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def find_user(self, key):
+        self.calls.append(key)
+        self.release.wait(5)
+        for dn, attrs in self.users.items():
+            if key in [v.lower() for v in attrs.get('uid', []) + attrs.get('primarymail', [])]:
+                return dn.lower(), attrs
+        return None
+
+
+class FakeSource:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def iter_entries(self, search_filter=None):
+        return iter(self.entries)
+
+
+def run(test, users=None):
+    async def main():
+        lookup = FakeLookup(users if users is not None else {USER_DN: user()})
+        proxy = DictProxy(asyncio.get_running_loop(), lookup, 10, None)
+        proxy.defaults = dict(DEFAULTS)
+        await test(proxy, lookup)
+
+    asyncio.run(main())
+
+
+def test_tabescape():
+    value = 'a\tb\nc\rd\x01e'
+    assert tabescape(value) == 'a\x01tb\x01nc\x01rd\x011e'
+    assert tabunescape(tabescape(value)) == value
+
+
+def test_quota_fields():
+    assert quota_fields('*:storage=1G Trash:storage=+100M') == {
+        'quota_rule': '*:storage=1G',
+        'quota_rule2': 'Trash:storage=+100M',
+    }
+    # very old entries store megabytes
+    assert quota_fields('2048') == {'quota_rule': '*:storage=2G'}
+
+
+def test_user_cache_evicts_least_recently_used():
+    cache = UserCache(2)
+    cache.put('a', 'dn-a', 1)
+    cache.put('b', 'dn-b', 2)
+    assert cache.get('a') == (True, 1)
+    cache.put('c', 'dn-c', 3)
+
+    assert cache.get('b') == (False, None)
+    assert cache.evictions == 1
+    assert not cache.holds('dn-b')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_user_cache_discard_dn():
+    cache = UserCache(10)
+    cache.put('jdoe', 'dn', 1)
+    cache.put('jdoe@example.test', 'dn', 1)
+    cache.put('unknown', None, None)
+    cache.discard_dn('dn')
+
+    assert 'jdoe' not in cache and 'jdoe@example.test' not in cache
+    assert cache.get('unknown') == (True, None)
+
+
+def test_lookup_inherits_defaults():
+    async def test(proxy, lookup):
+        assert json.loads(await proxy.lookup_key('shared/userdb/jdoe')) == {
+            'quota_rule': '*:storage=1G',
+            'mailbox_transport': 'lmtp:unix:private/dovecot-lmtp',
+        }
+        assert await proxy.lookup_key('shared/quota/JDoe@Example.test') == '*:storage=1G'
+        assert await proxy.lookup_key('shared/transport/jdoe') == 'lmtp:unix:private/dovecot-lmtp'
+        # the user was cached under all its names on the first lookup
+        assert lookup.calls == ['jdoe']
+
+    run(test)
+
+
+def test_lookup_explicit_values():
+    async def test(proxy, lookup):
+        assert json.loads(await proxy.lookup_key('shared/userdb/jdoe')) == {
+            'quota_rule': '*:storage=2G',
+            'quota_rule2': 'Trash:ignore',
+            'mailbox_transport': 'smtp:[relay.example.test]',
+        }
+
+    run(test, {USER_DN: user(mailboxquota=['*:storage=2G Trash:ignore'],
+                             mailboxtransport=['smtp:[relay.example.test]'])})
+
+
+def test_lookup_unknown():
+    async def test(proxy, lookup):
+        assert await proxy.lookup_key('shared/userdb/unknown') is None
+        assert await proxy.lookup_key('shared/userdb/unknown') is None
+        assert await proxy.lookup_key('shared/unknown/jdoe') is None
+        assert await proxy.lookup_key('shared/userdb/') is None
+        assert lookup.calls == ['unknown']
+
+    run(test)
+
+
+def test_concurrent_lookups_share_a_query():
+    async def test(proxy, lookup):
+        lookup.release.clear()
+        lookups = [asyncio.ensure_future(proxy.get_user('jdoe')) for _i in range(10)]
+        await asyncio.sleep(0.05)
+        lookup.release.set()
+
+        records = await asyncio.gather(*lookups)
+        assert records == [dict(quota=None, transport=None)] * 10
+        assert lookup.calls == ['jdoe']
+
+    run(test)
+
+
+def test_changes_update_cached_users():
+    async def test(proxy, lookup):
+        await proxy.get_user('jdoe')
+
+        proxy._apply(USER_DN, user(mailboxquota=['*:storage=5G']), None)
+        assert await proxy.lookup_key('shared/quota/jdoe') == '*:storage=5G'
+
+        # not mail enabled anymore
+        proxy._apply(USER_DN, {'objectclass': ['person'], 'uid': ['jdoe']}, None)
+        assert await proxy.get_user('jdoe') is None
+
+        proxy._apply(USER_DN, user(), None)
+        assert await proxy.get_user('JDoe@example.test') == dict(quota=None, transport=None)
+
+        proxy._apply(USER_DN, None, None)
+        assert 'jdoe' not in proxy.cache
+        assert 'jdoe@example.test' not in proxy.cache
+        assert lookup.calls == ['jdoe']
+
+    run(test)
+
+
+def test_changes_of_uncached_users_are_ignored():
+    async def test(proxy, lookup):
+        proxy._apply(USER_DN, user(), None)
+        assert 'jdoe' not in proxy.cache
+
+    run(test)
+
+
+def test_changes_of_the_defaults():
+    async def test(proxy, lookup):
+        proxy._apply(DOVECOT_DN, {'objectclass': ['dovecotConfiguration'], 'defaultmailboxquota': ['*:storage=2G']},
+                     None)
+        assert await proxy.lookup_key('shared/quota/jdoe') == '*:storage=2G'
+
+        proxy._apply(DOVECOT_DN, {'objectclass': ['dovecotConfiguration']}, None)
+        assert await proxy.lookup_key('shared/quota/jdoe') is None
+        assert proxy.defaults['defaultmailboxtransport'] == 'lmtp:unix:private/dovecot-lmtp'
+
+    run(test)
+
+
+def test_sync_resets_the_cache():
+    async def test(proxy, lookup):
+        await proxy.get_user('jdoe')
+        proxy.sync(FakeSource([(DOVECOT_DN, {'objectclass': ['dovecotConfiguration'],
+                                             'defaultmailboxquota': ['*:storage=3G']})]))
+        await asyncio.sleep(0)
+
+        assert 'jdoe' not in proxy.cache
+        assert proxy.defaults == {'defaultmailboxquota': '*:storage=3G'}
+
+    run(test)
+
+
+def test_respond():
+    async def test(proxy, lookup):
+        assert await proxy.respond('H3\t0\t\tjdoe\tipa') is None
+        assert await proxy.respond('Lshared/transport/jdoe\tjdoe') == 'Olmtp:unix:private/dovecot-lmtp'
+        assert await proxy.respond('Lshared/transport/unknown') == 'N'
+        assert await proxy.respond('Ishared/') == 'Funsupported dict command I'
+
+    run(test)
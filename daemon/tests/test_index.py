@@ -0,0 +1,149 @@
+import pytest
+
+from ipamailserver.index import INHERIT, MailIndex, entry_rows
+
+USER_DN = 'uid=jdoe,cn=users,cn=accounts,dc=example,dc=test'
+GROUP_DN = 'cn=sales,cn=groups,cn=accounts,dc=example,dc=test'
+HOST_DN = 'fqdn=web.example.test,cn=computers,cn=accounts,dc=example,dc=test'
+POSTFIX_DN = 'cn=postfix,cn=mailserver,cn=etc,dc=example,dc=test'
+
+
+def user(**attrs):
+    entry = {
+        'objectclass': ['top', 'person', 'mailSenderEntity', 'mailReceiverEntity', 'mailboxEntity'],
+        'uid': ['jdoe'],
+        'primarymail': ['John.Doe@example.test'],
+        'alias': ['jd@example.test'],
+        'sendalias': ['Sales@example.test'],
+        'cansendexternally': ['TRUE'],
+        'canreceiveexternally': ['TRUE'],
+    }
+    entry.update(attrs)
+    return entry
+
+
+def postfix_config(transport='lmtp:unix:private/dovecot-lmtp'):
+    return {
+        'objectclass': ['top', 'nsContainer', 'postfixConfiguration'],
+        'virtualdomain': ['Example.test'],
+        'defaultmailboxtransport': [transport],
+    }
+
+
+def test_user_rows():
+    assert sorted(entry_rows(user())) == sorted([
+        ('virtual_alias', 'jd@example.test', 'john.doe@example.test'),
+        ('transport', 'john.doe@example.test', INHERIT),
+        ('receive_external', 'john.doe@example.test', 'OK'),
+        ('sender_login', 'john.doe@example.test', 'jdoe'),
+        ('sender_login', 'sales@example.test', 'jdoe'),
+        ('send_external', 'john.doe@example.test', 'OK'),
+    ])
+
+
+def test_user_rows_explicit_transport():
+    rows = entry_rows(user(mailboxtransport=['smtp:[relay.example.test]']))
+    assert ('transport', 'john.doe@example.test', 'smtp:[relay.example.test]') in rows
+
+
+def test_effective_flags_override_own_flags():
+    rows = entry_rows(user(effectivecansendexternally=['FALSE'], effectivecanreceiveexternally=['FALSE']))
+    assert not [r for r in rows if r[0] in ('send_external', 'receive_external')]
+
+
+def test_entry_without_primary_mail_has_no_rows():
+    assert entry_rows({'objectclass': ['top', 'person'], 'uid': ['jdoe']}) == []
+
+
+def test_group_rows():
+    rows = entry_rows({
+        'objectclass': ['top', 'groupOfNames', 'ipaUserGroup', 'mailEnabledGroup'],
+        'alias': ['Sales@example.test'],
+        'mailrecipient': ['a@example.test', 'B@example.test'],
+    })
+    assert rows == [
+        ('virtual_alias', 'sales@example.test', 'a@example.test'),
+        ('virtual_alias', 'sales@example.test', 'b@example.test'),
+    ]
+
+
+def test_host_rows():
+    rows = entry_rows({
+        'objectclass': ['top', 'ipaHost', 'mailSenderEntity'],
+        'fqdn': ['web.example.test'],
+        'primarymail': ['web@example.test'],
+        'cansendexternally': ['FALSE'],
+    })
+    assert rows == [('sender_login', 'web@example.test', 'web.example.test')]
+
+
+def test_lookup_is_case_insensitive():
+    index = MailIndex()
+    index.update(USER_DN, user())
+
+    assert index.lookup('virtual_alias', 'JD@Example.Test') == 'john.doe@example.test'
+    assert index.lookup('sender_login', 'sales@example.test') == 'jdoe'
+    assert index.lookup('virtual_alias', 'unknown@example.test') is None
+
+
+def test_lookup_joins_values_of_several_entries():
+    index = MailIndex()
+    index.update(USER_DN, user())
+    index.update(GROUP_DN, {
+        'objectclass': ['mailEnabledGroup'],
+        'alias': ['jd@example.test'],
+        'mailrecipient': ['other@example.test', 'john.doe@example.test'],
+    })
+
+    assert index.lookup('virtual_alias', 'jd@example.test') == 'other@example.test,john.doe@example.test'
+
+
+def test_inherited_transport_follows_the_default():
+    index = MailIndex()
+    index.update(USER_DN, user())
+    assert index.lookup('transport', 'john.doe@example.test') is None
+
+    index.update(POSTFIX_DN, postfix_config())
+    assert index.lookup('transport', 'john.doe@example.test') == 'lmtp:unix:private/dovecot-lmtp'
+    assert index.lookup('virtual_domains', 'example.test') == 'OK'
+
+    index.update(POSTFIX_DN, postfix_config('lmtp:inet:mail.example.test:24'))
+    assert index.lookup('transport', 'john.doe@example.test') == 'lmtp:inet:mail.example.test:24'
+
+
+def test_update_replaces_rows():
+    index = MailIndex()
+    index.update(USER_DN, user())
+    index.update(USER_DN.upper(), user(alias=['john@example.test']))
+
+    assert len(index) == 1
+    assert index.lookup('virtual_alias', 'jd@example.test') is None
+    assert index.lookup('virtual_alias', 'john@example.test') == 'john.doe@example.test'
+
+
+def test_remove():
+    index = MailIndex()
+    index.update(USER_DN, user())
+    index.update(HOST_DN, {'objectclass': ['mailSenderEntity'], 'fqdn': ['web.example.test'],
+                           'primarymail': ['web@example.test']})
+    index.remove(USER_DN)
+    index.remove('cn=unknown,dc=example,dc=test')
+
+    assert len(index) == 1
+    assert index.lookup('sender_login', 'john.doe@example.test') is None
+    assert index.stats()['virtual_alias'] == 0
+    assert index.stats()['sender_login'] == 1
+
+
+def test_disabled_entry_is_removed_by_update():
+    index = MailIndex()
+    index.update(USER_DN, user())
+    index.update(USER_DN, {'objectclass': ['top', 'person'], 'uid': ['jdoe']})
+
+    assert len(index) == 0
+    assert index.lookup('virtual_alias', 'jd@example.test') is None
+
+
+def test_unknown_map():
+    with pytest.raises(KeyError):
+        MailIndex().lookup('unknown', 'key')
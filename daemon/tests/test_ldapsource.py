@@ -0,0 +1,149 @@
+import pytest
+
+ldap = pytest.importorskip('ldap')
+
+from ldap.controls import SimplePagedResultsControl  # noqa: E402
+from ldap.controls.psearch import EntryChangeNotificationControl, PersistentSearchControl  # noqa: E402
+
+from ipamailserver.ldapsource import CHANGE_TYPE_DELETE, CHANGE_TYPE_MODDN, LDAPSource, connection_options, \
+    iter_paged_entries, normalize_attrs  # noqa: E402
+
+BASE = 'cn=accounts,dc=example,dc=test'
+CHANGE_TYPE_ADD = 1
+CHANGE_TYPE_MODIFY = 4
+
+
+def entry(uid):
+    attrs = {'objectClass': [b'person'], 'uid': [uid.encode()], 'primaryMail': ['{}@example.test'.format(uid).encode()]}
+    return 'uid={},cn=users,{}'.format(uid, BASE), attrs
+
+
+def change(uid, change_type, previous_dn=None):
+    ctrl = EntryChangeNotificationControl()
+    ctrl.changeType = change_type
+    ctrl.previousDN = previous_dn
+    ctrl.changeNumber = None
+    dn, attrs = entry(uid)
+    return dn, attrs, [ctrl]
+
+
+class FakeConnection:
+    """
+    Stand-in for a python-ldap connection serving the pages of a paged search and the
+    responses of a persistent search
+    """
+
+    def __init__(self, pages=(), changes=()):
+        self.pages = list(pages)
+        self.changes = list(changes)
+        self.searches = []
+        self.unbound = False
+
+    def search_ext(self, base, scope, search_filter, attrs, serverctrls=None):
+        self.searches.append((base, search_filter, serverctrls))
+        return len(self.searches)
+
+    def result3(self, msgid):
+        rdata, cookie = self.pages.pop(0)
+        ctrl = SimplePagedResultsControl(True, size=2, cookie=cookie)
+        return ldap.RES_SEARCH_RESULT, rdata, msgid, [ctrl]
+
+    def result4(self, msgid, all=1, timeout=-1, add_ctrls=0, resp_ctrl_classes=None):
+        response = self.changes.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if response is None:
+            return ldap.RES_SEARCH_RESULT, [], msgid, [], None, None
+        return ldap.RES_SEARCH_ENTRY, [response], msgid, [], None, None
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+def test_normalize_attrs():
+    assert normalize_attrs({'primaryMail': [b'j\xc3\xb6rg@example.test'], 'objectClass': [b'top', b'person']}) == {
+        'primarymail': ['jörg@example.test'],
+        'objectclass': ['top', 'person'],
+    }
+
+
+def test_iter_paged_entries():
+    conn = FakeConnection(pages=[
+        ([entry('a'), entry('b')], b'next'),
+        # referrals come without a DN
+        ([entry('c'), (None, ['ldap://other.example.test'])], b''),
+    ])
+
+    entries = list(iter_paged_entries(conn, BASE, '(objectclass=person)', ['uid'], page_size=2))
+
+    assert [attrs['uid'] for _dn, attrs in entries] == [['a'], ['b'], ['c']]
+    assert len(conn.searches) == 2
+    assert conn.searches[1][2][0].cookie == b'next'
+
+
+def test_connection_options(tmp_path):
+    password_file = tmp_path / 'password'
+    password_file.write_text('secret\n')
+
+    assert connection_options({}) == dict(bind_dn=None, bind_password=None)
+    assert connection_options({'bind_dn': 'cn=reader', 'bind_password_file': str(password_file)}) == dict(
+        bind_dn='cn=reader', bind_password='secret')
+
+
+def sync(changes):
+    calls = []
+
+    def on_sync(source):
+        # the change stream has to be started before the entries are loaded
+        assert len(source._conn.searches) == 1
+        assert isinstance(source._conn.searches[0][2][0], PersistentSearchControl)
+        calls.append(('sync',))
+
+    def apply(dn, attrs, previous_dn):
+        calls.append((dn, attrs and attrs['uid'], previous_dn))
+
+    source = LDAPSource('ldap://ipa.example.test', BASE, '(objectclass=person)', ['uid'], on_sync, apply)
+    source._conn = FakeConnection(changes=changes)
+    source._sync()
+
+    return calls
+
+
+def test_sync_applies_changes_in_order():
+    old_dn = entry('jdoe')[0]
+    calls = sync([
+        change('jdoe', CHANGE_TYPE_ADD),
+        ldap.TIMEOUT(),
+        change('jdoe', CHANGE_TYPE_MODIFY, previous_dn='ignored'),
+        change('john', CHANGE_TYPE_MODDN, previous_dn=old_dn),
+        change('john', CHANGE_TYPE_DELETE),
+        None,
+    ])
+
+    john_dn = entry('john')[0]
+    assert calls == [
+        ('sync',),
+        (old_dn, ['jdoe'], None),
+        (old_dn, ['jdoe'], None),
+        (john_dn, ['john'], old_dn),
+        (john_dn, None, None),
+    ]
+
+
+def test_sync_stops():
+    source = LDAPSource('ldap://ipa.example.test', BASE, '(objectclass=person)', ['uid'], lambda s: None,
+                        lambda *args: pytest.fail('no change expected'))
+    source._conn = FakeConnection(changes=[change('jdoe', CHANGE_TYPE_ADD)])
+    source.stop()
+    source._sync()
+
+    assert source._conn.changes
+
+
+def test_close():
+    source = LDAPSource('ldap://ipa.example.test', BASE, '(objectclass=person)', ['uid'], None, None)
+    conn = source._conn = FakeConnection()
+    source._close()
+
+    assert conn.unbound
+    assert source._conn is None
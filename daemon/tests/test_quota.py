@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from ipamailserver import quota
+from ipamailserver.quota import MB, QuotaLimit, QuotaRule, format_quota_rules, parse_quota_rules, \
+    quota_display_value, storage_limit, storage_limit_mb, storage_rule
+
+PLUGIN_QUOTA = os.path.join(os.path.dirname(__file__), '..', '..', 'plugin', 'ipaserver', 'plugins',
+                            'mailserver_quota.py')
+
+
+def test_parse_storage_rule():
+    assert parse_quota_rules('*:storage=1G') == (
+        QuotaRule('*', (QuotaLimit('storage', 1024 * MB, '', False),)),
+    )
+
+
+def test_parse_several_rules():
+    rules = parse_quota_rules('*:storage=10%:messages=1000 Trash:storage=+100M Spam:ignore')
+
+    assert rules == (
+        QuotaRule('*', (QuotaLimit('storage', 10, '', True), QuotaLimit('messages', 1000, '', False))),
+        QuotaRule('Trash', (QuotaLimit('storage', 100 * MB, '+', False),)),
+        QuotaRule('Spam', (QuotaLimit('ignore', None, '', False),)),
+    )
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('*:bytes=2048k', '*:storage=2M'),
+    ('*:storage=1536M', '*:storage=1536M'),
+    ('*:storage=1073741825', '*:storage=1073741825'),
+    ('*:STORAGE=1gb', '*:storage=1G'),
+    ('*:storage=0', '*:storage=0'),
+    ('*:backend=1G', '*:backend=1G'),
+    ('INBOX:storage=-10M:noenforcing', 'INBOX:storage=-10M:noenforcing'),
+])
+def test_format_canonical(value, expected):
+    assert format_quota_rules(parse_quota_rules(value)) == expected
+
+
+@pytest.mark.parametrize('value', [
+    '',
+    '*',
+    ':storage=1G',
+    '*:',
+    '*:storage=lots',
+    '*:messages=10k',
+    '*:size=1G',
+    '*:unknown',
+])
+def test_parse_invalid(value):
+    with pytest.raises(ValueError):
+        parse_quota_rules(value)
+
+
+def test_storage_rule():
+    assert storage_rule('2048') == '*:storage=2048M'
+    assert storage_limit_mb(parse_quota_rules(storage_rule(2048))) == 2048
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('*:storage=1G', 1024),
+    ('*:storage=1G Trash:storage=+100M', None),
+    ('*:storage=1G:messages=10', None),
+    ('*:storage=+1G', None),
+    ('*:storage=10%', None),
+    ('*:storage=1025k', None),
+    ('INBOX:storage=1G', None),
+])
+def test_storage_limit_mb(value, expected):
+    assert storage_limit_mb(parse_quota_rules(value)) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Trash:storage=+100M *:messages=10:storage=1G', 1024 * MB),
+    ('*:storage=0', None),
+    ('*:storage=10%', None),
+    ('INBOX:storage=1G', None),
+])
+def test_storage_limit(value, expected):
+    assert storage_limit(parse_quota_rules(value)) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('*:storage=1024M', '1024'),
+    ('*:bytes=1G Trash:storage=+100M', '*:storage=1G Trash:storage=+100M'),
+    ('not a rule', 'not a rule'),
+])
+def test_quota_display_value(value, expected):
+    assert quota_display_value(value) == expected
+
+
+def test_plugin_copy_is_identical():
+    # the IPA plugin can't import the daemon package, it ships its own copy of the module
+    with open(PLUGIN_QUOTA) as plugin, open(quota.__file__) as daemon:
+        assert plugin.read() == daemon.read()
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('ldap')
+
+from ipamailserver.socketmap import MAX_NETSTRING_LENGTH, ProtocolError, SocketmapServer, netstring, \
+    read_netstring  # noqa: E402
+
+USER_DN = 'uid=jdoe,cn=users,cn=accounts,dc=example,dc=test'
+USER = {
+    'objectclass': ['person', 'mailSenderEntity', 'mailReceiverEntity'],
+    'uid': ['jdoe'],
+    'primarymail': ['jdoe@example.test'],
+    'alias': ['john@example.test'],
+}
+
+
+class FakeSource:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def iter_entries(self):
+        return iter(self.entries)
+
+
+def read(data):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_netstring(reader)
+
+    return asyncio.run(run())
+
+
+def loaded_server(loop, entries=((USER_DN, USER),)):
+    server = SocketmapServer(loop)
+    server.load(FakeSource(list(entries)))
+    return server
+
+
+def test_netstring():
+    assert netstring('OK a@example.test') == b'17:OK a@example.test,'
+    # the length counts bytes, not characters
+    assert netstring('OK ä') == b'5:OK \xc3\xa4,'
+
+
+def test_read_netstring():
+    assert read(b'28:virtual_alias a@example.test,') == 'virtual_alias a@example.test'
+    assert read(netstring('transport ä@example.test')) == 'transport ä@example.test'
+
+
+@pytest.mark.parametrize('data', [
+    b'x:abc,',
+    b'3:abc;',
+    '{}:'.format(MAX_NETSTRING_LENGTH + 1).encode(),
+])
+def test_read_invalid_netstring(data):
+    with pytest.raises(ProtocolError):
+        read(data)
+
+
+def test_read_truncated_netstring():
+    with pytest.raises(asyncio.IncompleteReadError):
+        read(b'10:abc')
+
+
+def test_respond_before_load():
+    server = SocketmapServer(None)
+    assert server.respond('virtual_alias john@example.test') == 'TEMP index not loaded yet'
+
+
+def test_respond():
+    async def run():
+        server = loaded_server(asyncio.get_running_loop())
+        # the index is handed over to the event loop
+        await asyncio.sleep(0)
+
+        assert server.respond('virtual_alias John@Example.test') == 'OK jdoe@example.test'
+        assert server.respond('sender_login jdoe@example.test') == 'OK jdoe'
+        assert server.respond('virtual_alias unknown@example.test') == 'NOTFOUND '
+        assert server.respond('unknown john@example.test') == 'PERM unknown map unknown'
+        assert server.respond('virtual_alias') == 'PERM invalid request'
+        assert server.respond('virtual_alias ') == 'PERM invalid request'
+
+    asyncio.run(run())
+
+
+def test_apply_changes():
+    async def run():
+        server = loaded_server(asyncio.get_running_loop())
+        await asyncio.sleep(0)
+
+        renamed_dn = 'uid=john,cn=users,cn=accounts,dc=example,dc=test'
+        server.apply(renamed_dn, dict(USER, uid=['john']), USER_DN)
+        await asyncio.sleep(0)
+        assert len(server.index) == 1
+        assert server.respond('sender_login jdoe@example.test') == 'OK john'
+
+        server.apply(renamed_dn, None, None)
+        await asyncio.sleep(0)
+        assert len(server.index) == 0
+        assert server.respond('virtual_alias john@example.test') == 'NOTFOUND '
+
+    asyncio.run(run())
+
+
+def test_changes_before_load_are_ignored():
+    async def run():
+        server = SocketmapServer(asyncio.get_running_loop())
+        server.apply(USER_DN, USER, None)
+        await asyncio.sleep(0)
+        assert server.index is None
+
+    asyncio.run(run())
+
+
+def test_handle_connection():
+    async def run():
+        server = loaded_server(asyncio.get_running_loop())
+        await asyncio.sleep(0)
+
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # Postfix may send several requests without waiting for the responses
+            writer.write(netstring('virtual_alias john@example.test') + netstring('send_external jdoe@example.test'))
+            assert await read_netstring(reader) == 'OK jdoe@example.test'
+            assert await read_netstring(reader) == 'NOTFOUND '
+
+            # an invalid request closes the connection
+            writer.write(b'3:abc;')
+            assert await reader.read() == b''
+            writer.close()
+
+    asyncio.run(run())
@@ -18,6 +18,7 @@ Source0:        freeipa-mailserver-%{version}.tar.gz
 BuildRequires: ipa-server-common >= 4.6.0
 BuildRequires: python3-devel
 BuildRequires: python3-ipaserver >= 4.6.0
+BuildRequires: systemd-rpm-macros
 
 Requires(post): python3-ipa-%{plugin_name}-server
 Requires: python3-ipa-%{plugin_name}-server
@@ -30,12 +31,24 @@ mail server setup.
 Summary: Server side of postfix/dovecot with FreeIPA
 License: GPLv3+
 Requires: python3-ipaserver
+Requires(post): policycoreutils-python-utils
+Requires(postun): policycoreutils-python-utils
 
 %description  -n python3-ipa-%{plugin_name}-server
 A FreeIPA extension to handle configuration of a Postfix/Dovecot
 mail server setup.
 This package adds server-side support for FreeIPA.
 
+%package daemons
+Summary: Postfix and Dovecot lookup servers for FreeIPA mail entries
+License: GPLv3+
+Requires: python3-ldap
+%{?systemd_requires}
+
+%description daemons
+Daemons answering Postfix socketmap and Dovecot dict lookups from memory
+instead of LDAP. They are kept current with an LDAP persistent search.
+
 %prep
 %autosetup
 
@@ -60,6 +73,10 @@ for j in $(find plugin/schema.d -name '*.ldif') ; do
     %__cp $j %buildroot/%_datadir/ipa/schema.d
 done
 
+# optional schema, only copied to schema.d by the admin to inherit the default quota and transport
+%__mkdir_p %buildroot/%_datadir/%{name}
+%__cp plugin/schema.inherit/*.ldif %buildroot/%_datadir/%{name}
+
 for j in $(find plugin/updates -name '*.update') ; do
     %__cp $j %buildroot/%_datadir/ipa/updates
 done
@@ -68,6 +85,16 @@ for j in $(find plugin/ui -name '*.js') ; do
     %__cp $j %buildroot/%_datadir/ipa/ui/js/plugins/%{plugin_name}
 done
 
+# files written and read by the commands running in the web server
+%__mkdir_p %buildroot/%{_localstatedir}/lib/ipa-mailserver
+
+%__mkdir_p %buildroot/%{python3_sitelib}/ipamailserver
+%__cp daemon/ipamailserver/*.py %buildroot/%{python3_sitelib}/ipamailserver
+%__mkdir_p %buildroot/%{_unitdir}
+%__cp daemon/conf/*.service %buildroot/%{_unitdir}
+%__mkdir_p %buildroot/%{_sysconfdir}/ipa-mailserver
+%__cp daemon/conf/*.conf %buildroot/%{_sysconfdir}/ipa-mailserver
+
 %posttrans
 ipa_interp=python3
 $ipa_interp -c "import sys; from ipaserver.install import installutils; sys.exit(0 if installutils.is_ipa_configured() else 1);" > /dev/null 2>&1
@@ -87,14 +114,43 @@ if [ $? -eq 0 ]; then
     fi
 fi
 
+%post -n python3-ipa-%{plugin_name}-server
+semanage fcontext -a -t httpd_var_lib_t '%{_localstatedir}/lib/ipa-mailserver(/.*)?' >/dev/null 2>&1 || :
+restorecon -R %{_localstatedir}/lib/ipa-mailserver || :
+
+%postun -n python3-ipa-%{plugin_name}-server
+if [ $1 -eq 0 ]; then
+    semanage fcontext -d -t httpd_var_lib_t '%{_localstatedir}/lib/ipa-mailserver(/.*)?' >/dev/null 2>&1 || :
+fi
+
+%post daemons
+%systemd_post ipa-mailserver-socketmap.service ipa-mailserver-dict.service
+
+%preun daemons
+%systemd_preun ipa-mailserver-socketmap.service ipa-mailserver-dict.service
+
+%postun daemons
+%systemd_postun_with_restart ipa-mailserver-socketmap.service ipa-mailserver-dict.service
+
 %files
 %license COPYING
 %_datadir/ipa/schema.d/*
 %_datadir/ipa/updates/*
+%_datadir/%{name}
 %_datadir/ipa/ui/js/plugins/%{plugin_name}/*
 
 %files -n python3-ipa-%{plugin_name}-server
 %ipa_python3_sitelib/ipaserver/plugins/*
+%dir %attr(0750,apache,apache) %{_localstatedir}/lib/ipa-mailserver
+
+%files daemons
+%license COPYING
+%{python3_sitelib}/ipamailserver
+%{_unitdir}/ipa-mailserver-socketmap.service
+%{_unitdir}/ipa-mailserver-dict.service
+%dir %{_sysconfdir}/ipa-mailserver
+%config(noreplace) %{_sysconfdir}/ipa-mailserver/socketmap.conf
+%config(noreplace) %{_sysconfdir}/ipa-mailserver/dict.conf
 
 %changelog
 * Thu Jan 15 2026 Peter Keresztes Schmidt <carbenium@outlook.com> 0.2.3-6
@@ -1,14 +1,38 @@
-from ipalib import _, Bool, Str, errors, Int, Flag
+import contextlib
+import csv
+import functools
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import ldap as _ldap
+import ldif
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+from ldap.schema import ObjectClass
+
+from ipalib import _, ngettext, Bool, Str, StrEnum, errors, Int, Flag, Command, Object, Method
 from ipalib import output
 from ipalib.plugable import Registry
+from ipalib.request import context
 from ipalib.util import validate_domain_name
 from ipapython.dn import DN
 from ipapython.ipavalidate import Email
 from ipaserver.plugins.baseldap import LDAPObject, LDAPUpdate, LDAPRetrieve, add_missing_object_class, LDAPQuery, \
     pkey_to_value
-from ipaserver.plugins.group import group, group_add, group_mod
-from ipaserver.plugins.host import host, host_add
-from ipaserver.plugins.user import user, user_add, user_mod, user_show
+from ipaserver.plugins.group import group, group_add, group_add_member, group_del, group_mod, group_remove_member
+from ipaserver.plugins.host import host, host_add, host_del, host_mod
+from ipaserver.plugins.mailserver_quota import MB, format_quota_rules, parse_quota_rules, quota_display_value, \
+    storage_limit, storage_rule
+from ipaserver.plugins.user import user, user_add, user_del, user_find, user_mod, user_show
+from ipaserver.plugins.virtual import VirtualCommand
 
 __doc__ = _("""
 Mail server configuration
@@ -19,10 +43,657 @@ Configure mailboxes and mail routing.
 register = Registry()
 
 
+logger = logging.getLogger(__name__)
+
+CONFIG_CACHE_TTL = 60
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+PAGE_SIZE = 1000
+BATCH_SIZE = 100
+
+MAIL_USER_OBJECT_CLASSES = frozenset({'mailsenderentity', 'mailreceiverentity', 'mailboxentity'})
+MAIL_OBJECT_CLASSES = frozenset({'mailsenderentity', 'mailreceiverentity', 'mailenabledgroup'})
+# user_mod options which change the mail data of a user
+USER_MAIL_OPTIONS = (
+    'mail', 'primarymail', 'alias', 'sendalias', 'canreceiveexternally', 'cansendexternally', 'mailboxquota',
+    'mailboxtransport', 'rename', 'setattr', 'addattr', 'delattr',
+)
+HOST_MAIL_OPTIONS = ('primarymail', 'sendalias', 'cansendexternally', 'setattr', 'addattr', 'delattr')
+MAIL_ADDRESS_ATTRS = ('primarymail', 'alias', 'sendalias')
+MAIL_ENTRY_FILTER = '(|(objectclass=mailsenderentity)(objectclass=mailreceiverentity)(objectclass=mailenabledgroup))'
+MAIL_ENTRY_ATTRS = [
+    'objectclass', 'uid', 'fqdn', 'cn', 'primarymail', 'alias', 'sendalias', 'mailboxtransport',
+    'cansendexternally', 'canreceiveexternally', 'effectivecansendexternally', 'effectivecanreceiveexternally',
+    'memberof'
+]
+MAIL_DUMP_ATTRS = MAIL_ENTRY_ATTRS + ['mailrecipient', 'mailboxquota']
+# attributes which store a copy of a default unless the defaults are inherited
+MAIL_DEFAULT_ATTRS = ('mailboxquota', 'mailboxtransport')
+MAILSERVER_CONTAINER = DN(('cn', 'mailserver'), ('cn', 'etc'))
+# the only directory the commands running in the web server read files from and write files to
+MAILSERVER_FILES_DIR = '/var/lib/ipa-mailserver'
+MAILSERVER_FILES_OPERATION = 'manage mail server files'
+MAILSERVER_STATS_OPERATION = 'read mail server statistics'
+# own flag of an entry or policy of a group: flag combined with the policies of all groups of an entry
+MAIL_POLICY_ATTRS = (
+    ('cansendexternally', 'effectivecansendexternally'),
+    ('canreceiveexternally', 'effectivecanreceiveexternally'),
+)
+MAIL_POLICY_ENTRY_ATTRS = ['objectclass', 'memberof'] + [a for pair in MAIL_POLICY_ATTRS for a in pair]
+# match type: filter assertion template and test of a lowercased address against the criteria
+MAIL_FIND_MATCHES = {
+    'exact': ('{}', lambda address, criteria: address == criteria),
+    'prefix': ('{}*', lambda address, criteria: address.startswith(criteria)),
+    'substring': ('*{}*', lambda address, criteria: criteria in address),
+}
+
+
 class MailAlreadyMigratedError(errors.GenericError):
     format = _("Mail attributes for this entry were already migrated.")
 
 
+def request_cache(name):
+    """
+    Return the dict called name which lives as long as the current request
+
+    The caches are stored in the request context, which is destroyed after each request. A
+    batch command runs all of its commands in one request, so they share the caches.
+    """
+    caches = getattr(context, 'mailserver_cache', None)
+    if caches is None:
+        caches = context.mailserver_cache = {}
+    return caches.setdefault(name, {})
+
+
+def reset_request_cache():
+    """
+    Drop all request scoped caches, e.g. when running outside of an IPA request
+    """
+    if hasattr(context, 'mailserver_cache'):
+        del context.mailserver_cache
+
+
+class MailConfigCache:
+    """
+    Per-process cache for the Postfix, Dovecot and IPA configuration
+
+    Cached values expire after ``ttl`` seconds. The config mod commands invalidate the cache
+    of the process they run in, other server processes pick up the change once the TTL expired.
+    Within a request (a single command or a whole batch) a value is additionally pinned, so it
+    is loaded at most once and doesn't change between the commands of a batch.
+
+    The values are loaded with the credentials of the caller, so they are cached per bound
+    principal. A caller never gets a value it couldn't have read itself.
+    """
+
+    def __init__(self, ttl=CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, name, loader):
+        pinned = request_cache('config')
+        if name in pinned:
+            return pinned[name]
+
+        key = (name, getattr(context, 'principal', None))
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] > now:
+                self.hits += 1
+                pinned[name] = cached[1]
+                return cached[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            # don't store values which were loaded before an invalidation
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, value)
+
+        pinned[name] = value
+        return value
+
+    def invalidate(self, name=None):
+        pinned = request_cache('config')
+        if name is None:
+            pinned.clear()
+        else:
+            pinned.pop(name, None)
+
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == name]:
+                    del self._entries[key]
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                ttl=self.ttl,
+                cached=sorted({name for name, _principal in self._entries}),
+                principals=len({principal for _name, principal in self._entries}),
+            )
+
+
+config_cache = MailConfigCache()
+
+
+class HookStats:
+    """
+    Per-process statistics of the mail plugin callbacks and commands
+
+    Records call counts, errors, a latency histogram, LDAP operations and nested command
+    dispatches. Measurements nest: the LDAP operations and dispatches of a nested callback
+    are also accounted to the callback or command which caused it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def measure(self, name, log=False):
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = dict(ldap=0, dispatch=0)
+        stack.append(frame)
+        failed = False
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            stack.pop()
+            if stack:
+                stack[-1]['ldap'] += frame['ldap']
+                stack[-1]['dispatch'] += frame['dispatch']
+
+            self._record(name, elapsed_ms, frame, failed)
+            if log:
+                logger.debug('mailserver: %s took %.3f ms, %d LDAP operations, %d command dispatches',
+                             name, elapsed_ms, frame['ldap'], frame['dispatch'])
+
+    def count(self, kind):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[-1][kind] += 1
+
+    def _record(self, name, elapsed_ms, frame, failed):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = dict(
+                    calls=0, errors=0, total_ms=0.0, max_ms=0.0, ldap=0, dispatch=0,
+                    histogram={'le_{}ms'.format(b): 0 for b in LATENCY_BUCKETS_MS + ('inf',)},
+                )
+
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['ldap'] += frame['ldap']
+            stats['dispatch'] += frame['dispatch']
+
+            bucket = next((b for b in LATENCY_BUCKETS_MS if elapsed_ms <= b), 'inf')
+            stats['histogram']['le_{}ms'.format(bucket)] += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(s, histogram=dict(s['histogram'])) for name, s in self._stats.items()}
+
+
+hook_stats = HookStats()
+
+
+class CountingLDAP:
+    """
+    Proxy for the LDAP backend counting the operations of the current measurement
+    """
+    operations = frozenset({
+        'get_entry', 'get_entries', 'find_entries', 'find_entry_by_attr', 'add_entry', 'update_entry',
+        'delete_entry', 'move_entry', 'get_ipa_config', 'modify_s', 'add_entry_to_group',
+        'remove_entry_from_group',
+    })
+
+    def __init__(self, ldap):
+        self._ldap = ldap
+
+    def __getattr__(self, name):
+        attr = getattr(self._ldap, name)
+        if name not in self.operations:
+            return attr
+
+        @functools.wraps(attr)
+        def counted(*args, **kwargs):
+            hook_stats.count('ldap')
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+def counting_ldap(ldap):
+    if isinstance(ldap, CountingLDAP):
+        return ldap
+    return CountingLDAP(ldap)
+
+
+def _log_stats(api):
+    return getattr(api.env, 'mailserver_log_stats', False)
+
+
+def instrument(callback):
+    """
+    Measure a pre/post callback, its LDAP backend argument is replaced by a counting proxy
+    """
+    @functools.wraps(callback)
+    def wrapper(self, ldap, *args, **kwargs):
+        with hook_stats.measure(callback.__qualname__, _log_stats(self.api)):
+            return callback(self, counting_ldap(ldap), *args, **kwargs)
+
+    return wrapper
+
+
+def instrument_command(execute):
+    """
+    Measure the execute method of a command
+    """
+    @functools.wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        with hook_stats.measure(self.name, _log_stats(self.api)):
+            return execute(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _dispatch(api, command, **options):
+    hook_stats.count('dispatch')
+    return api.Command[command](**options)
+
+
+def get_postfix_config(api):
+    return config_cache.get('postfix',
+                            lambda: _dispatch(api, 'postfixconfig_show', all=True, raw=True)['result'])
+
+
+def get_dovecot_config(api):
+    return config_cache.get('dovecot',
+                            lambda: _dispatch(api, 'dovecotconfig_show', all=True, raw=True)['result'])
+
+
+def get_ipa_config(ldap):
+    return config_cache.get('ipa', ldap.get_ipa_config)
+
+
+def get_virtual_domains(api):
+    return config_cache.get('virtualdomains',
+                            lambda: frozenset(d.lower() for d in get_postfix_config(api).get('virtualdomain', [])))
+
+
+def get_validation_domains(api):
+    """
+    Return the virtual domains addresses are checked against
+
+    Callers which may not read the Postfix configuration, e.g. delegated user administrators,
+    get an empty set, which disables the domain check instead of failing the change.
+    """
+    try:
+        return get_virtual_domains(api)
+    except (errors.NotFound, errors.ACIError) as e:
+        logger.debug('Virtual domains not readable by the caller, skipping the domain check: %s', e)
+        return frozenset()
+
+
+def get_address_validator(api, ldap):
+    config = get_ipa_config(ldap)
+    return MailAddressValidator(lambda: get_validation_domains(api), config.get('ipadefaultemaildomain', [None])[0])
+
+
+def get_mail_defaults(api):
+    """
+    Return the default quota and transport, None for defaults which aren't set
+
+    The configuration is read with the credentials of the caller. Callers which may not read it,
+    e.g. users showing their own entry, get no defaults instead of an error.
+    """
+    try:
+        return read_mail_defaults(api)
+    except (errors.NotFound, errors.ACIError) as e:
+        logger.debug('Mail defaults not readable by the caller: %s', e)
+        return dict(mailboxquota=None, mailboxtransport=None)
+
+
+def read_mail_defaults(api):
+    """
+    Like get_mail_defaults(), but raises NotFound or ACIError if the configuration isn't readable
+    """
+    dovecot_config = get_dovecot_config(api)
+    postfix_config = get_postfix_config(api)
+
+    # dovecotconfig_show returns plain storage limits in MB and all other rules in Dovecot notation
+    quota = dovecot_config.get('defaultmailboxquota')
+    quota = str(quota[0]) if quota else None
+    if quota is not None and quota.isdigit():
+        quota = storage_rule(quota)
+
+    transport = postfix_config.get('defaultmailboxtransport')
+
+    return dict(
+        mailboxquota=quota,
+        mailboxtransport=str(transport[0]) if transport else None,
+    )
+
+
+def mail_defaults_inherited(api):
+    """
+    Check if users without an explicit quota or transport inherit the defaults
+
+    Inheritance is off unless enabled with postfixconfig-mod --inherit-defaults, the defaults are
+    then copied into every user like before.
+    """
+    value = get_postfix_config(api).get('inheritmaildefaults')
+    return bool(value) and str(value[0]).upper() == 'TRUE'
+
+
+def copy_mail_defaults(api, entry_attrs, attrs=MAIL_DEFAULT_ATTRS):
+    """
+    Store copies of the defaults for the attrs which are missing or None in entry_attrs
+
+    Nothing is copied if the defaults are inherited. The configuration has to be readable by the
+    caller, the schema requires the values without inheritance.
+    """
+    missing = [attr for attr in attrs if entry_attrs.get(attr) is None]
+    if not missing or mail_defaults_inherited(api):
+        return
+
+    defaults = read_mail_defaults(api)
+    for attr in missing:
+        if defaults[attr] is not None:
+            entry_attrs[attr] = defaults[attr]
+
+
+def inherit_mail_defaults(entry_attrs, defaults):
+    """
+    Fill in the default quota and transport of a mail user without explicit values
+
+    With inheritance enabled users only store a quota or transport if it was set explicitly, so
+    changing a default doesn't require to rewrite every user. Entries without primarymail are not
+    mail enabled and left alone.
+    """
+    if not entry_attrs.get('primarymail'):
+        return
+
+    for attr in ('mailboxquota', 'mailboxtransport'):
+        if not entry_attrs.get(attr) and defaults[attr] is not None:
+            entry_attrs[attr] = [defaults[attr]]
+
+
+def get_cached_entry(ldap, dn, attrs_list):
+    """
+    Read attrs_list of dn at most once per request
+
+    A cached entry is reused if it contains all requested attributes, otherwise the entry is
+    read again with the union of the attributes. Entries are shared, callers must not modify
+    the returned entry without invalidating it.
+    """
+    cache = request_cache('entries')
+    attrs = {a.lower() for a in attrs_list}
+
+    cached = cache.get(dn)
+    if cached is not None:
+        if attrs <= cached[0]:
+            return cached[1]
+        attrs |= cached[0]
+
+    entry = ldap.get_entry(dn, sorted(attrs))
+    cache[dn] = (attrs, entry)
+    return entry
+
+
+def invalidate_cached_entries(*dns):
+    """
+    Forget the cached entries of dns after they were modified, or all entries if no DN is given
+    """
+    cache = request_cache('entries')
+    if not dns:
+        cache.clear()
+
+    for dn in dns:
+        cache.pop(dn, None)
+
+
+def add_object_class(ldap, dn, object_class, modlist):
+    """
+    Add object_class to dn together with the changes in modlist in a single modify request
+
+    Returns False without changing the entry if it already has the object class, so no read
+    is needed beforehand to check it.
+    """
+    modlist = make_modlist(ldap, dict(objectclass=[object_class]), op=_ldap.MOD_ADD) + modlist
+
+    hook_stats.count('ldap')
+    with ldap.error_handler():
+        try:
+            ldap.conn.modify_s(str(dn), modlist)
+        except _ldap.TYPE_OR_VALUE_EXISTS:
+            return False
+
+    invalidate_cached_entries(dn)
+    return True
+
+
+def iter_paged_entries(ldap, filter, attrs_list, base_dn, scope=_ldap.SCOPE_SUBTREE, page_size=PAGE_SIZE):
+    """
+    Yield the entries matching filter page by page using the simple paged results control
+
+    In contrast to ldap.find_entries() only one page of entries is held in memory at a time.
+    """
+    cookie = b''
+    while True:
+        page_control = SimplePagedResultsControl(True, size=page_size, cookie=cookie)
+        hook_stats.count('ldap')
+        with ldap.error_handler():
+            msgid = ldap.conn.search_ext(str(base_dn), scope, filter, attrs_list, serverctrls=[page_control])
+            _rtype, rdata, _rmsgid, rctrls = ldap.conn.result3(msgid)
+
+        for entry_dn, raw_attrs in rdata:
+            # skip search references
+            if entry_dn is None:
+                continue
+
+            entry = ldap.make_entry(DN(entry_dn))
+            for name, values in raw_attrs.items():
+                entry.raw[name] = values
+            entry.reset_modlist()
+            yield entry
+
+        cookie = b''
+        for ctrl in rctrls:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                cookie = ctrl.cookie
+
+        if not cookie:
+            break
+
+
+def mail_entries_base_dn(api):
+    return DN(('cn', 'accounts'), api.env.basedn)
+
+
+def mail_entry_type(entry):
+    obj_classes = {o.lower() for o in entry['objectclass']}
+    if 'ipahost' in obj_classes:
+        return 'host'
+    if 'posixaccount' in obj_classes or 'person' in obj_classes:
+        return 'user'
+    return 'group'
+
+
+def mail_entry_to_dict(entry, defaults=None):
+    """
+    Convert an entry read with MAIL_ENTRY_ATTRS to a plain serializable dict
+
+    If defaults are given, users without an explicit quota or transport get the default values,
+    otherwise only the stored values are returned.
+    """
+    entry_type = mail_entry_type(entry)
+    name_attr = dict(user='uid', group='cn', host='fqdn')[entry_type]
+
+    result = dict(dn=str(entry.dn), type=entry_type, name=entry[name_attr][0])
+    for attr in ('primarymail', 'mailboxquota', 'mailboxtransport', 'cansendexternally', 'canreceiveexternally',
+                 'effectivecansendexternally', 'effectivecanreceiveexternally'):
+        value = entry.single_value.get(attr)
+        if value is not None:
+            result[attr] = value
+    if defaults is not None and entry_type == 'user' and 'primarymail' in result:
+        for attr in ('mailboxquota', 'mailboxtransport'):
+            if attr not in result and defaults[attr] is not None:
+                result[attr] = defaults[attr]
+    for attr in ('alias', 'sendalias', 'mailrecipient'):
+        if entry.get(attr):
+            result[attr] = sorted(entry[attr])
+
+    return result
+
+
+def mail_server_file(name, param='file'):
+    """
+    Return the path of the file name in MAILSERVER_FILES_DIR
+
+    The commands run as the web server user, so callers only choose a file name in a directory
+    owned by it instead of an arbitrary path on the server.
+    """
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise errors.ValidationError(name=param, error=_('must be a file name, the files are kept in %(dir)s')
+                                     % dict(dir=MAILSERVER_FILES_DIR))
+
+    return os.path.join(MAILSERVER_FILES_DIR, name)
+
+
+@contextlib.contextmanager
+def mail_server_file_errors():
+    """
+    Report a file which can't be read or written as an error of the command instead of an internal error
+    """
+    try:
+        yield
+    except OSError as e:
+        raise errors.ExecutionError(message=str(e))
+
+
+class MailServerFileCommand(VirtualCommand):
+    """
+    Base of the commands reading or writing files in MAILSERVER_FILES_DIR
+
+    They require the System: Manage Mail Server Files permission.
+    """
+    operation = MAILSERVER_FILES_OPERATION
+
+
+def write_file_atomic(path, lines, compress=False):
+    """
+    Write lines to path by replacing it with a completely written temporary file
+
+    With compress the file is gzip compressed.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+            for line in lines:
+                out.write(line.encode('utf-8'))
+                out.write(b'\n')
+            if compress:
+                out.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def make_modlist(ldap, attrs, op=_ldap.MOD_REPLACE):
+    modlist = []
+    for name, value in attrs.items():
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        modlist.append((op, name, [ldap.encode(v) for v in value]))
+
+    return modlist
+
+
+def apply_modlists(ldap, changes):
+    """
+    Apply a batch of (dn, modlist) changes
+
+    All modify requests are sent before the first response is awaited so a batch costs about one
+    round trip instead of one per entry. Returns a list of (dn, error) with error being None on success.
+    """
+    pending = []
+    results = []
+    for dn, modlist in changes:
+        hook_stats.count('ldap')
+        try:
+            with ldap.error_handler():
+                pending.append((dn, ldap.conn.modify_ext(str(dn), modlist)))
+        except errors.PublicError as e:
+            results.append((dn, e))
+
+    for dn, msgid in pending:
+        try:
+            with ldap.error_handler():
+                ldap.conn.result3(msgid)
+        except errors.PublicError as e:
+            results.append((dn, e))
+        else:
+            results.append((dn, None))
+            invalidate_cached_entries(dn)
+
+    return results
+
+
+def bump_mail_serial(api, ldap):
+    """
+    Increment the serial of the mail directory after the mail data changed
+
+    The directory server increments the value itself, so no read is needed and concurrent
+    changes can't get lost. The update grants the write to every permission which changes mail
+    data. A failure is only logged, the change itself already succeeded and must not be reported
+    as failed.
+    """
+    hook_stats.count('ldap')
+    try:
+        with ldap.error_handler():
+            ldap.conn.modify_s(str(DN(MAILSERVER_CONTAINER, api.env.basedn)),
+                               [(_ldap.MOD_INCREMENT, 'mailDirectorySerial', [b'1'])])
+    except errors.PublicError as e:
+        # consumers skip their reload until the next successful increment
+        logger.error('Could not increment the mail directory serial, consumers may keep stale data: %s', e)
+
+
 def normalize_and_validate_email(email, config):
     # check if default email domain should be added
     defaultdomain = config.get('ipadefaultemaildomain', [None])[0]
@@ -48,40 +719,104 @@ def normalize_and_validate_email(email, config):
     return email
 
 
-def parse_quota_rule(quota_str):
-    def norm_to_mb(limit_str):
-        suffix = limit_str[-1]
-        _limit = int(limit_str[0:-1])
+class MailAddressValidator:
+    """
+    Validate batches of mail addresses
+
+    Checks the syntax with ipapython.ipavalidate.Email and the domains against the set of
+    virtual domains. All errors of a batch are reported at once. virtual_domains may also be
+    a callable, which is only called once the first domain has to be checked.
+    """
 
-        in_mb = 0
-        if suffix == 'b':
-            in_mb = _limit // 1024 // 1024
-        elif suffix == 'k':
-            in_mb = _limit // 1024
-        elif suffix == 'M':
-            in_mb = _limit
-        elif suffix == 'G':
-            in_mb = _limit * 1024
-        elif suffix == 'T':
-            in_mb = _limit * 1024 * 1024
+    def __init__(self, virtual_domains, default_domain=None):
+        self._virtual_domains = virtual_domains
+        self.default_domain = default_domain
+
+    @property
+    def virtual_domains(self):
+        if callable(self._virtual_domains):
+            self._virtual_domains = self._virtual_domains()
+        return self._virtual_domains
+
+    def normalize(self, address, check_domain=True):
+        """
+        Return the normalized address and an error message or None
+        """
+        if '@' not in address and self.default_domain:
+            address = '{}@{}'.format(address, self.default_domain)
+
+        if not Email(address):
+            return address, _('invalid e-mail format: %(email)s') % dict(email=address)
+
+        domain = address.rpartition('@')[2]
+
+        # an empty list of virtual domains disables the check
+        if check_domain and self.virtual_domains and domain.lower() not in self.virtual_domains:
+            return address, _('%(email)s is not in a virtual domain') % dict(email=address)
+
+        return address, None
+
+    def validate_entry(self, entry_attrs, attrs=MAIL_ADDRESS_ATTRS, domain_attrs=MAIL_ADDRESS_ATTRS, existing=None):
+        """
+        Normalize the address attributes of entry_attrs in place
+
+        Values which the entry existing already has are kept as they are, so an old address in a
+        domain which isn't a virtual domain anymore doesn't block other changes of the entry.
+        Raises a single ValidationError listing every invalid address.
+        """
+        failed = []
+        for attr in attrs:
+            values = entry_attrs.get(attr)
+            if not values:
+                continue
+
+            known = {str(v).lower() for v in existing.get(attr, [])} if existing is not None else set()
+            single = not isinstance(values, (list, tuple))
+            normalized = []
+            for value in [values] if single else values:
+                if str(value).lower() in known:
+                    normalized.append(value)
+                    continue
+                value, error = self.normalize(str(value), attr in domain_attrs)
+                normalized.append(value)
+                if error is not None:
+                    failed.append((attr, error))
+
+            entry_attrs[attr] = normalized[0] if single else normalized
+
+        if failed:
+            raise errors.ValidationError(name=failed[0][0],
+                                         error='; '.join('{}: {}'.format(a, e) for a, e in failed))
+
+
+def format_quota_attr(entry_attrs, attr='mailboxquota'):
+    if attr in entry_attrs:
+        entry_attrs[attr] = quota_display_value(str(entry_attrs[attr][0]))
+
+
+def mail_migration_attrs(entry):
+    """
+    Compute the attributes which make an existing user entry mail enabled
 
-        return in_mb
+    entry has to contain the current objectclass and mail attributes. The caller adds the
+    quota and transport with copy_mail_defaults().
+    """
+    obj_classes = [o.lower() for o in entry['objectclass']]
 
-    parts = quota_str.split(':')
+    if MAIL_USER_OBJECT_CLASSES.intersection(obj_classes):
+        raise MailAlreadyMigratedError
 
-    mailbox = parts[0]
-    limit_conf = parts[1].split('=')
-    limit = None
-    if len(limit_conf) > 1:
-        limit_type = limit_conf[0]
-        limit = limit_conf[1]
+    if not entry.get('mail'):
+        raise errors.ValidationError(name='mail', error=_('Entry has no mail address to migrate.'))
 
-        if limit_type in ('storage', 'bytes'):
-            limit = norm_to_mb(limit)
-    else:
-        limit_type = limit_conf[0]
+    mail_attrs = {'mail': list(entry['mail'])}
+    normalize_mail_attrs(mail_attrs)
 
-    return mailbox, limit_type, limit
+    return dict(
+        objectclass=list(entry['objectclass']) + sorted(MAIL_USER_OBJECT_CLASSES.difference(obj_classes)),
+        mail=mail_attrs['mail'],
+        primarymail=mail_attrs['primarymail'],
+    )
 
 
 def normalize_mail_attrs(entry_attrs):
@@ -123,10 +858,18 @@ user.takes_params += (
         label='Mailbox quota [MB]'),
     Str('mailboxtransport?',
         cli_name='mailbox_transport',
-        label=_('Mailbox transport string'))
+        label=_('Mailbox transport string')),
+    Bool('effectivecanreceiveexternally?',
+         label=_('Can receive external mails (effective)'),
+         flags=('no_create', 'no_update', 'no_search')),
+    Bool('effectivecansendexternally?',
+         label=_('Can send mails to external locations (effective)'),
+         flags=('no_create', 'no_update', 'no_search')),
 )
 
-user.default_attributes = user.default_attributes + ['alias', 'sendalias', 'mailboxquota', 'mailboxtransport']
+# primarymail tells mail enabled users apart, which inherit the default quota and transport
+user.default_attributes = user.default_attributes + ['primarymail', 'alias', 'sendalias', 'mailboxquota',
+                                                     'mailboxtransport']
 
 user.managed_permissions = {**user.managed_permissions, **{
     'System: Read User Mail Attributes': {
@@ -134,7 +877,7 @@ user.managed_permissions = {**user.managed_permissions, **{
         'ipapermright': {'read', 'search', 'compare'},
         'ipapermdefaultattr': {
             'primarymail', 'alias', 'sendalias', 'canreceiveexternally', 'cansendexternally', 'mailboxquota',
-            'mailboxtransport'
+            'mailboxtransport', 'effectivecanreceiveexternally', 'effectivecansendexternally'
         }
     },
     'System: Modify User Mail Attributes': {
@@ -142,19 +885,17 @@ user.managed_permissions = {**user.managed_permissions, **{
         'ipapermright': {'write', 'add', 'delete'},
         'ipapermdefaultattr': {
             'primarymail', 'alias', 'sendalias', 'canreceiveexternally', 'cansendexternally', 'mailboxquota',
-            'mailboxtransport'
+            'mailboxtransport', 'effectivecanreceiveexternally', 'effectivecansendexternally'
         }
     }
 }}
 
 
+@instrument
 def usershow_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-    if 'mailboxquota' in entry_attrs:
-        try:
-            _, _, limit = parse_quota_rule(str(entry_attrs['mailboxquota'][0]))
-            entry_attrs['mailboxquota'] = str(limit)
-        except ValueError:
-            pass
+    if not options.get('raw'):
+        inherit_mail_defaults(entry_attrs, get_mail_defaults(self.api))
+    format_quota_attr(entry_attrs)
 
     return dn
 
@@ -162,6 +903,45 @@ def usershow_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
 user_show.register_post_callback(usershow_post_callback)
 
 
+@instrument
+def userfind_post_callback(self, ldap, entries, truncated, *args, **options):
+    # parsed rules are memoized, so converting a whole result set only parses each distinct rule once
+    defaults = None if options.get('raw') else get_mail_defaults(self.api)
+    for entry_attrs in entries:
+        if defaults is not None:
+            inherit_mail_defaults(entry_attrs, defaults)
+        format_quota_attr(entry_attrs)
+
+    return truncated
+
+
+user_find.register_post_callback(userfind_post_callback)
+
+
+def _explicit_address_attrs(options):
+    """
+    Address attributes whose domain has to be a virtual domain
+
+    Addresses derived from the IPA default e-mail domain are only checked for their syntax.
+    """
+    attrs = ['alias', 'sendalias']
+    if options.get('primarymail') or options.get('mail'):
+        attrs.append('primarymail')
+    return attrs
+
+
+def _changed_attrs(options):
+    """
+    Names of the attributes a command changes, including those of --setattr, --addattr and --delattr
+    """
+    attrs = set(options)
+    for option in ('setattr', 'addattr', 'delattr'):
+        for value in options.get(option) or ():
+            attrs.add(str(value).split('=', 1)[0].strip().lower())
+    return attrs
+
+
+@instrument
 def useradd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
     add_missing_object_class(ldap, 'mailSenderEntity', dn, entry_attrs, update=False)
     add_missing_object_class(ldap, 'mailReceiverEntity', dn, entry_attrs, update=False)
@@ -171,26 +951,20 @@ def useradd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **optio
         if 'mail' in entry_attrs:
             entry_attrs['primarymail'] = entry_attrs['mail'][0]
 
+    get_address_validator(self.api, ldap).validate_entry(entry_attrs, domain_attrs=_explicit_address_attrs(options))
     normalize_mail_attrs(entry_attrs)
 
-    if 'mailboxquota' in entry_attrs:
+    if entry_attrs.get('mailboxquota') is not None:
         try:
-            quota = int(entry_attrs['mailboxquota'])
+            entry_attrs['mailboxquota'] = storage_rule(entry_attrs['mailboxquota'])
         except ValueError:
             raise errors.ValidationError(name='mailboxquota', error='not a number')
-    else:
-        dovecot_config = self.api.Command['dovecotconfig_show'](all=True, raw=True)['result']
-        quota = int(dovecot_config.get('defaultmailboxquota')[0])
-
-    quota_str = '*:storage={}M'.format(quota)
-    entry_attrs['mailboxquota'] = quota_str
-
-    if 'mailboxtransport' not in entry_attrs:
-        postfix_config = self.api.Command['postfixconfig_show'](all=True, raw=True)['result']
-        entry_attrs['mailboxtransport'] = postfix_config.get('defaultmailboxtransport')
+    copy_mail_defaults(self.api, entry_attrs)
 
     entry_attrs['canreceiveexternally'] = entry_attrs.get('canreceiveexternally', True)
     entry_attrs['cansendexternally'] = entry_attrs.get('cansendexternally', True)
+    # the new user isn't a member of any group yet
+    set_effective_mail_flags(self.api, ldap, dn, entry_attrs, member_of=[])
 
     return dn
 
@@ -198,13 +972,18 @@ def useradd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **optio
 user_add.register_pre_callback(useradd_pre_callback)
 
 
+@instrument
 def useradd_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-    if 'mailboxquota' in entry_attrs:
-        try:
-            _, _, limit = parse_quota_rule(str(entry_attrs['mailboxquota'][0]))
-            entry_attrs['mailboxquota'] = str(limit)
-        except ValueError:
-            pass
+    # user_add adds the new user to the default group
+    refresh_member_groups(self.api, ldap, dn)
+    if get_mail_policies(self.api, ldap):
+        refresh_entry_mail_policy(self.api, ldap, dn)
+
+    if not options.get('raw'):
+        inherit_mail_defaults(entry_attrs, get_mail_defaults(self.api))
+    format_quota_attr(entry_attrs)
+
+    bump_mail_serial(self.api, ldap)
 
     return dn
 
@@ -212,21 +991,37 @@ def useradd_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
 user_add.register_post_callback(useradd_post_callback)
 
 
+@instrument
 def usermod_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-    if 'objectclass' in entry_attrs:
-        obj_classes = entry_attrs['objectclass']
-    else:
-        obj_classes = ldap.get_entry(dn, ['objectclass'])['objectclass']
+    # changes without addresses, e.g. of a phone number, neither need the configuration nor the entry
+    if any(attr in entry_attrs for attr in MAIL_ADDRESS_ATTRS + ('mail',)):
+        # the object classes are read along, they are needed to keep mail and primarymail in sync
+        existing = get_cached_entry(ldap, dn, ['objectclass'] + list(MAIL_ADDRESS_ATTRS))
+        get_address_validator(self.api, ldap).validate_entry(entry_attrs, domain_attrs=_explicit_address_attrs(options),
+                                                             existing=existing)
+
+    if 'mail' in entry_attrs or 'primarymail' in entry_attrs:
+        if 'objectclass' in entry_attrs:
+            obj_classes = entry_attrs['objectclass']
+        else:
+            obj_classes = get_cached_entry(ldap, dn, ['objectclass'])['objectclass']
+
+        obj_classes = [o.lower() for o in obj_classes]
+        mail_obj_classes = {'mailsenderentity', 'mailreceiverentity'}
 
-    obj_classes = [o.lower() for o in obj_classes]
-    mail_obj_classes = {'mailsenderentity', 'mailreceiverentity'}
+        if mail_obj_classes.intersection(obj_classes):
+            normalize_mail_attrs(entry_attrs)
 
-    if mail_obj_classes.intersection(obj_classes):
-        normalize_mail_attrs(entry_attrs)
+    if entry_attrs.get('mailboxquota') is not None:
+        entry_attrs['mailboxquota'] = storage_rule(entry_attrs['mailboxquota'])
+    # removing the quota or transport of a mail user resets it to the default
+    cleared = [attr for attr in MAIL_DEFAULT_ATTRS if attr in entry_attrs]
+    if cleared:
+        obj_classes = entry_attrs.get('objectclass') or get_cached_entry(ldap, dn, ['objectclass'])['objectclass']
+        if 'mailboxentity' in (o.lower() for o in obj_classes):
+            copy_mail_defaults(self.api, entry_attrs, cleared)
 
-    if 'mailboxquota' in entry_attrs:
-        quota_str = '*:storage={}M'.format(entry_attrs['mailboxquota'])
-        entry_attrs['mailboxquota'] = quota_str
+    set_effective_mail_flags(self.api, ldap, dn, entry_attrs)
 
     return dn
 
@@ -234,13 +1029,19 @@ def usermod_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **optio
 user_mod.register_pre_callback(usermod_pre_callback)
 
 
+@instrument
 def usermod_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-    if 'mailboxquota' in entry_attrs:
-        try:
-            _, _, limit = parse_quota_rule(str(entry_attrs['mailboxquota'][0]))
-            entry_attrs['mailboxquota'] = str(limit)
-        except ValueError:
-            pass
+    invalidate_cached_entries(dn)
+
+    if {'primarymail', 'mail'} & _changed_attrs(options):
+        refresh_member_groups(self.api, ldap, dn)
+
+    if not options.get('raw'):
+        inherit_mail_defaults(entry_attrs, get_mail_defaults(self.api))
+    format_quota_attr(entry_attrs)
+
+    if any(o in options for o in USER_MAIL_OPTIONS):
+        bump_mail_serial(self.api, ldap)
 
     return dn
 
@@ -250,34 +1051,141 @@ user_mod.register_post_callback(usermod_post_callback)
 
 @register()
 class user_migrate_mail(LDAPUpdate):
+    @instrument
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-        _entry_attrs = ldap.get_entry(dn, ['objectclass', 'mail'])
-        obj_classes = entry_attrs['objectclass'] = _entry_attrs['objectclass']
+        _entry_attrs = get_cached_entry(ldap, dn, ['objectclass', 'mail'])
+        entry_attrs.update(mail_migration_attrs(_entry_attrs))
+        copy_mail_defaults(self.api, entry_attrs)
 
-        obj_classes = [o.lower() for o in obj_classes]
-        mail_obj_classes = {'mailsenderentity', 'mailreceiverentity', 'mailboxentity'}
+        entry_attrs['canreceiveexternally'] = entry_attrs.get('canreceiveexternally', True)
+        entry_attrs['cansendexternally'] = entry_attrs.get('cansendexternally', True)
+        set_effective_mail_flags(self.api, ldap, dn, entry_attrs)
 
-        if mail_obj_classes.intersection(obj_classes):
-            raise MailAlreadyMigratedError
+        return dn
 
-        entry_attrs['objectclass'].extend(mail_obj_classes.difference(obj_classes))
+    @instrument
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        invalidate_cached_entries(dn)
+        refresh_member_groups(self.api, ldap, dn)
+        bump_mail_serial(self.api, ldap)
+        return dn
 
-        normalize_mail_attrs(_entry_attrs)
-        entry_attrs['mail'] = _entry_attrs['mail']
-        entry_attrs['primarymail'] = _entry_attrs['primarymail']
 
-        dovecot_config = self.api.Command['dovecotconfig_show'](all=True, raw=True)['result']
-        quota = int(dovecot_config.get('defaultmailboxquota')[0])
-        quota_str = '*:storage={}M'.format(quota)
-        entry_attrs['mailboxquota'] = quota_str
+@register()
+class user_migrate_mail_all(Command):
+    __doc__ = _("""
+    Migrate the mail attributes of all users which are not mail enabled yet.
 
-        postfix_config = self.api.Command['postfixconfig_show'](all=True, raw=True)['result']
-        entry_attrs['mailboxtransport'] = postfix_config.get('defaultmailboxtransport')
+    Users are processed with a paged search and updated in batches. Already migrated users
+    are skipped by the search, so an interrupted run can simply be restarted.
+    """)
 
-        entry_attrs['canreceiveexternally'] = entry_attrs.get('canreceiveexternally', True)
-        entry_attrs['cansendexternally'] = entry_attrs.get('cansendexternally', True)
+    msg_summary = _('Migrated %(migrated)d users, %(failed)d failed')
+    msg_summary_dry_run = _('Would migrate %(migrated)d users, %(failed)d failed')
 
-        return dn
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Migration result')),
+    )
+
+    takes_options = (
+        Str('filter?',
+            cli_name='filter',
+            label=_('Additional LDAP filter selecting the users to migrate')
+            ),
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Number of entries modified per batch'),
+            minvalue=1,
+            default=BATCH_SIZE
+            ),
+        Flag('dry_run',
+             cli_name='dry_run',
+             label=_('Only report which users would be migrated'),
+             default=False
+             ),
+    )
+
+    @instrument_command
+    def execute(self, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        dry_run = options.get('dry_run', False)
+        batch_size = options.get('batch_size') or BATCH_SIZE
+
+        search_filter = '(&(objectclass=posixaccount)(!(|{})){})'.format(
+            ''.join('(objectclass={})'.format(o) for o in sorted(MAIL_USER_OBJECT_CLASSES)),
+            self._user_filter(options.get('filter')),
+        )
+        base_dn = DN(self.api.env.container_user, self.api.env.basedn)
+
+        policies = get_mail_policies(self.api, ldap)
+        copied = {}
+        copy_mail_defaults(self.api, copied)
+        migrated = 0
+        failed = []
+        batch = []
+
+        def flush():
+            if dry_run:
+                return len(batch)
+
+            done = 0
+            for dn, error in apply_modlists(ldap, batch):
+                if error is None:
+                    done += 1
+                else:
+                    failed.append(dict(dn=str(dn), error=str(error)))
+            # bump per batch, so the consumers also see the users of an interrupted run
+            if done:
+                bump_mail_serial(self.api, ldap)
+            return done
+
+        for entry in iter_paged_entries(ldap, search_filter, ['uid', 'objectclass', 'mail', 'memberof'], base_dn):
+            try:
+                attrs = mail_migration_attrs(entry)
+            except errors.PublicError as e:
+                failed.append(dict(dn=str(entry.dn), error=str(e)))
+                continue
+
+            added_classes = attrs.pop('objectclass')[len(entry['objectclass']):]
+            attrs.update(copied)
+            attrs['canreceiveexternally'] = True
+            attrs['cansendexternally'] = True
+            denied = denied_mail_flags(entry.get('memberof', []), policies)
+            for attr, effective in MAIL_POLICY_ATTRS:
+                attrs[effective] = attr not in denied
+
+            modlist = make_modlist(ldap, dict(objectclass=added_classes), op=_ldap.MOD_ADD)
+            modlist.extend(make_modlist(ldap, attrs))
+            batch.append((entry.dn, modlist))
+
+            if len(batch) >= batch_size:
+                migrated += flush()
+                batch = []
+                logger.info('user_migrate_mail_all: %d users migrated, %d failed', migrated, len(failed))
+
+        if batch:
+            migrated += flush()
+
+        if migrated and not dry_run:
+            refresh_group_recipients(self.api, ldap, find_all_mail_groups(self.api, ldap))
+
+        counts = dict(migrated=migrated, failed=len(failed))
+        summary = self.msg_summary_dry_run if dry_run else self.msg_summary
+        logger.info('user_migrate_mail_all: %d users migrated, %d failed', migrated, len(failed))
+
+        return dict(
+            summary=str(summary % counts),
+            result=dict(migrated=migrated, failed=failed, dry_run=dry_run),
+        )
+
+    @staticmethod
+    def _user_filter(user_filter):
+        if not user_filter:
+            return ''
+        if not user_filter.startswith('('):
+            user_filter = '({})'.format(user_filter)
+        return user_filter
 
 
 group.takes_params += (
@@ -285,38 +1193,462 @@ group.takes_params += (
         cli_name='alias',
         label=_('Mail alias')
         ),
+    Str('mailrecipient*',
+        cli_name='mail_recipient',
+        label=_('Expanded mail recipients'),
+        flags=('no_create', 'no_update', 'no_search')
+        ),
+    Bool('canreceiveexternally?',
+         cli_name='can_receive_externally',
+         label=_('Members can receive external mails'),
+         doc=_('FALSE denies receiving external mails to all direct and indirect members')
+         ),
+    Bool('cansendexternally?',
+         cli_name='can_send_externally',
+         label=_('Members can send mails to external locations'),
+         doc=_('FALSE denies sending mails to external locations for all direct and indirect members')
+         ),
 )
 
 group.managed_permissions = {**group.managed_permissions, **{
     'System: Read Group Mail Attributes': {
         'ipapermbindruletype': 'all',
         'ipapermright': {'read', 'search', 'compare'},
-        'ipapermdefaultattr': {'alias'}
+        'ipapermdefaultattr': {'alias', 'mailrecipient', 'canreceiveexternally', 'cansendexternally'}
     },
     'System: Modify Group Mail Attributes': {
         'ipapermbindruletype': 'permission',
         'ipapermright': {'write', 'add', 'delete'},
-        'ipapermdefaultattr': {'alias'}
+        'ipapermdefaultattr': {'alias', 'mailrecipient', 'canreceiveexternally', 'cansendexternally'}
     }
 }}
 
 
-def groupadd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-    if 'alias' in entry_attrs:
-        add_missing_object_class(ldap, 'mailenabledgroup', dn, entry_attrs, update=False)
-    return dn
+def find_mail_groups(api, ldap, group_dns):
+    """
+    Return the mail enabled groups among group_dns
+    """
+    groups_dn = DN(api.env.container_group, api.env.basedn)
+    names = {dn[0].value for dn in group_dns if dn.endswith(groups_dn) and len(dn) == len(groups_dn) + 1}
+    if not names:
+        return []
 
+    search_filter = '(&(objectclass=mailenabledgroup)(|{}))'.format(
+        ''.join('(cn={})'.format(escape_filter_chars(n)) for n in sorted(names)))
 
-group_add.register_pre_callback(groupadd_pre_callback)
+    return list(iter_paged_entries(ldap, search_filter, ['objectclass', 'mailrecipient'], groups_dn,
+                                   scope=_ldap.SCOPE_ONELEVEL))
 
 
-def groupmod_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-    if 'alias' in entry_attrs:
-        entry_attrs.update(add_missing_object_class(ldap, 'mailenabledgroup', dn, update=False))
-    return dn
+def group_recipients(api, ldap, group_dn):
+    """
+    Return the primary addresses of all direct and indirect receiving members of a group
+    """
+    # memberOf also contains indirect memberships, so nested groups don't need to be walked
+    search_filter = '(&(objectclass=mailreceiverentity)(memberof={}))'.format(escape_filter_chars(str(group_dn)))
 
+    recipients = set()
+    for entry in iter_paged_entries(ldap, search_filter, ['primarymail'], mail_entries_base_dn(api)):
+        if entry.get('primarymail'):
+            recipients.add(entry.single_value['primarymail'].lower())
 
-group_mod.register_pre_callback(groupmod_pre_callback)
+    return sorted(recipients)
+
+
+def refresh_group_recipients(api, ldap, groups):
+    """
+    Update the materialized recipient lists of the given mail enabled group entries
+
+    Returns the number of updated groups.
+    """
+    updated = 0
+    for group_entry in groups:
+        recipients = group_recipients(api, ldap, group_entry.dn)
+        if sorted(r.lower() for r in group_entry.get('mailrecipient', [])) == recipients:
+            continue
+
+        group_entry['mailrecipient'] = recipients
+        try:
+            ldap.update_entry(group_entry)
+        except errors.EmptyModlist:
+            pass
+        except errors.ACIError:
+            # a stale recipient list delivers to the wrong members, so the change must not look successful
+            raise errors.ACIError(info=_(
+                'cannot update the mail recipients of %(group)s, run "ipa group-refresh-mail-recipients" '
+                'with sufficient privileges') % dict(group=group_entry.dn))
+        else:
+            invalidate_cached_entries(group_entry.dn)
+            updated += 1
+
+    return updated
+
+
+def check_recipients_writable(ldap, groups):
+    """
+    Raise ACIError if the recipient list of any of the mail enabled group entries can't be updated
+    """
+    for group_entry in groups:
+        if not ldap.can_write(group_entry.dn, 'mailrecipient'):
+            raise errors.ACIError(info=_('cannot update the mail recipients of %(group)s') % dict(group=group_entry.dn))
+
+
+def find_all_mail_groups(api, ldap):
+    return list(iter_paged_entries(ldap, '(objectclass=mailenabledgroup)', ['objectclass', 'mailrecipient'],
+                                   DN(api.env.container_group, api.env.basedn), scope=_ldap.SCOPE_ONELEVEL))
+
+
+def refresh_member_groups(api, ldap, dn):
+    """
+    Update the recipient lists of dn (if it is a mail enabled group) and all groups it is a member of
+
+    Returns the number of updated groups.
+    """
+    entry = get_cached_entry(ldap, dn, ['memberof'])
+    return refresh_group_recipients(api, ldap, find_mail_groups(api, ldap, [dn] + list(entry.get('memberof', []))))
+
+
+def get_mail_policies(api, ldap):
+    """
+    Return the mail policies of all groups as {group dn: {flag: bool}}
+
+    Only few groups carry a policy, so all of them are loaded with one search per request.
+    """
+    cache = request_cache('policies')
+    if 'groups' not in cache:
+        cache['groups'] = {}
+        for entry in iter_paged_entries(ldap, '(objectclass=mailpolicygroup)', MAIL_POLICY_ENTRY_ATTRS,
+                                        DN(api.env.container_group, api.env.basedn), scope=_ldap.SCOPE_ONELEVEL):
+            policy = {attr: entry.single_value[attr] for attr, _effective in MAIL_POLICY_ATTRS
+                      if entry.single_value.get(attr) is not None}
+            if policy:
+                cache['groups'][entry.dn] = policy
+
+    return cache['groups']
+
+
+def invalidate_mail_policies():
+    request_cache('policies').clear()
+
+
+def denied_mail_flags(member_of, policies):
+    """
+    Return the flags denied by a policy of any of the groups in member_of
+
+    memberOf already contains the indirect memberships, so the depth of the nesting doesn't matter.
+    A group policy can only restrict, an allowing policy doesn't override the flag of the member.
+    """
+    denied = set()
+    for group_dn in member_of:
+        for attr, value in policies.get(group_dn, {}).items():
+            if not value:
+                denied.add(attr)
+
+    return denied
+
+
+def set_effective_mail_flags(api, ldap, dn, entry_attrs, member_of=None):
+    """
+    Add the effective flags for the flags set in entry_attrs before the entry is written
+
+    The memberships of dn are only read if there are any group policies.
+    """
+    flags = [(attr, effective) for attr, effective in MAIL_POLICY_ATTRS if entry_attrs.get(attr) is not None]
+    if not flags:
+        return
+
+    policies = get_mail_policies(api, ldap)
+    if member_of is None:
+        member_of = get_cached_entry(ldap, dn, ['memberof']).get('memberof', []) if policies else []
+    denied = denied_mail_flags(member_of, policies)
+
+    for attr, effective in flags:
+        value = entry_attrs[attr]
+        if isinstance(value, (list, tuple)):
+            value = value[0]
+        entry_attrs[effective] = bool(value) and attr not in denied
+
+
+def effective_mail_flag(entry, attr):
+    """
+    Return the effective value of the flag attr of entry
+
+    Entries which weren't updated since the group policies were introduced only have their own flag.
+    """
+    value = entry.single_value.get(dict(MAIL_POLICY_ATTRS)[attr])
+    if value is None:
+        value = entry.single_value.get(attr)
+
+    return value
+
+
+def mail_policy_modlist(ldap, entry, policies):
+    """
+    Return the modlist updating the effective flags of entry, empty if they are up to date
+    """
+    denied = denied_mail_flags(entry.get('memberof', []), policies)
+
+    changed = {}
+    for attr, effective in MAIL_POLICY_ATTRS:
+        own = entry.single_value.get(attr)
+        if own is None:
+            continue
+        value = bool(own) and attr not in denied
+        if entry.single_value.get(effective) != value:
+            changed[effective] = value
+
+    return make_modlist(ldap, changed) if changed else []
+
+
+def refresh_entry_mail_policy(api, ldap, dn):
+    """
+    Recompute the effective flags of a single entry, returns whether they changed
+    """
+    entry = get_cached_entry(ldap, dn, MAIL_POLICY_ENTRY_ATTRS)
+    modlist = mail_policy_modlist(ldap, entry, get_mail_policies(api, ldap))
+    if not modlist:
+        return False
+
+    hook_stats.count('ldap')
+    try:
+        with ldap.error_handler():
+            ldap.conn.modify_s(str(dn), modlist)
+    except errors.ACIError:
+        # stale flags allow or deny external mail wrongly, so the change must not look successful
+        raise errors.ACIError(info=_(
+            'cannot update the effective mail flags of %(entry)s, run "ipa group-refresh-mail-policies" '
+            'with sufficient privileges') % dict(entry=dn))
+    invalidate_cached_entries(dn)
+
+    return True
+
+
+def refresh_mail_policies(api, ldap, search_filter=None, batch_size=BATCH_SIZE):
+    """
+    Recompute the effective flags of all mail entries, optionally only of those matching search_filter
+
+    The entries are read with a paged search and only entries whose flags changed are written,
+    in pipelined batches. Returns the number of updated entries, raises ACIError after all batches
+    were applied if the flags of some entries couldn't be written.
+    """
+    policies = get_mail_policies(api, ldap)
+    search_filter = '(&(|(objectclass=mailsenderentity)(objectclass=mailreceiverentity)){})'.format(
+        search_filter or '')
+
+    updated = 0
+    batch = []
+    denied = []
+
+    def flush():
+        done = 0
+        for dn, error in apply_modlists(ldap, batch):
+            if error is None:
+                done += 1
+            else:
+                logger.warning('Could not update the effective mail flags of %s: %s', dn, error)
+                if isinstance(error, errors.ACIError):
+                    denied.append(dn)
+        return done
+
+    for entry in iter_paged_entries(ldap, search_filter, MAIL_POLICY_ENTRY_ATTRS, mail_entries_base_dn(api)):
+        modlist = mail_policy_modlist(ldap, entry, policies)
+        if modlist:
+            batch.append((entry.dn, modlist))
+        if len(batch) >= batch_size:
+            updated += flush()
+            batch = []
+
+    if batch:
+        updated += flush()
+
+    if updated:
+        bump_mail_serial(api, ldap)
+
+    if denied:
+        raise errors.ACIError(info=_(
+            'cannot update the effective mail flags of %(count)d entries, e.g. %(entry)s, run '
+            '"ipa group-refresh-mail-policies" with sufficient privileges') % dict(count=len(denied), entry=denied[0]))
+
+    return updated
+
+
+def check_mail_policy_writable(ldap, dns):
+    """
+    Raise ACIError if the effective flags of any of the mail entries among dns can't be updated
+    """
+    for dn in dns:
+        obj_classes = {o.lower() for o in get_cached_entry(ldap, dn, ['objectclass'])['objectclass']}
+        if not {'mailsenderentity', 'mailreceiverentity'}.intersection(obj_classes):
+            continue
+        if not all(ldap.can_write(dn, effective) for _attr, effective in MAIL_POLICY_ATTRS):
+            raise errors.ACIError(info=_('cannot update the effective mail flags of %(entry)s') % dict(entry=dn))
+
+
+def member_filter(group_dns):
+    return '(|{})'.format(''.join('(memberof={})'.format(escape_filter_chars(str(dn))) for dn in group_dns))
+
+
+def has_mail_policy(api, ldap, group_dn):
+    """
+    Check if group_dn or any group it is a member of has a mail policy
+    """
+    policies = get_mail_policies(api, ldap)
+    if not policies:
+        return False
+
+    entry = get_cached_entry(ldap, group_dn, ['memberof'])
+    return any(dn in policies for dn in [group_dn] + list(entry.get('memberof', [])))
+
+
+def _has_mail_policy_attrs(entry_attrs):
+    return any(entry_attrs.get(attr) is not None for attr, _effective in MAIL_POLICY_ATTRS)
+
+
+@instrument
+def groupadd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+    if 'alias' in entry_attrs:
+        get_address_validator(self.api, ldap).validate_entry(entry_attrs, attrs=['alias'])
+        add_missing_object_class(ldap, 'mailenabledgroup', dn, entry_attrs, update=False)
+    if _has_mail_policy_attrs(entry_attrs):
+        add_missing_object_class(ldap, 'mailpolicygroup', dn, entry_attrs, update=False)
+    return dn
+
+
+group_add.register_pre_callback(groupadd_pre_callback)
+
+
+@instrument
+def groupadd_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+    if any(attr in options for attr, _effective in MAIL_POLICY_ATTRS):
+        # a new group has no members yet
+        invalidate_mail_policies()
+    if 'alias' in options:
+        bump_mail_serial(self.api, ldap)
+    return dn
+
+
+group_add.register_post_callback(groupadd_post_callback)
+
+
+@instrument
+def groupmod_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+    added_classes = []
+    if 'alias' in entry_attrs:
+        existing = get_cached_entry(ldap, dn, ['objectclass', 'alias'])
+        get_address_validator(self.api, ldap).validate_entry(entry_attrs, attrs=['alias'], existing=existing)
+        added_classes.append('mailenabledgroup')
+    if _has_mail_policy_attrs(entry_attrs):
+        added_classes.append('mailpolicygroup')
+
+    if added_classes:
+        obj_classes = list(get_cached_entry(ldap, dn, ['objectclass'])['objectclass'])
+        missing = [o for o in added_classes if o not in [c.lower() for c in obj_classes]]
+        if missing:
+            entry_attrs['objectclass'] = obj_classes + missing
+    return dn
+
+
+group_mod.register_pre_callback(groupmod_pre_callback)
+
+
+@instrument
+def groupmod_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+    invalidate_cached_entries(dn)
+    if 'alias' in options:
+        refresh_group_recipients(self.api, ldap, find_mail_groups(self.api, ldap, [dn]))
+        bump_mail_serial(self.api, ldap)
+    if 'rename' in options:
+        # the policies are keyed by the group DN
+        invalidate_mail_policies()
+    if any(attr in options for attr, _effective in MAIL_POLICY_ATTRS):
+        invalidate_mail_policies()
+        refresh_mail_policies(self.api, ldap, member_filter([dn]))
+    return dn
+
+
+group_mod.register_post_callback(groupmod_post_callback)
+
+
+@instrument
+def groupmember_pre_callback(self, ldap, dn, member_dns, failed, *keys, **options):
+    # fail before the membership changes instead of leaving recipient lists or effective flags stale afterwards
+    entry = get_cached_entry(ldap, dn, ['memberof'])
+    check_recipients_writable(ldap, find_mail_groups(self.api, ldap, [dn] + list(entry.get('memberof', []))))
+    if has_mail_policy(self.api, ldap, dn):
+        check_mail_policy_writable(ldap, member_dns.get('member', {}).get('user', []))
+    return dn
+
+
+group_add_member.register_pre_callback(groupmember_pre_callback)
+group_remove_member.register_pre_callback(groupmember_pre_callback)
+
+
+@instrument
+def groupmember_post_callback(self, ldap, completed, failed, dn, entry_attrs, *keys, **options):
+    if completed:
+        # memberOf of all direct and indirect members changed
+        invalidate_cached_entries()
+        if refresh_member_groups(self.api, ldap, dn):
+            bump_mail_serial(self.api, ldap)
+        if has_mail_policy(self.api, ldap, dn):
+            # removed members aren't members anymore, so they are selected by name
+            terms = ['(uid={})'.format(escape_filter_chars(u)) for u in options.get('user') or []]
+            terms += ['(memberof={})'.format(escape_filter_chars(str(self.api.Object['group'].get_dn(g))))
+                      for g in options.get('group') or []]
+            if terms:
+                refresh_mail_policies(self.api, ldap, '(|{})'.format(''.join(terms)))
+    return completed, dn
+
+
+group_add_member.register_post_callback(groupmember_post_callback)
+group_remove_member.register_post_callback(groupmember_post_callback)
+
+
+@instrument
+def memberdel_pre_callback(self, ldap, dn, *keys, **options):
+    # the memberships are gone after the deletion, remember the affected groups until the post callback
+    entry = get_cached_entry(ldap, dn, ['objectclass', 'memberof'])
+    groups = find_mail_groups(self.api, ldap, entry.get('memberof', []))
+    if groups or MAIL_OBJECT_CLASSES.intersection(o.lower() for o in entry['objectclass']):
+        if not hasattr(context, 'mailserver_deleted_member_groups'):
+            context.mailserver_deleted_member_groups = {}
+        context.mailserver_deleted_member_groups[dn] = groups
+
+    # the members of a deleted group lose the policies of the group and the groups it is a member of
+    if 'groupofnames' in [o.lower() for o in entry['objectclass']] and has_mail_policy(self.api, ldap, dn):
+        search_filter = '(&(|(objectclass=mailsenderentity)(objectclass=mailreceiverentity)){})'.format(
+            member_filter([dn]))
+        if not hasattr(context, 'mailserver_deleted_policy_members'):
+            context.mailserver_deleted_policy_members = {}
+        context.mailserver_deleted_policy_members[dn] = [
+            e.dn for e in iter_paged_entries(ldap, search_filter, ['objectclass'], mail_entries_base_dn(self.api))
+        ]
+    return dn
+
+
+@instrument
+def memberdel_post_callback(self, ldap, dn, *keys, **options):
+    invalidate_cached_entries()
+    groups = getattr(context, 'mailserver_deleted_member_groups', {}).pop(dn, None)
+    if groups is not None:
+        # a mail entry was deleted or the recipients of its groups changed
+        refresh_group_recipients(self.api, ldap, groups)
+        bump_mail_serial(self.api, ldap)
+
+    members = getattr(context, 'mailserver_deleted_policy_members', {}).pop(dn, None)
+    if members is not None:
+        invalidate_mail_policies()
+        if any([refresh_entry_mail_policy(self.api, ldap, member) for member in members]):
+            bump_mail_serial(self.api, ldap)
+    return True
+
+
+user_del.register_pre_callback(memberdel_pre_callback)
+user_del.register_post_callback(memberdel_post_callback)
+group_del.register_pre_callback(memberdel_pre_callback)
+group_del.register_post_callback(memberdel_post_callback)
+host_del.register_pre_callback(memberdel_pre_callback)
+host_del.register_post_callback(memberdel_post_callback)
 
 
 @register()
@@ -332,18 +1664,26 @@ class group_enable_mail(LDAPQuery):
             )
     )
 
+    @instrument_command
     def execute(self, *args, **kw):
+        ldap = counting_ldap(self.obj.backend)
         dn = self.obj.get_dn(*args, **kw)
-        entry = self.obj.backend.get_entry(dn, ['objectclass'])
 
-        if 'mailenabledgroup' not in [o.lower() for o in entry['objectclass']]:
-            entry['objectclass'].append('mailenabledgroup')
-        else:
-            raise errors.AlreadyActive()
+        aliases = dict(alias=list(kw['alias']))
+        get_address_validator(self.api, ldap).validate_entry(aliases, attrs=['alias'])
+        aliases['mailrecipient'] = group_recipients(self.api, ldap, dn)
+        if not aliases['mailrecipient']:
+            del aliases['mailrecipient']
 
-        entry['alias'] = list(kw['alias'])
+        try:
+            enabled = add_object_class(ldap, dn, 'mailenabledgroup', make_modlist(ldap, aliases))
+        except errors.NotFound:
+            self.obj.handle_not_found(*args)
+
+        if not enabled:
+            raise errors.AlreadyActive()
 
-        self.obj.backend.update_entry(entry)
+        bump_mail_serial(self.api, ldap)
 
         return dict(
             result=True,
@@ -358,21 +1698,26 @@ class group_disable_mail(LDAPQuery):
     has_output = output.standard_value
     msg_summary = _('Disabled mail aliases for group "%(value)s"')
 
+    @instrument_command
     def execute(self, *args, **kw):
+        ldap = counting_ldap(self.obj.backend)
         dn = self.obj.get_dn(*args, **kw)
-        entry = self.obj.backend.get_entry(dn, ['objectclass', 'alias'])
+        entry = get_cached_entry(ldap, dn, ['objectclass', 'alias', 'mailrecipient'])
 
         if 'mailenabledgroup' in [o.lower() for o in entry['objectclass']]:
-            try:
-                del entry['alias']
-            except KeyError:
-                pass
+            for attr in ('alias', 'mailrecipient'):
+                try:
+                    del entry[attr]
+                except KeyError:
+                    pass
 
             entry['objectclass'].remove('mailenabledgroup')
         else:
             raise errors.AlreadyInactive()
 
-        self.obj.backend.update_entry(entry)
+        ldap.update_entry(entry)
+        invalidate_cached_entries(dn)
+        bump_mail_serial(self.api, ldap)
 
         return dict(
             result=True,
@@ -380,6 +1725,75 @@ class group_disable_mail(LDAPQuery):
         )
 
 
+@register()
+class group_refresh_mail_recipients(Command):
+    __doc__ = _('Rebuild the expanded mail recipients of mail enabled groups.')
+
+    msg_summary = _('Refreshed the mail recipients of %(count)d groups')
+
+    takes_args = (
+        Str('cn*',
+            cli_name='group',
+            label=_('Group name')
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', bool, _('True')),
+    )
+
+    @instrument_command
+    def execute(self, cn=None, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+
+        if cn:
+            groups = find_mail_groups(self.api, ldap, [self.api.Object['group'].get_dn(c) for c in cn])
+        else:
+            groups = find_all_mail_groups(self.api, ldap)
+
+        if refresh_group_recipients(self.api, ldap, groups):
+            bump_mail_serial(self.api, ldap)
+
+        return dict(
+            summary=str(self.msg_summary % dict(count=len(groups))),
+            result=True,
+        )
+
+
+@register()
+class group_refresh_mail_policies(Command):
+    __doc__ = _('Recompute the effective send and receive flags of the members of groups with mail policies.')
+
+    msg_summary = _('Updated the effective mail flags of %(count)d entries')
+
+    takes_args = (
+        Str('cn*',
+            cli_name='group',
+            label=_('Group name')
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', int, _('Number of updated entries')),
+    )
+
+    @instrument_command
+    def execute(self, cn=None, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+
+        search_filter = None
+        if cn:
+            search_filter = member_filter([self.api.Object['group'].get_dn(c) for c in cn])
+        count = refresh_mail_policies(self.api, ldap, search_filter)
+
+        return dict(
+            summary=str(self.msg_summary % dict(count=count)),
+            result=count,
+        )
+
+
 host.takes_params += (
     Flag('disablemail',
          cli_name='disable_mail',
@@ -399,30 +1813,39 @@ host.takes_params += (
          cli_name='can_send_externally',
          label='Can send mails to external locations'
          ),
+    Bool('effectivecansendexternally?',
+         label=_('Can send mails to external locations (effective)'),
+         flags=('no_create', 'no_update', 'no_search')
+         ),
 )
 
 host.managed_permissions = {**host.managed_permissions, **{
     'System: Read Host Mail Attributes': {
         'ipapermbindruletype': 'all',
         'ipapermright': {'read', 'search', 'compare'},
-        'ipapermdefaultattr': {'primarymail', 'sendalias', 'cansendexternally'}
+        'ipapermdefaultattr': {'primarymail', 'sendalias', 'cansendexternally', 'effectivecansendexternally'}
     },
     'System: Modify Host Mail Attributes': {
         'ipapermbindruletype': 'permission',
         'ipapermright': {'write', 'add', 'delete'},
-        'ipapermdefaultattr': {'primarymail', 'sendalias', 'cansendexternally'}
+        'ipapermdefaultattr': {'primarymail', 'sendalias', 'cansendexternally', 'effectivecansendexternally'}
     }
 }}
 
 
+@instrument
 def hostadd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
     if not options.get('disablemail'):
+        get_address_validator(self.api, ldap).validate_entry(entry_attrs, attrs=['primarymail', 'sendalias'])
+
         entry_attrs.update(add_missing_object_class(ldap, 'mailsenderentity', dn, entry_attrs, update=False))
         if 'primarymail' not in entry_attrs:
-            config = ldap.get_ipa_config()
+            config = get_ipa_config(ldap)
             entry_attrs['primarymail'] = normalize_and_validate_email(entry_attrs['serverhostname'], config)
 
         entry_attrs['cansendexternally'] = entry_attrs.get('cansendexternally', False)
+        # hosts can't be members of user groups, so no group policy applies
+        set_effective_mail_flags(self.api, ldap, dn, entry_attrs, member_of=[])
 
     return dn
 
@@ -430,6 +1853,36 @@ def hostadd_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **optio
 host_add.register_pre_callback(hostadd_pre_callback)
 
 
+@instrument
+def hostadd_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+    if not options.get('disablemail'):
+        bump_mail_serial(self.api, ldap)
+    return dn
+
+
+host_add.register_post_callback(hostadd_post_callback)
+
+
+@instrument
+def hostmod_pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+    set_effective_mail_flags(self.api, ldap, dn, entry_attrs, member_of=[])
+    return dn
+
+
+host_mod.register_pre_callback(hostmod_pre_callback)
+
+
+@instrument
+def hostmod_post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+    invalidate_cached_entries(dn)
+    if any(o in options for o in HOST_MAIL_OPTIONS):
+        bump_mail_serial(self.api, ldap)
+    return dn
+
+
+host_mod.register_post_callback(hostmod_post_callback)
+
+
 @register()
 class host_enable_mail(LDAPQuery):
     __doc__ = _('Enable mail sending for the host.')
@@ -452,27 +1905,34 @@ class host_enable_mail(LDAPQuery):
              default=False),
     )
 
+    @instrument_command
     def execute(self, *args, **kw):
+        ldap = counting_ldap(self.obj.backend)
         dn = self.obj.get_dn(*args, **kw)
-        entry = self.obj.backend.get_entry(dn, ['objectclass', 'serverhostname'])
 
-        if 'mailsenderentity' not in [o.lower() for o in entry['objectclass']]:
-            entry['objectclass'].append('mailsenderentity')
-        else:
-            raise errors.AlreadyActive()
+        addresses = {attr: kw[attr] for attr in ('primarymail', 'sendalias') if kw.get(attr)}
+        get_address_validator(self.api, ldap).validate_entry(addresses, attrs=['primarymail', 'sendalias'])
 
-        if 'primarymail' not in kw:
-            config = self.obj.backend.get_ipa_config()
-            entry['primarymail'] = normalize_and_validate_email(entry['serverhostname'], config)
-        else:
-            entry['primarymail'] = kw['primarymail']
+        if 'primarymail' not in addresses:
+            # serverhostname is the first label of the fqdn, no need to read it
+            config = get_ipa_config(ldap)
+            addresses['primarymail'] = normalize_and_validate_email(args[0].split('.')[0], config)
+
+        if 'sendalias' in addresses:
+            addresses['sendalias'] = list(addresses['sendalias'])
+
+        addresses['cansendexternally'] = kw['cansendexternally']
+        addresses['effectivecansendexternally'] = kw['cansendexternally']
 
-        if 'sendalias' in kw:
-            entry['sendalias'] = list(kw['sendalias'])
+        try:
+            enabled = add_object_class(ldap, dn, 'mailsenderentity', make_modlist(ldap, addresses))
+        except errors.NotFound:
+            self.obj.handle_not_found(*args)
 
-        entry['cansendexternally'] = kw['cansendexternally']
+        if not enabled:
+            raise errors.AlreadyActive()
 
-        self.obj.backend.update_entry(entry)
+        bump_mail_serial(self.api, ldap)
 
         return dict(
             result=True,
@@ -487,27 +1947,28 @@ class host_disable_mail(LDAPQuery):
     has_output = output.standard_value
     msg_summary = _('Disabled mail sending for host "%(value)s"')
 
+    @instrument_command
     def execute(self, *args, **kw):
+        ldap = counting_ldap(self.obj.backend)
         dn = self.obj.get_dn(*args, **kw)
-        entry = self.obj.backend.get_entry(dn, ['objectclass', 'primarymail', 'cansendexternally'])
+        entry = get_cached_entry(ldap, dn, ['objectclass', 'primarymail', 'cansendexternally',
+                                            'effectivecansendexternally'])
 
         if 'mailsenderentity' in [o.lower() for o in entry['objectclass']]:
-            try:
-                del entry['primarymail']
-            except KeyError:
-                pass
-
-            try:
-                del entry['cansendexternally']
-            except KeyError:
-                pass
+            for attr in ('primarymail', 'cansendexternally', 'effectivecansendexternally'):
+                try:
+                    del entry[attr]
+                except KeyError:
+                    pass
 
             while 'mailsenderentity' in [o.lower() for o in entry['objectclass']]:
                 entry['objectclass'].remove('mailsenderentity')
         else:
             raise errors.AlreadyInactive()
 
-        self.obj.backend.update_entry(entry)
+        ldap.update_entry(entry)
+        invalidate_cached_entries(dn)
+        bump_mail_serial(self.api, ldap)
 
         return dict(
             result=True,
@@ -523,7 +1984,8 @@ class postfixconfig(LDAPObject):
     object_name = _('postfix configuration')
     default_attributes = [
         'virtualDomain',
-        'defaultMailboxTransport'
+        'defaultMailboxTransport',
+        'inheritMailDefaults'
     ]
     container_dn = DN(('cn', 'postfix'), ('cn', 'mailserver'), ('cn', 'etc'))
     permission_filter_objectclasses = ["postfixConfiguration"]
@@ -532,14 +1994,14 @@ class postfixconfig(LDAPObject):
             'ipapermbindruletype': 'permission',
             'ipapermright': {'read', 'search', 'compare'},
             'ipapermdefaultattr': {
-                'cn', 'objectclass', 'virtualdomain', 'defaultMailboxTransport'
+                'cn', 'objectclass', 'virtualdomain', 'defaultMailboxTransport', 'inheritMailDefaults'
             }
         },
         'System: Modify Mail Server Postfix Configuration': {
             'ipapermbindruletype': 'permission',
             'ipapermright': {'write', 'add', 'delete'},
             'ipapermdefaultattr': {
-                'virtualdomain', 'defaultMailboxTransport'
+                'virtualdomain', 'defaultMailboxTransport', 'inheritMailDefaults'
             }
         }
     }
@@ -556,6 +2018,12 @@ class postfixconfig(LDAPObject):
             cli_name='default_mailbox_transport',
             label=_('Default mailbox transport')
             ),
+        Bool('inheritmaildefaults?',
+             cli_name='inherit_defaults',
+             label=_('Inherit default quota and transport'),
+             doc=_('Users without explicit quota and transport inherit the defaults instead of storing copies. '
+                   'Requires the optional schema 76-mailserver-inherit.ldif')
+             ),
     )
 
 
@@ -563,6 +2031,7 @@ class postfixconfig(LDAPObject):
 class postfixconfig_mod(LDAPUpdate):
     __doc__ = _('Modify Postfix configuration')
 
+    @instrument
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         if 'virtualdomain' in entry_attrs:
             for d in entry_attrs['virtualdomain']:
@@ -571,6 +2040,23 @@ class postfixconfig_mod(LDAPUpdate):
                 except ValueError:
                     raise errors.ValidationError(name='virtualdomain', error=_('Invalid domain format'))
 
+        if str(entry_attrs.get('inheritmaildefaults')).upper() == 'TRUE':
+            # users without own values would violate the default schema
+            for obj_class, attr in (('mailboxEntity', 'mailboxQuota'), ('mailReceiverEntity', 'mailboxTransport')):
+                must = {a.lower() for a in ldap.schema.get_obj(ObjectClass, obj_class).must}
+                if attr.lower() in must:
+                    raise errors.ValidationError(
+                        name='inheritmaildefaults',
+                        error=_('%(attr)s is required by the schema, install 76-mailserver-inherit.ldif first')
+                        % dict(attr=attr))
+
+        return dn
+
+    @instrument
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        config_cache.invalidate('postfix')
+        config_cache.invalidate('virtualdomains')
+        bump_mail_serial(self.api, ldap)
         return dn
 
 
@@ -622,24 +2108,21 @@ class dovecotconfig(LDAPObject):
 class dovecotconfig_mod(LDAPUpdate):
     __doc__ = _('Modify Dovecot configuration')
 
+    @instrument
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         if 'defaultmailboxquota' in entry_attrs:
             try:
-                quota = int(entry_attrs['defaultmailboxquota'])
+                entry_attrs['defaultmailboxquota'] = storage_rule(entry_attrs['defaultmailboxquota'])
             except ValueError:
                 raise errors.ValidationError(name='defaultmailboxquota', error='not a number')
-            quota_str = '*:storage={}M'.format(quota)
-            entry_attrs['defaultmailboxquota'] = quota_str
 
         return dn
 
+    @instrument
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-        if 'defaultmailboxquota' in entry_attrs:
-            try:
-                _, _, limit = parse_quota_rule(str(entry_attrs['defaultmailboxquota'][0]))
-                entry_attrs['defaultmailboxquota'] = str(limit)
-            except ValueError:
-                pass
+        config_cache.invalidate('dovecot')
+        format_quota_attr(entry_attrs, 'defaultmailboxquota')
+        bump_mail_serial(self.api, ldap)
 
         return dn
 
@@ -648,12 +2131,1766 @@ class dovecotconfig_mod(LDAPUpdate):
 class dovecotconfig_show(LDAPRetrieve):
     __doc__ = _('Show Dovecot configuration')
 
+    @instrument
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-        if 'defaultmailboxquota' in entry_attrs:
-            try:
-                _, _, limit = parse_quota_rule(str(entry_attrs['defaultmailboxquota'][0]))
-                entry_attrs['defaultmailboxquota'] = str(limit)
-            except ValueError:
-                pass
+        format_quota_attr(entry_attrs, 'defaultmailboxquota')
 
         return dn
+
+
+@register()
+class mailserver_stats(VirtualCommand):
+    __doc__ = _("""
+    Show statistics of the mail server plugin in this server process.
+
+    Requires the System: Read Mail Server Statistics permission.
+    """)
+    operation = MAILSERVER_STATS_OPERATION
+
+    has_output = (
+        output.Output('result', dict, _('Statistics')),
+    )
+
+    takes_options = (
+        Flag('reset',
+             label=_('Reset the counters after reading them'),
+             default=False),
+    )
+
+    def execute(self, **options):
+        self.check_access()
+        result = dict(config_cache=config_cache.stats(), hooks=hook_stats.stats())
+
+        if options.get('reset'):
+            config_cache.reset_stats()
+            hook_stats.reset()
+
+        return dict(result=result)
+
+
+@register()
+class mailserver_serial(Command):
+    __doc__ = _("""
+    Show the serial of the mail directory.
+
+    The serial is incremented by every change of users, groups, hosts or configuration which
+    affects the mail server. Consumers can poll it and only reload their maps if it changed.
+    """)
+
+    msg_summary = _('Mail directory serial %(value)d')
+
+    has_output = (
+        output.summary,
+        output.Output('result', int, _('Serial')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        entry = ldap.get_entry(DN(MAILSERVER_CONTAINER, self.api.env.basedn), ['maildirectoryserial'])
+        serial = int(entry.single_value.get('maildirectoryserial', 0))
+
+        return dict(
+            summary=str(self.msg_summary % dict(value=serial)),
+            result=serial,
+        )
+
+
+class PostfixMapExporter:
+    """
+    Compile the Postfix lookup tables from a single paged search over all mail entries
+
+    Map rows are spooled to an on-disk SQLite database so memory usage does not depend on the
+    size of the directory. Group aliases are expanded through the memberOf values of the
+    receiving entries, which already include nested group memberships.
+    """
+    maps = {
+        # map name: join multiple values
+        'virtual_alias': True,
+        'sender_login': True,
+        'transport': False,
+        'send_external': False,
+        'receive_external': False,
+    }
+
+    def __init__(self, api, ldap, page_size=PAGE_SIZE):
+        self.api = api
+        self.ldap = ldap
+        self.page_size = page_size
+
+    def export(self, directory):
+        with tempfile.TemporaryDirectory(dir=directory, prefix='.mailserver-export-') as spool_dir:
+            db = sqlite3.connect(os.path.join(spool_dir, 'spool.sqlite'))
+            try:
+                self._create_spool(db)
+                entries = self._spool_entries(db)
+                self._expand_groups(db)
+
+                counts = {}
+                for name, join in self.maps.items():
+                    counts[name] = self._write_map(db, os.path.join(directory, name), name, join)
+            finally:
+                db.close()
+
+        domains = get_postfix_config(self.api).get('virtualdomain', [])
+        write_file_atomic(os.path.join(directory, 'virtual_domains'),
+                          ('{} OK'.format(d.lower()) for d in sorted(domains)))
+        counts['virtual_domains'] = len(domains)
+
+        return dict(entries=entries, maps=counts)
+
+    @staticmethod
+    def _create_spool(db):
+        db.execute('CREATE TABLE map_row (map TEXT, key TEXT, value TEXT)')
+        db.execute('CREATE TABLE group_alias (dn TEXT, alias TEXT)')
+        db.execute('CREATE TABLE group_member (dn TEXT, mail TEXT)')
+
+    def _spool_entries(self, db):
+        default_transport = get_mail_defaults(self.api)['mailboxtransport']
+        count = 0
+        rows = []
+        for entry in iter_paged_entries(self.ldap, MAIL_ENTRY_FILTER, MAIL_ENTRY_ATTRS,
+                                        mail_entries_base_dn(self.api), page_size=self.page_size):
+            rows.extend(self._entry_rows(entry, default_transport))
+            count += 1
+
+            if len(rows) >= self.page_size:
+                self._flush_rows(db, rows)
+                rows = []
+
+        self._flush_rows(db, rows)
+        db.commit()
+
+        return count
+
+    @staticmethod
+    def _entry_rows(entry, default_transport):
+        obj_classes = {o.lower() for o in entry['objectclass']}
+
+        if 'mailenabledgroup' in obj_classes:
+            dn = str(entry.dn).lower()
+            for alias in entry.get('alias', []):
+                yield 'group_alias', dn, alias.lower()
+            return
+
+        primary = entry.single_value.get('primarymail')
+        if not primary:
+            return
+        primary = primary.lower()
+
+        if 'mailreceiverentity' in obj_classes:
+            for alias in entry.get('alias', []):
+                yield 'virtual_alias', alias.lower(), primary
+
+            transport = entry.single_value.get('mailboxtransport') or default_transport
+            if transport:
+                yield 'transport', primary, transport
+
+            if effective_mail_flag(entry, 'canreceiveexternally'):
+                yield 'receive_external', primary, 'OK'
+
+            for group_dn in entry.get('memberof', []):
+                yield 'group_member', str(group_dn).lower(), primary
+
+        if 'mailsenderentity' in obj_classes:
+            login = entry.get('uid', entry.get('fqdn', [None]))[0]
+            if login:
+                for address in [primary] + list(entry.get('sendalias', [])):
+                    yield 'sender_login', address.lower(), login
+
+            if effective_mail_flag(entry, 'cansendexternally'):
+                yield 'send_external', primary, 'OK'
+
+    @staticmethod
+    def _flush_rows(db, rows):
+        db.executemany('INSERT INTO group_alias VALUES (?, ?)',
+                       (r[1:] for r in rows if r[0] == 'group_alias'))
+        db.executemany('INSERT INTO group_member VALUES (?, ?)',
+                       (r[1:] for r in rows if r[0] == 'group_member'))
+        db.executemany('INSERT INTO map_row VALUES (?, ?, ?)',
+                       (r for r in rows if r[0] not in ('group_alias', 'group_member')))
+
+    @staticmethod
+    def _expand_groups(db):
+        db.execute('INSERT INTO map_row SELECT \'virtual_alias\', a.alias, m.mail '
+                   'FROM group_alias a JOIN group_member m ON a.dn = m.dn')
+        db.execute('CREATE INDEX map_row_key ON map_row (map, key, value)')
+        db.commit()
+
+    @staticmethod
+    def _write_map(db, path, name, join):
+        count = 0
+
+        def lines():
+            nonlocal count
+            cursor = db.execute('SELECT DISTINCT key, value FROM map_row WHERE map = ? ORDER BY key, value', (name,))
+            key = None
+            values = []
+            for row_key, row_value in cursor:
+                if row_key != key:
+                    if key is not None:
+                        count += 1
+                        yield '{} {}'.format(key, ','.join(values))
+                    key = row_key
+                    values = []
+                if join or not values:
+                    values.append(row_value)
+
+            if key is not None:
+                count += 1
+                yield '{} {}'.format(key, ','.join(values))
+
+        write_file_atomic(path, lines())
+        return count
+
+
+@register()
+class mailserver_export_maps(MailServerFileCommand):
+    __doc__ = _("""
+    Export Postfix lookup tables to local files.
+
+    Writes the virtual_alias, sender_login, transport, send_external, receive_external and
+    virtual_domains tables in postmap source format to a directory below /var/lib/ipa-mailserver
+    on the IPA server executing the command. Every file is replaced atomically.
+    """)
+
+    msg_summary = _('Exported lookup tables for %(entries)d mail entries')
+
+    takes_args = (
+        Str('directory?',
+            cli_name='directory',
+            label=_('Target directory name in /var/lib/ipa-mailserver'),
+            default='maps',
+            autofill=True,
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Number of keys per lookup table')),
+    )
+
+    @instrument_command
+    def execute(self, directory, **options):
+        path = mail_server_file(directory, param='directory')
+        self.check_access()
+
+        exporter = PostfixMapExporter(self.api, counting_ldap(self.api.Backend.ldap2))
+        with mail_server_file_errors():
+            os.makedirs(path, mode=0o755, exist_ok=True)
+            result = exporter.export(path)
+
+        return dict(
+            summary=str(self.msg_summary % result),
+            result=result['maps'],
+        )
+
+
+@register()
+class mailserver_export_delta(Command):
+    __doc__ = _("""
+    Export the mail entries changed since the last sync.
+
+    Changes are tracked through the entry update sequence numbers (entryUSN) of the directory.
+    Without a cookie only the current cookie is returned, consumers are expected to do a full
+    export first and pass the returned cookie to the next call.
+
+    Entries which are not mail enabled anymore (e.g. after group-disable-mail or
+    host-disable-mail) and deleted mail entries are returned as tombstones. The directory
+    doesn't record which attributes changed, so every changed user, group or host without mail
+    object classes is returned as tombstone, also if it never was mail enabled. Consumers have to
+    ignore tombstones of entries they don't know.
+
+    Entries only contain a quota and transport if they are set explicitly. The current
+    defaults are returned with every export, users without own values inherit them.
+    """)
+
+    msg_summary = _('%(changed)d changed entries, %(tombstones)d tombstones')
+
+    takes_options = (
+        Str('cookie?',
+            cli_name='cookie',
+            label=_('Cookie returned by the previous export')
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Changed entries')),
+    )
+
+    candidate_filter = '(|(objectclass=person)(objectclass=ipausergroup)(objectclass=ipahost))'
+
+    @instrument_command
+    def execute(self, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        base_dn = mail_entries_base_dn(self.api)
+
+        # read the watermark first, entries changed during the export are reported again next time
+        last_usn = self._get_last_usn(ldap)
+        result = dict(cookie='usn:{}'.format(last_usn), entries=[], tombstones=[],
+                      defaults=get_mail_defaults(self.api))
+
+        if options.get('cookie'):
+            since = self._parse_cookie(options['cookie']) + 1
+
+            # changed entries without mail object classes can't be told apart from disabled ones
+            changed_filter = '(&(entryusn>={}){})'.format(since, self.candidate_filter)
+            for entry in iter_paged_entries(ldap, changed_filter, MAIL_ENTRY_ATTRS, base_dn):
+                if self._is_mail_entry(entry):
+                    result['entries'].append(mail_entry_to_dict(entry))
+                else:
+                    result['tombstones'].append(str(entry.dn))
+
+            deleted_filter = '(&(objectclass=nstombstone)(entryusn>={}))'.format(since)
+            for entry in iter_paged_entries(ldap, deleted_filter, ['objectclass', 'nscpentrydn'], base_dn):
+                if self._is_mail_entry(entry) and entry.get('nscpentrydn'):
+                    result['tombstones'].append(str(entry['nscpentrydn'][0]))
+
+        counts = dict(changed=len(result['entries']), tombstones=len(result['tombstones']))
+
+        return dict(
+            summary=str(self.msg_summary % counts),
+            result=result,
+        )
+
+    @staticmethod
+    def _is_mail_entry(entry):
+        obj_classes = {o.lower() for o in entry['objectclass']}
+        return bool(obj_classes & {'mailsenderentity', 'mailreceiverentity', 'mailenabledgroup'})
+
+    @staticmethod
+    def _parse_cookie(cookie):
+        prefix, _sep, usn = cookie.partition(':')
+        try:
+            if prefix != 'usn':
+                raise ValueError(cookie)
+            return int(usn)
+        except ValueError:
+            raise errors.ValidationError(name='cookie', error=_('invalid cookie'))
+
+    @staticmethod
+    def _get_last_usn(ldap):
+        hook_stats.count('ldap')
+        with ldap.error_handler():
+            rdata = ldap.conn.search_s('', _ldap.SCOPE_BASE, '(objectclass=*)', ['lastusn'])
+
+        last_usn = -1
+        for _dn, raw_attrs in rdata:
+            # with a global USN counter the attribute has no backend subtype
+            for name, values in raw_attrs.items():
+                if name.lower().startswith('lastusn'):
+                    last_usn = max([last_usn] + [int(v) for v in values])
+
+        return last_usn
+
+
+class MailResolver:
+    """
+    Resolve addresses to their final recipients
+
+    Expanded group memberships are memoized for the lifetime of the resolver, so resolving many
+    addresses which point to the same groups only expands every group once.
+    """
+    recipient_attrs = ['objectclass', 'uid', 'primarymail', 'mailboxtransport', 'canreceiveexternally',
+                       'effectivecanreceiveexternally']
+
+    def __init__(self, api, ldap):
+        self.api = api
+        self.ldap = ldap
+        self.base_dn = mail_entries_base_dn(api)
+        self.default_transport = get_mail_defaults(api)['mailboxtransport']
+        self._groups = {}
+
+    def resolve(self, address):
+        address = escape_filter_chars(address)
+        search_filter = (
+            '(&(|(objectclass=mailreceiverentity)(objectclass=mailenabledgroup))'
+            '(|(primarymail={0})(alias={0})))'.format(address)
+        )
+
+        recipients = {}
+        for entry in self._find(search_filter):
+            if 'mailenabledgroup' in [o.lower() for o in entry['objectclass']]:
+                recipients.update(self._expand_group(entry.dn))
+            else:
+                recipients[entry.dn] = self._recipient(entry)
+
+        return sorted(recipients.values(), key=lambda r: r['primarymail'])
+
+    def _expand_group(self, group_dn):
+        if group_dn not in self._groups:
+            # memberOf also contains indirect memberships, so one search expands nested groups
+            search_filter = '(&(objectclass=mailreceiverentity)(memberof={}))'.format(
+                escape_filter_chars(str(group_dn)))
+            self._groups[group_dn] = {e.dn: self._recipient(e) for e in self._find(search_filter)}
+
+        return self._groups[group_dn]
+
+    def _find(self, search_filter):
+        return iter_paged_entries(self.ldap, search_filter, self.recipient_attrs, self.base_dn)
+
+    def _recipient(self, entry):
+        return dict(
+            uid=entry.get('uid', [None])[0],
+            primarymail=entry.single_value.get('primarymail'),
+            mailboxtransport=entry.single_value.get('mailboxtransport') or self.default_transport,
+            canreceiveexternally=effective_mail_flag(entry, 'canreceiveexternally'),
+        )
+
+
+@register()
+class mail_resolve(Command):
+    __doc__ = _('Resolve mail addresses to their final recipients.')
+
+    msg_summary = _('Resolved %(count)d addresses')
+
+    takes_args = (
+        Str('address+',
+            cli_name='address',
+            label=_('Mail address')
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', (list, tuple), _('Recipients per address')),
+    )
+
+    @instrument_command
+    def execute(self, address, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        config = get_ipa_config(ldap)
+        resolver = MailResolver(self.api, ldap)
+
+        result = []
+        resolved = {}
+        for a in normalize_and_validate_email(address, config):
+            a = a.lower()
+            if a not in resolved:
+                resolved[a] = resolver.resolve(a)
+            result.append(dict(address=a, recipients=resolved[a]))
+
+        return dict(
+            summary=str(self.msg_summary % dict(count=len(result))),
+            result=result,
+        )
+
+
+@register()
+class mail(Object):
+    """
+    Mail addresses of users, groups and hosts
+    """
+    object_name = _('mail address')
+    object_name_plural = _('mail addresses')
+    label = _('Mail Addresses')
+    label_singular = _('Mail Address')
+
+    takes_params = (
+        Str('address',
+            primary_key=True,
+            label=_('Address'),
+            ),
+        Str('attribute',
+            label=_('Attribute'),
+            ),
+        Str('type',
+            label=_('Owner type'),
+            ),
+        Str('name',
+            label=_('Owner'),
+            ),
+        Str('dn',
+            label=_('Owner DN'),
+            ),
+    )
+
+
+@register()
+class mail_find(Method):
+    __doc__ = _("""
+    Search the mail addresses of users, groups and hosts.
+
+    The primary addresses, aliases and sender aliases of all mail enabled entries are searched
+    with a single indexed LDAP search. Every matching address is returned with the attribute it
+    was found in and its owner.
+    """)
+
+    msg_summary = ngettext('%(count)d address matched', '%(count)d addresses matched', 0)
+
+    has_output = output.standard_list_of_entries
+
+    takes_args = (
+        Str('criteria?',
+            noextrawhitespace=False,
+            label=_('Address'),
+            doc=_('Address or part of an address to search for'),
+            ),
+    )
+
+    takes_options = (
+        StrEnum('match?',
+                cli_name='match',
+                label=_('Match type'),
+                values=tuple(MAIL_FIND_MATCHES),
+                default='substring',
+                autofill=True,
+                ),
+        StrEnum('attribute*',
+                cli_name='attribute',
+                label=_('Only search these attributes'),
+                values=MAIL_ADDRESS_ATTRS,
+                ),
+        Int('sizelimit?',
+            label=_('Size Limit'),
+            doc=_('Maximum number of addresses returned'),
+            minvalue=0,
+            ),
+        Flag('pkey_only?',
+             label=_('Primary key only'),
+             doc=_('Results should contain primary key attribute only ("address")'),
+             ),
+    )
+
+    @instrument_command
+    def execute(self, criteria=None, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        attrs = options.get('attribute') or MAIL_ADDRESS_ATTRS
+        template, matches = MAIL_FIND_MATCHES[options.get('match') or 'substring']
+
+        sizelimit = options.get('sizelimit')
+        if sizelimit is None:
+            sizelimit = int(get_ipa_config(ldap).get('ipasearchrecordslimit', [100])[0])
+
+        criteria = (criteria or '').strip().lower()
+        address_filter = ''
+        if criteria:
+            assertion = template.format(escape_filter_chars(criteria))
+            address_filter = '(|{})'.format(''.join('({}={})'.format(a, assertion) for a in attrs))
+
+        found = self._iter_matches(ldap, '(&{}{})'.format(MAIL_ENTRY_FILTER, address_filter), attrs,
+                                   lambda address: matches(address, criteria), sizelimit)
+        if sizelimit > 0:
+            found = itertools.islice(found, sizelimit + 1)
+
+        result = list(found)
+        truncated = 0 < sizelimit < len(result)
+        if truncated:
+            del result[sizelimit:]
+
+        if options.get('pkey_only'):
+            result = [dict(address=r['address']) for r in result]
+
+        return dict(
+            summary=str(self.msg_summary % dict(count=len(result))),
+            result=result,
+            count=len(result),
+            truncated=truncated,
+        )
+
+    def _iter_matches(self, ldap, search_filter, attrs, matches, sizelimit):
+        page_size = min(PAGE_SIZE, sizelimit + 1) if sizelimit > 0 else PAGE_SIZE
+        for entry in iter_paged_entries(ldap, search_filter, MAIL_ENTRY_ATTRS, mail_entries_base_dn(self.api),
+                                        page_size=page_size):
+            owner = mail_entry_to_dict(entry)
+            for attr in attrs:
+                for address in entry.get(attr, []):
+                    if matches(address.lower()):
+                        yield dict(address=address, attribute=attr, type=owner['type'], name=owner['name'],
+                                   dn=owner['dn'])
+
+
+class QuotaReport:
+    """
+    Aggregate the allocated mailbox quota per virtual domain, per group and overall
+
+    Entries are consumed one by one, only the running totals per domain and group are kept.
+    The raw attribute values are used to avoid decoding the memberOf DNs of every user.
+    """
+    columns = ('mailboxes', 'quota_mb', 'default_quota', 'unlimited', 'invalid')
+
+    def __init__(self, api, default_quota):
+        # without a readable default, users without an own quota count as unlimited
+        self.default_rules = parse_quota_rules(default_quota) if default_quota else ()
+        self.groups_suffix = ',' + str(DN(api.env.container_group, api.env.basedn)).lower()
+        self.overall = self._totals()
+        self.domains = {}
+        self.groups = {}
+
+    @staticmethod
+    def _totals():
+        return dict(mailboxes=0, quota_bytes=0, default_quota=0, unlimited=0, invalid=0)
+
+    def add(self, entry):
+        raw = entry.raw
+        quota = raw.get('mailboxquota')
+        totals = self._totals()
+        totals['mailboxes'] = 1
+
+        try:
+            rules = parse_quota_rules(quota[0].decode('utf-8')) if quota else self.default_rules
+        except ValueError:
+            totals['invalid'] = 1
+            rules = None
+
+        if rules is not None:
+            if rules == self.default_rules:
+                totals['default_quota'] = 1
+            limit = storage_limit(rules)
+            if limit is None:
+                totals['unlimited'] = 1
+            else:
+                totals['quota_bytes'] = limit
+
+        primary = raw.get('primarymail')
+        domain = primary[0].decode('utf-8').rpartition('@')[2].lower() if primary else ''
+
+        buckets = [self.overall, self.domains.setdefault(domain, self._totals())]
+        for member_dn in raw.get('memberof', []):
+            member_dn = member_dn.decode('utf-8')
+            if member_dn.lower().endswith(self.groups_suffix):
+                # group names can't contain commas
+                group = member_dn.split(',', 1)[0].partition('=')[2]
+                buckets.append(self.groups.setdefault(group, self._totals()))
+
+        for bucket in buckets:
+            for key, value in totals.items():
+                bucket[key] += value
+
+    @staticmethod
+    def _row(totals, **name):
+        row = dict(name, quota_mb=totals['quota_bytes'] // MB)
+        row.update((k, v) for k, v in totals.items() if k != 'quota_bytes')
+        return row
+
+    def result(self):
+        return dict(
+            overall=self._row(self.overall),
+            domains=[self._row(self.domains[d], domain=d) for d in sorted(self.domains)],
+            groups=[self._row(self.groups[g], group=g) for g in sorted(self.groups)],
+        )
+
+    def csv_lines(self):
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='')
+        rows = [('overall', '', self.overall)]
+        rows.extend(('domain', d, self.domains[d]) for d in sorted(self.domains))
+        rows.extend(('group', g, self.groups[g]) for g in sorted(self.groups))
+
+        writer.writerow(('scope', 'name') + self.columns)
+        yield buf.getvalue()
+        for scope, name, totals in rows:
+            buf.seek(0)
+            buf.truncate()
+            row = self._row(totals)
+            writer.writerow((scope, name) + tuple(row[c] for c in self.columns))
+            yield buf.getvalue()
+
+
+@register()
+class mailserver_quota_report(Command):
+    __doc__ = _("""
+    Report the allocated mailbox quota per virtual domain, per group and overall.
+
+    The storage limit for all mailboxes ("*:storage=...") of every mailbox entity is summed up.
+    Mailboxes without an absolute limit are counted as unlimited, mailboxes with the default
+    quota of the Dovecot configuration are counted separately. Group totals include the members
+    of nested groups. The report only contains the totals, so it is returned in the response,
+    with --csv additionally formatted as CSV.
+    """)
+
+    msg_summary = _('%(mailboxes)d mailboxes with %(quota_mb)d MB allocated quota')
+
+    takes_options = (
+        Flag('csv',
+             cli_name='csv',
+             label=_('Additionally return the report as CSV'),
+             default=False,
+             ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Quota allocation')),
+    )
+
+    @instrument_command
+    def execute(self, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        report = QuotaReport(self.api, get_mail_defaults(self.api)['mailboxquota'])
+        attrs_list = ['primarymail', 'mailboxquota', 'memberof']
+        base_dn = mail_entries_base_dn(self.api)
+        for entry in iter_paged_entries(ldap, '(objectclass=mailboxentity)', attrs_list, base_dn):
+            report.add(entry)
+
+        result = report.result()
+        if options.get('csv'):
+            result['csv'] = '\n'.join(report.csv_lines()) + '\n'
+
+        return dict(
+            summary=str(self.msg_summary % result['overall']),
+            result=result,
+        )
+
+
+def _iter_mail_dump_entries(api, ldap, page_size=PAGE_SIZE):
+    return iter_paged_entries(ldap, MAIL_ENTRY_FILTER, MAIL_DUMP_ATTRS, mail_entries_base_dn(api),
+                              page_size=page_size)
+
+
+def iter_mail_dump(api, ldap, page_size=PAGE_SIZE):
+    """
+    Yield the mail data of every mail enabled user, group and host as plain dicts
+
+    The entries are read with a paged search, so memory usage does not depend on the size of
+    the directory. This is the library entry point of mailserver_dump.
+    """
+    for entry in _iter_mail_dump_entries(api, ldap, page_size):
+        yield mail_entry_to_dict(entry)
+
+
+def _ndjson_lines(entries):
+    for entry in entries:
+        yield json.dumps(mail_entry_to_dict(entry), sort_keys=True)
+
+
+def _ldif_lines(entries):
+    buf = io.StringIO()
+    writer = ldif.LDIFWriter(buf)
+    for entry in entries:
+        buf.seek(0)
+        buf.truncate()
+        writer.unparse(str(entry.dn), {name: list(values) for name, values in entry.raw.items()
+                                       if name.lower() != 'memberof'})
+        # the blank line separating the entries is added by write_file_atomic
+        yield buf.getvalue()[:-1]
+
+
+@register()
+class mailserver_dump(MailServerFileCommand):
+    __doc__ = _("""
+    Dump the mail data of all mail enabled users, groups and hosts to a file.
+
+    The file is written to /var/lib/ipa-mailserver on the IPA server executing the command,
+    either as newline delimited JSON with one object per entry or as LDIF. Entries are streamed
+    from a paged search to the file, so the dump neither depends on the RPC response size nor on
+    the available memory.
+    """)
+
+    msg_summary = _('Dumped %(count)d mail entries to %(file)s')
+
+    takes_args = (
+        Str('file',
+            cli_name='file',
+            label=_('Output file name in /var/lib/ipa-mailserver')
+            ),
+    )
+
+    takes_options = (
+        StrEnum('format?',
+                cli_name='format',
+                label=_('Output format'),
+                values=('json', 'ldif'),
+                default='json',
+                autofill=True,
+                ),
+        Flag('compress',
+             cli_name='compress',
+             label=_('Compress the file with gzip'),
+             default=False,
+             ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Number of dumped entries per type')),
+    )
+
+    @instrument_command
+    def execute(self, file, **options):
+        path = mail_server_file(file)
+        self.check_access()
+
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        counts = dict(user=0, group=0, host=0)
+
+        def counted(entries):
+            for entry in entries:
+                counts[mail_entry_type(entry)] += 1
+                yield entry
+
+        entries = counted(_iter_mail_dump_entries(self.api, ldap))
+        lines = _ldif_lines(entries) if options.get('format') == 'ldif' else _ndjson_lines(entries)
+        with mail_server_file_errors():
+            write_file_atomic(path, lines, compress=options.get('compress', False))
+
+        return dict(
+            summary=str(self.msg_summary % dict(count=sum(counts.values()), file=path)),
+            result=counts,
+        )
+
+
+class MailAudit:
+    """
+    Consistency checks of all mail entries in a single pass
+
+    Every entry is checked on its own, addresses are collected in a hash index keyed by the
+    lowercased address, so conflicts are found in linear time without a search per address.
+    """
+    search_filter = ('(|(objectclass=mailsenderentity)(objectclass=mailreceiverentity)(objectclass=mailboxentity)'
+                     '(objectclass=mailenabledgroup)(&(objectclass=ipahost)(primarymail=*)))')
+    attrs_list = ['objectclass', 'uid', 'fqdn', 'cn', 'primarymail', 'alias', 'sendalias']
+    # number of example entries reported per foreign domain
+    examples = 10
+
+    def __init__(self, virtual_domains):
+        self.virtual_domains = virtual_domains
+        self.entries = 0
+        # receiving address -> [(dn, attribute)]
+        self.receivers = {}
+        self.foreign_domains = {}
+        self.partial_object_classes = []
+        self.hosts_without_sender_class = []
+
+    def add(self, entry):
+        self.entries += 1
+        dn = str(entry.dn)
+        obj_classes = {o.lower() for o in entry['objectclass']}
+        entry_type = mail_entry_type(entry)
+
+        if entry_type == 'user' and MAIL_USER_OBJECT_CLASSES & obj_classes != MAIL_USER_OBJECT_CLASSES:
+            self.partial_object_classes.append(dict(dn=dn, missing=sorted(MAIL_USER_OBJECT_CLASSES - obj_classes)))
+
+        if entry_type == 'host' and entry.get('primarymail') and 'mailsenderentity' not in obj_classes:
+            self.hosts_without_sender_class.append(dn)
+
+        receiving = 'mailreceiverentity' in obj_classes or 'mailenabledgroup' in obj_classes
+        seen = set()
+        for attr in MAIL_ADDRESS_ATTRS:
+            for address in entry.get(attr, []):
+                address = address.lower()
+                self._check_domain(dn, address)
+
+                if receiving and attr != 'sendalias' and address not in seen:
+                    seen.add(address)
+                    self.receivers.setdefault(address, []).append(dict(dn=dn, attribute=attr))
+
+    def _check_domain(self, dn, address):
+        # without virtual domains every domain is accepted, like by the address validation
+        domain = address.rpartition('@')[2]
+        if not self.virtual_domains or domain in self.virtual_domains:
+            return
+
+        foreign = self.foreign_domains.setdefault(domain, dict(domain=domain, count=0, entries=[]))
+        foreign['count'] += 1
+        if len(foreign['entries']) < self.examples and dn not in foreign['entries']:
+            foreign['entries'].append(dn)
+
+    def result(self):
+        duplicates = [dict(address=address, owners=owners)
+                      for address, owners in sorted(self.receivers.items()) if len(owners) > 1]
+
+        return dict(
+            entries=self.entries,
+            duplicate_addresses=duplicates,
+            foreign_domains=[self.foreign_domains[d] for d in sorted(self.foreign_domains)],
+            partial_object_classes=self.partial_object_classes,
+            hosts_without_sender_class=self.hosts_without_sender_class,
+        )
+
+
+@register()
+class mailserver_audit(Command):
+    __doc__ = _("""
+    Check all mail entries for conflicts and inconsistencies.
+
+    Reports receiving addresses (primary addresses and aliases) claimed by more than one user or
+    group, addresses outside of the virtual domains, users with only some of the mail object
+    classes and hosts with a primary address but without the mailSenderEntity object class.
+    Addresses are only checked against the virtual domains if there are any.
+    """)
+
+    msg_summary = _('Checked %(entries)d mail entries, found %(problems)d problems')
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Audit result')),
+    )
+
+    @instrument_command
+    def execute(self, **options):
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        audit = MailAudit(get_virtual_domains(self.api))
+        for entry in iter_paged_entries(ldap, audit.search_filter, audit.attrs_list, mail_entries_base_dn(self.api)):
+            audit.add(entry)
+
+        result = audit.result()
+        problems = sum(len(result[k]) for k in ('duplicate_addresses', 'foreign_domains', 'partial_object_classes',
+                                                 'hosts_without_sender_class'))
+
+        return dict(
+            summary=str(self.msg_summary % dict(entries=result['entries'], problems=problems)),
+            result=result,
+        )
+
+
+def changes_modlist(ldap, changes, reverse=False):
+    """
+    Convert {attr: {'removed': [...], 'added': [...]}} to a value level modlist
+
+    Only the changed values are deleted and added, so concurrent changes of other values are
+    kept. With reverse the modlist undoes the changes.
+    """
+    modlist = []
+    for attr, change in changes.items():
+        removed, added = change['removed'], change['added']
+        if reverse:
+            removed, added = added, removed
+        if removed:
+            modlist.append((_ldap.MOD_DELETE, attr, [ldap.encode(v) for v in removed]))
+        if added:
+            modlist.append((_ldap.MOD_ADD, attr, [ldap.encode(v) for v in added]))
+
+    return modlist
+
+
+class ChangeJournal:
+    """
+    Append only JSON lines journal of value level changes
+
+    Changes are written and synced before they are applied, failures are recorded afterwards,
+    so the journal always covers everything which might have been changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def write(self, records):
+        for record in records:
+            self._file.write(json.dumps(record, sort_keys=True))
+            self._file.write('\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    @staticmethod
+    def read(path):
+        """
+        Return the journaled changes as list of (dn, changes) without the failed ones
+        """
+        changes = []
+        failed = set()
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'error' in record:
+                    failed.add((record['dn'], record['seq']))
+                else:
+                    changes.append(record)
+
+        return [(DN(r['dn']), r['changes']) for r in changes if (r['dn'], r['seq']) not in failed]
+
+
+class DomainRewrite:
+    """
+    Rename or remove all addresses of a virtual domain
+
+    Affected entries are found with one paged search on the indexed address attributes and
+    modified in pipelined batches. Entries which were already rewritten don't match the search
+    anymore, so an interrupted run continues where it stopped when it is started again.
+    """
+
+    def __init__(self, api, ldap, domain, new_domain=None):
+        self.api = api
+        self.ldap = ldap
+        self.domain = domain.lower()
+        self.new_domain = new_domain.lower() if new_domain else None
+        # the mail attribute of users mirrors primaryMail and is only renamed, never removed
+        self.attrs = MAIL_ADDRESS_ATTRS + (('mail',) if self.new_domain else ())
+        self.config_dn = DN(api.Object.postfixconfig.container_dn, api.env.basedn)
+        # journal records are identified by run and sequence number, a resumed run appends to the journal
+        self._run_id = '{:x}'.format(int(time.time() * 1000))
+        self._seq = 0
+
+    def search_filter(self):
+        assertion = '*@{}'.format(escape_filter_chars(self.domain))
+        return '(|{})'.format(''.join('({}={})'.format(a, assertion) for a in MAIL_ADDRESS_ATTRS))
+
+    def changes(self, entry):
+        suffix = '@' + self.domain
+        changes = {}
+        for attr in self.attrs:
+            values = entry.get(attr, [])
+            removed = [v for v in values if v.lower().endswith(suffix)]
+            if not removed:
+                continue
+
+            if self.new_domain is None:
+                if attr == 'primarymail':
+                    raise errors.ValidationError(
+                        name='primarymail',
+                        error=_('primary address %(address)s is in the removed domain') % dict(address=removed[0]))
+                added = []
+            else:
+                existing = {v.lower() for v in values}
+                added = ['{}@{}'.format(v.rpartition('@')[0], self.new_domain) for v in removed]
+                added = [v for v in added if v.lower() not in existing]
+
+            changes[attr] = dict(removed=removed, added=added)
+
+        return changes
+
+    def _record(self, dn, changes):
+        self._seq += 1
+        return dict(dn=str(dn), seq='{}:{}'.format(self._run_id, self._seq), changes=changes)
+
+    def _apply(self, journal, records):
+        journal.write(records)
+        results = apply_modlists(self.ldap, [(DN(r['dn']), changes_modlist(self.ldap, r['changes'])) for r in records])
+
+        seqs = {r['dn']: r['seq'] for r in records}
+        failed = [dict(dn=str(dn), seq=seqs[str(dn)], error=str(error)) for dn, error in results if error is not None]
+        journal.write(failed)
+        return len(records) - len(failed), failed
+
+    def _config_change(self, removed, added):
+        return {'virtualdomain': dict(removed=removed, added=added)}
+
+    def collisions(self, records, claims):
+        """
+        Split off the records whose new addresses are already received by another entry
+
+        claims maps the DNs of receiving entries to their new primary addresses and aliases, sender
+        aliases may be shared. Returns the remaining records and the failures.
+        """
+        wanted = {}
+        for record in records:
+            for address in claims.get(record['dn'], ()):
+                wanted.setdefault(address.lower(), []).append(record['dn'])
+        if not wanted:
+            return records, []
+
+        terms = ''.join('({}={})'.format(attr, escape_filter_chars(address))
+                        for address in sorted(wanted) for attr in ('primarymail', 'alias'))
+        owners = iter_paged_entries(
+            self.ldap, '(&(|(objectclass=mailreceiverentity)(objectclass=mailenabledgroup))(|{}))'.format(terms),
+            ['primarymail', 'alias'], mail_entries_base_dn(self.api))
+
+        owned = {}
+        for owner in owners:
+            for address in owner.get('primarymail', []) + owner.get('alias', []):
+                for dn in wanted.get(address.lower(), []):
+                    if dn != str(owner.dn):
+                        owned.setdefault(dn, _('%(address)s is already used by %(owner)s') % dict(
+                            address=address, owner=owner.dn))
+
+        failed = [dict(dn=dn, error=str(error)) for dn, error in owned.items()]
+        return [r for r in records if r['dn'] not in owned], failed
+
+    def run(self, journal_path, dry_run, batch_size, name):
+        rewritten = 0
+        addresses = 0
+        failed = []
+        batch = []
+        # new receiving addresses and the number of rewritten addresses of the records in the batch
+        claims = {}
+        counts = {}
+        domains = get_virtual_domains(self.api)
+
+        with contextlib.ExitStack() as stack:
+            journal = None if dry_run else stack.enter_context(ChangeJournal(journal_path))
+
+            if not dry_run and self.new_domain and self.new_domain not in domains:
+                # the new addresses have to be valid from the first rewritten entry on
+                _done, config_failed = self._apply(
+                    journal, [self._record(self.config_dn, self._config_change([], [self.new_domain]))])
+                if config_failed:
+                    raise errors.ExecutionError(message=config_failed[0]['error'])
+                config_cache.invalidate('postfix')
+                config_cache.invalidate('virtualdomains')
+
+            def flush():
+                nonlocal addresses
+                records, collided = self.collisions(batch, claims)
+                addresses += sum(counts[r['dn']] for r in records)
+                claims.clear()
+                counts.clear()
+                if dry_run or not records:
+                    return len(records), collided
+                done, batch_failed = self._apply(journal, records)
+                return done, collided + batch_failed
+
+            for entry in iter_paged_entries(self.ldap, self.search_filter(), ['objectclass', 'mail'] +
+                                            list(MAIL_ADDRESS_ATTRS), mail_entries_base_dn(self.api)):
+                try:
+                    changes = self.changes(entry)
+                except errors.PublicError as e:
+                    failed.append(dict(dn=str(entry.dn), error=str(e)))
+                    continue
+
+                if not changes:
+                    continue
+
+                record = self._record(entry.dn, changes)
+                counts[record['dn']] = sum(len(c['removed']) for a, c in changes.items() if a != 'mail')
+                obj_classes = {o.lower() for o in entry.get('objectclass', [])}
+                if obj_classes & {'mailreceiverentity', 'mailenabledgroup'}:
+                    claims[record['dn']] = [v for attr in ('primarymail', 'alias')
+                                            for v in changes.get(attr, {}).get('added', [])]
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    done, batch_failed = flush()
+                    rewritten += done
+                    failed.extend(batch_failed)
+                    batch = []
+                    logger.info('%s: %d entries rewritten, %d failed', name, rewritten, len(failed))
+
+            if batch:
+                done, batch_failed = flush()
+                rewritten += done
+                failed.extend(batch_failed)
+
+            if not dry_run and not failed and self.domain in domains:
+                removed = [d for d in get_postfix_config(self.api).get('virtualdomain', [])
+                           if d.lower() == self.domain]
+                _done, config_failed = self._apply(
+                    journal, [self._record(self.config_dn, self._config_change(removed, []))])
+                # the entries are rewritten already, so the failure is reported instead of raised
+                failed.extend(config_failed)
+                config_cache.invalidate('postfix')
+                config_cache.invalidate('virtualdomains')
+
+        if rewritten and not dry_run:
+            invalidate_cached_entries()
+            refresh_group_recipients(self.api, self.ldap, find_all_mail_groups(self.api, self.ldap))
+            bump_mail_serial(self.api, self.ldap)
+
+        logger.info('%s: %d entries rewritten, %d failed', name, rewritten, len(failed))
+        for f in failed:
+            f.pop('seq', None)
+
+        return dict(entries=rewritten, addresses=addresses, failed=failed, dry_run=dry_run, journal=journal_path)
+
+
+class DomainCommand(MailServerFileCommand):
+    msg_summary = _('Rewrote %(entries)d entries, %(failed)d failed')
+    msg_summary_dry_run = _('Would rewrite %(addresses)d addresses in %(entries)d entries, %(failed)d failed')
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Rewrite result')),
+    )
+
+    takes_options = (
+        Str('journal?',
+            cli_name='journal',
+            label=_('Rollback journal file name in /var/lib/ipa-mailserver, required unless --dry-run is given')
+            ),
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Number of entries modified per batch'),
+            minvalue=1,
+            default=BATCH_SIZE
+            ),
+        Flag('dry_run',
+             cli_name='dry_run',
+             label=_('Only report which entries would be rewritten'),
+             default=False
+             ),
+    )
+
+    def _run(self, domain, new_domain, **options):
+        dry_run = options.get('dry_run', False)
+        journal = None
+        if not dry_run:
+            if not options.get('journal'):
+                raise errors.RequirementError(name='journal')
+            journal = mail_server_file(options['journal'], param='journal')
+            self.check_access()
+
+        rewrite = DomainRewrite(self.api, counting_ldap(self.api.Backend.ldap2), domain, new_domain)
+        with mail_server_file_errors():
+            result = rewrite.run(journal, dry_run, options.get('batch_size') or BATCH_SIZE, self.name)
+
+        counts = dict(entries=result['entries'], addresses=result['addresses'], failed=len(result['failed']))
+        summary = self.msg_summary_dry_run if dry_run else self.msg_summary
+
+        return dict(
+            summary=str(summary % counts),
+            result=result,
+        )
+
+
+@register()
+class mailserver_domain_rename(DomainCommand):
+    __doc__ = _("""
+    Rename a virtual domain in all primary addresses, aliases and sender aliases.
+
+    The new domain is added to the virtual domains before the first entry is rewritten, the old
+    one is removed once all entries were rewritten. Entries whose new primary address or alias is
+    already received by another entry are reported as failed and left unchanged. Every change is
+    recorded in the journal first, mailserver-domain-rollback undoes a run. An interrupted run can
+    be continued by running the command again.
+    """)
+
+    takes_args = (
+        Str('domain',
+            cli_name='domain',
+            label=_('Current domain')
+            ),
+        Str('new_domain',
+            cli_name='new_domain',
+            label=_('New domain')
+            ),
+    )
+
+    @instrument_command
+    def execute(self, domain, new_domain, **options):
+        try:
+            validate_domain_name(new_domain)
+        except ValueError:
+            raise errors.ValidationError(name='new_domain', error=_('Invalid domain format'))
+
+        if domain.lower() == new_domain.lower():
+            raise errors.ValidationError(name='new_domain', error=_('must differ from the current domain'))
+
+        return self._run(domain, new_domain, **options)
+
+
+@register()
+class mailserver_domain_remove(DomainCommand):
+    __doc__ = _("""
+    Remove a virtual domain and all aliases and sender aliases in it.
+
+    Entries with a primary address in the domain are reported as failed, their primary address
+    has to be changed first. The domain is removed from the virtual domains once no entry failed.
+    Every change is recorded in the journal first, mailserver-domain-rollback undoes a run.
+    """)
+
+    takes_args = (
+        Str('domain',
+            cli_name='domain',
+            label=_('Domain')
+            ),
+    )
+
+    @instrument_command
+    def execute(self, domain, **options):
+        return self._run(domain, None, **options)
+
+
+@register()
+class mailserver_domain_rollback(MailServerFileCommand):
+    __doc__ = _("""
+    Undo a domain rename or removal recorded in a journal.
+
+    The journaled changes are reverted in reverse order. Values which were changed again since
+    are left alone, the affected entries are reported as failed.
+    """)
+
+    msg_summary = _('Reverted %(reverted)d changes, %(failed)d failed')
+
+    takes_args = (
+        Str('journal',
+            cli_name='journal',
+            label=_('Rollback journal file name in /var/lib/ipa-mailserver')
+            ),
+    )
+
+    takes_options = (
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Number of entries modified per batch'),
+            minvalue=1,
+            default=BATCH_SIZE
+            ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Rollback result')),
+    )
+
+    @instrument_command
+    def execute(self, journal, **options):
+        path = mail_server_file(journal, param='journal')
+        self.check_access()
+
+        ldap = counting_ldap(self.api.Backend.ldap2)
+        batch_size = options.get('batch_size') or BATCH_SIZE
+        with mail_server_file_errors():
+            changes = ChangeJournal.read(path)
+        changes.reverse()
+
+        reverted = 0
+        failed = []
+        for i in range(0, len(changes), batch_size):
+            batch = [(dn, changes_modlist(ldap, c, reverse=True)) for dn, c in changes[i:i + batch_size]]
+            for dn, error in apply_modlists(ldap, batch):
+                if error is None:
+                    reverted += 1
+                else:
+                    failed.append(dict(dn=str(dn), error=str(error)))
+            logger.info('mailserver_domain_rollback: %d changes reverted, %d failed', reverted, len(failed))
+
+        config_cache.invalidate('postfix')
+        config_cache.invalidate('virtualdomains')
+        invalidate_cached_entries()
+        if reverted:
+            refresh_group_recipients(self.api, ldap, find_all_mail_groups(self.api, ldap))
+            bump_mail_serial(self.api, ldap)
+
+        return dict(
+            summary=str(self.msg_summary % dict(reverted=reverted, failed=len(failed))),
+            result=dict(reverted=reverted, failed=failed),
+        )
+
+
+BULK_ACTIONS = ('enable', 'add', 'remove', 'set')
+# per type: object class and the attributes a change set may change
+BULK_TYPES = {
+    'user': ('posixaccount', ('primarymail', 'alias', 'sendalias', 'mailboxquota', 'mailboxtransport',
+                              'cansendexternally', 'canreceiveexternally')),
+    'group': ('ipausergroup', ('alias', 'cansendexternally', 'canreceiveexternally')),
+    'host': ('ipahost', ('primarymail', 'sendalias', 'cansendexternally')),
+}
+# object classes of which an entry needs one before its mail attributes can be changed
+BULK_ENABLED_CLASSES = dict(user=MAIL_USER_OBJECT_CLASSES, group=frozenset({'mailenabledgroup'}),
+                            host=frozenset({'mailsenderentity'}))
+BULK_MULTI_VALUED_ATTRS = ('alias', 'sendalias')
+BULK_BOOL_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+BULK_STATE_ATTRS = ['objectclass', 'mail', 'primarymail', 'alias', 'sendalias', 'mailboxquota', 'mailboxtransport'] + \
+    [a for pair in MAIL_POLICY_ATTRS for a in pair]
+
+
+def _value_key(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+class MailBulkApply:
+    """
+    Apply a change set of mail attribute changes read from a file
+
+    Every line changes one attribute of one user, group or host. The file is streamed twice, first
+    to validate all lines, then to apply them in chunks of entries: the entries of a chunk are read
+    with one search, all lines of an entry are combined into a single value level modify request and
+    the requests of a chunk are sent pipelined. Only the lines of one chunk are held in memory.
+    """
+
+    def __init__(self, api, ldap, path, file_format):
+        self.api = api
+        self.ldap = ldap
+        self.path = path
+        self.file_format = file_format
+        self.validator = get_address_validator(api, ldap)
+        self.lines = 0
+        # an entry whose lines aren't adjacent can be modified in several chunks, it is counted once
+        self.modified = set()
+        self.failed = []
+        # groups whose recipient lists or member flags have to be refreshed after the last chunk
+        self.recipient_groups = set()
+        self.policy_groups = set()
+        self._copied_defaults = None
+
+    @property
+    def entries(self):
+        return len(self.modified)
+
+    def copied_defaults(self):
+        """
+        Return the defaults stored in mail users without own quota or transport
+        """
+        if self._copied_defaults is None:
+            self._copied_defaults = {}
+            copy_mail_defaults(self.api, self._copied_defaults)
+        return self._copied_defaults
+
+    def records(self):
+        """
+        Yield the line number and the raw record of every non empty line
+        """
+        with open(self.path, encoding='utf-8', newline='') as f:
+            if self.file_format == 'csv':
+                reader = csv.DictReader(f)
+                for record in reader:
+                    yield reader.line_num, record
+                return
+
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield number, line
+
+    def validate(self, record):
+        """
+        Check a record without looking at the entry and return the normalized change
+
+        Raises ValidationError for invalid records.
+        """
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError as e:
+                raise errors.ValidationError(name='line', error=str(e))
+            if not isinstance(record, dict):
+                raise errors.ValidationError(name='line', error=_('not a JSON object'))
+
+        # the fields of a JSON record may have any type
+        entry_type = record.get('type')
+        if not isinstance(entry_type, str) or entry_type not in BULK_TYPES:
+            raise errors.ValidationError(name='type', error=_('must be one of %(values)s') % dict(
+                values=', '.join(BULK_TYPES)))
+
+        name = record.get('name')
+        if not name or not isinstance(name, str):
+            raise errors.ValidationError(name='name', error=_('is required'))
+
+        action = record.get('action')
+        if not isinstance(action, str) or action not in BULK_ACTIONS:
+            raise errors.ValidationError(name='action', error=_('must be one of %(values)s') % dict(
+                values=', '.join(BULK_ACTIONS)))
+
+        attr = record.get('attribute') or None
+        if attr is not None and not isinstance(attr, str):
+            raise errors.ValidationError(name='attribute', error=_('must be a string'))
+        attr = attr.lower() if attr else None
+        values = record.get('value')
+        if values is None or values == '':
+            values = []
+        elif not isinstance(values, list):
+            values = [values]
+
+        if action == 'enable':
+            if attr is not None:
+                raise errors.ValidationError(name='attribute', error=_('has to be empty to enable mail'))
+            # the values of enable are the aliases of a group or the primary address of a host
+            attr = dict(user=None, group='alias', host='primarymail')[entry_type]
+            if entry_type == 'group' and not values:
+                raise errors.ValidationError(name='value', error=_('a group needs at least one alias'))
+            if (entry_type == 'user' and values) or (entry_type == 'host' and len(values) > 1):
+                raise errors.ValidationError(name='value', error=_('too many values'))
+        else:
+            if attr not in BULK_TYPES[entry_type][1]:
+                raise errors.ValidationError(name='attribute', error=_('%(attr)s can\'t be changed for a %(type)s')
+                                             % dict(attr=attr, type=entry_type))
+            if attr in BULK_MULTI_VALUED_ATTRS:
+                if action != 'set' and not values:
+                    raise errors.ValidationError(name='value', error=_('is required'))
+            elif action != 'set':
+                raise errors.ValidationError(name='action', error=_('%(attr)s is single-valued, use set')
+                                             % dict(attr=attr))
+            elif len(values) > 1:
+                raise errors.ValidationError(name='value', error=_('%(attr)s is single-valued') % dict(attr=attr))
+            elif attr == 'primarymail' and not values:
+                raise errors.ValidationError(name='value', error=_('is required'))
+
+        # host.get_dn() reads the entry, the DN is built directly to keep the validation offline
+        obj = self.api.Object[entry_type]
+        dn = DN((obj.primary_key.name, name.lower() if entry_type == 'host' else name), obj.container_dn,
+                self.api.env.basedn)
+
+        return dict(type=entry_type, dn=dn, action=action, attr=attr,
+                    values=[self._value(attr, v) for v in values])
+
+    def _value(self, attr, value):
+        if attr in ('cansendexternally', 'canreceiveexternally'):
+            if isinstance(value, bool):
+                return value
+            try:
+                return BULK_BOOL_VALUES[str(value).lower()]
+            except KeyError:
+                raise errors.ValidationError(name=attr, error=_('must be TRUE or FALSE'))
+
+        if attr == 'mailboxquota':
+            # plain numbers are megabytes like --mailbox-quota, everything else a Dovecot quota rule
+            value = str(value)
+            try:
+                return storage_rule(value) if value.isdigit() else format_quota_rules(parse_quota_rules(value))
+            except ValueError as e:
+                raise errors.ValidationError(name=attr, error=str(e))
+
+        if not isinstance(value, str) or not value:
+            raise errors.ValidationError(name=attr, error=_('must be a non empty string'))
+
+        if attr in MAIL_ADDRESS_ATTRS:
+            value, error = self.validator.normalize(value)
+            if error is not None:
+                raise errors.ValidationError(name=attr, error=error)
+
+        return value
+
+    def _enable(self, entry, entry_type, change, state):
+        """
+        Make the entry mail enabled
+
+        For an entry which already is, the aliases of a group are added and the primary address of
+        a host is replaced if one is given.
+        """
+        obj_classes = {o.lower() for o in state['objectclass']}
+        if obj_classes & BULK_ENABLED_CLASSES[entry_type]:
+            if entry_type == 'group':
+                existing = {_value_key(v) for v in state['alias']}
+                state['alias'] = state['alias'] + [v for v in change['values'] if _value_key(v) not in existing]
+            elif entry_type == 'host' and change['values']:
+                state['primarymail'] = list(change['values'])
+            return
+
+        if entry_type == 'user':
+            attrs = mail_migration_attrs(state)
+            state['objectclass'] = attrs['objectclass']
+            state['mail'] = attrs['mail']
+            state['primarymail'] = [attrs['primarymail']]
+            state['canreceiveexternally'] = [True]
+            state['cansendexternally'] = [True]
+            self.recipient_groups.update(entry.get('memberof', []))
+        elif entry_type == 'group':
+            state['objectclass'].append('mailenabledgroup')
+            state['alias'] = list(change['values'])
+            self.recipient_groups.add(entry.dn)
+        else:
+            state['objectclass'].append('mailsenderentity')
+            # serverhostname is the first label of the fqdn like in host_enable_mail
+            state['primarymail'] = change['values'] or normalize_and_validate_email(
+                entry.single_value['fqdn'].split('.')[0], get_ipa_config(self.ldap))
+            state['cansendexternally'] = [False]
+
+    def _apply_change(self, entry, entry_type, change, state):
+        if change['action'] == 'enable':
+            self._enable(entry, entry_type, change, state)
+            return
+
+        attr, values = change['attr'], change['values']
+        obj_classes = {o.lower() for o in state['objectclass']}
+        if entry_type == 'group' and attr != 'alias':
+            # a group policy doesn't need mail aliases
+            if 'mailpolicygroup' not in obj_classes:
+                state['objectclass'].append('mailpolicygroup')
+            self.policy_groups.add(entry.dn)
+        elif not obj_classes & BULK_ENABLED_CLASSES[entry_type]:
+            raise errors.ValidationError(name=attr, error=_('mail is not enabled for this %(type)s')
+                                         % dict(type=entry_type))
+
+        if change['action'] == 'set':
+            state[attr] = []
+            keys = set()
+            for value in values:
+                if _value_key(value) not in keys:
+                    keys.add(_value_key(value))
+                    state[attr].append(value)
+        elif change['action'] == 'add':
+            existing = {_value_key(v) for v in state[attr]}
+            state[attr] = state[attr] + [v for v in values if _value_key(v) not in existing]
+        else:
+            removed = {_value_key(v) for v in values}
+            state[attr] = [v for v in state[attr] if _value_key(v) not in removed]
+
+        if entry_type == 'user' and attr == 'primarymail':
+            state['mail'] = list(values)
+            self.recipient_groups.update(entry.get('memberof', []))
+
+    def entry_changes(self, entry, entry_type, changes, policies):
+        """
+        Combine the changes of all lines of an entry into value level changes
+
+        Lines which can't be applied to the entry are recorded as failed and skipped. Returns the
+        changes in the format of changes_modlist() and the numbers of the applied lines.
+        """
+        state = {attr: list(entry.get(attr, [])) for attr in BULK_STATE_ATTRS}
+
+        applied = []
+        for number, change in changes:
+            try:
+                self._apply_change(entry, entry_type, change, state)
+            except errors.PublicError as e:
+                self.failed.append(dict(line=number, error=str(e)))
+            else:
+                applied.append(number)
+
+        if entry_type == 'user' and 'mailboxentity' in (o.lower() for o in state['objectclass']):
+            # enabled users and users whose quota or transport was removed get the defaults
+            for attr, value in self.copied_defaults().items():
+                if not state[attr]:
+                    state[attr] = [value]
+
+        if entry_type != 'group':
+            # hosts can't be members of user groups, so no group policy applies
+            denied = denied_mail_flags(entry.get('memberof', []), policies) if entry_type == 'user' else set()
+            for attr, effective in MAIL_POLICY_ATTRS:
+                if state[attr]:
+                    state[effective] = [bool(state[attr][0]) and attr not in denied]
+
+        changes = {}
+        for attr, new in state.items():
+            old = entry.get(attr, [])
+            old_keys = {_value_key(v) for v in old}
+            new_keys = {_value_key(v) for v in new}
+            removed = [v for v in old if _value_key(v) not in new_keys]
+            added = [v for v in new if _value_key(v) not in old_keys]
+            if removed or added:
+                changes[attr] = dict(removed=removed, added=added)
+
+        return changes, applied
+
+    def _find_entries(self, chunk):
+        terms = []
+        for dn, changes in chunk.items():
+            obj_class, _attrs = BULK_TYPES[changes[0][1]['type']]
+            terms.append('(&(objectclass={})({}={}))'.format(obj_class, dn[0].attr, escape_filter_chars(dn[0].value)))
+
+        entries = iter_paged_entries(self.ldap, '(|{})'.format(''.join(terms)), BULK_STATE_ATTRS + ['memberof', 'fqdn'],
+                                     mail_entries_base_dn(self.api))
+        return {entry.dn: entry for entry in entries}
+
+    def apply_chunk(self, chunk, dry_run):
+        """
+        Apply the lines of a chunk given as {dn: [(line number, change), ...]}
+        """
+        entries = self._find_entries(chunk)
+        policies = get_mail_policies(self.api, self.ldap)
+
+        batch = []
+        lines = {}
+        for dn, changes in chunk.items():
+            entry = entries.get(dn)
+            if entry is None:
+                error = _('%(type)s %(name)s not found') % dict(type=changes[0][1]['type'], name=dn[0].value)
+                self.failed.extend(dict(line=number, error=str(error)) for number, _change in changes)
+                continue
+
+            entry_changes, applied = self.entry_changes(entry, changes[0][1]['type'], changes, policies)
+            if not applied:
+                continue
+            if entry_changes:
+                batch.append((dn, changes_modlist(self.ldap, entry_changes)))
+                lines[dn] = applied
+            else:
+                # nothing to do, e.g. adding an existing alias
+                self.lines += len(applied)
+
+        results = [(dn, None) for dn, _modlist in batch] if dry_run else apply_modlists(self.ldap, batch)
+        modified = 0
+        for dn, error in results:
+            if error is None:
+                modified += 1
+                self.modified.add(dn)
+                self.lines += len(lines[dn])
+            else:
+                self.failed.extend(dict(line=number, error=str(error)) for number in lines[dn])
+
+        # bump per chunk, so the consumers also see the changes of an interrupted run
+        if modified and not dry_run:
+            bump_mail_serial(self.api, self.ldap)
+
+    def run(self, dry_run, batch_size, name):
+        for number, record in self.records():
+            try:
+                self.validate(record)
+            except errors.PublicError as e:
+                self.failed.append(dict(line=number, error=str(e)))
+
+        if self.failed:
+            logger.info('%s: %d invalid lines, nothing applied', name, len(self.failed))
+            return dict(lines=0, entries=0, failed=self.failed, dry_run=dry_run)
+
+        chunk = {}
+        for number, record in self.records():
+            change = self.validate(record)
+            if change['dn'] not in chunk and len(chunk) >= batch_size:
+                self.apply_chunk(chunk, dry_run)
+                chunk = {}
+                logger.info('%s: %d lines applied to %d entries, %d failed', name, self.lines, self.entries,
+                            len(self.failed))
+            chunk.setdefault(change['dn'], []).append((number, change))
+
+        if chunk:
+            self.apply_chunk(chunk, dry_run)
+
+        if self.entries and not dry_run:
+            if self.policy_groups:
+                invalidate_mail_policies()
+                refresh_mail_policies(self.api, self.ldap, member_filter(sorted(self.policy_groups)))
+            if self.recipient_groups:
+                groups = find_mail_groups(self.api, self.ldap, list(self.recipient_groups))
+                if refresh_group_recipients(self.api, self.ldap, groups):
+                    bump_mail_serial(self.api, self.ldap)
+
+        logger.info('%s: %d lines applied to %d entries, %d failed', name, self.lines, self.entries, len(self.failed))
+        self.failed.sort(key=lambda f: f['line'])
+
+        return dict(lines=self.lines, entries=self.entries, failed=self.failed, dry_run=dry_run)
+
+
+@register()
+class mailserver_bulk_apply(MailServerFileCommand):
+    __doc__ = _("""
+    Apply mail attribute changes of many users, groups and hosts from a file.
+
+    The file in /var/lib/ipa-mailserver on the IPA server contains one change per line, either as
+    JSON object (default) or as CSV with the columns type, name, action, attribute and value. type
+    is user, group or host, action is enable, add, remove or set. All lines are validated before anything is changed,
+    nothing is applied if any line is invalid. All lines of an entry are then combined into one
+    modification and the entries are modified in batches. Lines which couldn't be applied are
+    reported with their line number, the file can simply be applied again after fixing them.
+    """)
+
+    msg_summary = _('Applied %(lines)d lines to %(entries)d entries, %(failed)d failed')
+    msg_summary_dry_run = _('Would apply %(lines)d lines to %(entries)d entries, %(failed)d failed')
+
+    takes_args = (
+        Str('file',
+            cli_name='file',
+            label=_('Change set file name in /var/lib/ipa-mailserver')
+            ),
+    )
+
+    takes_options = (
+        StrEnum('format?',
+                cli_name='format',
+                label=_('Input format'),
+                values=('json', 'csv'),
+                default='json',
+                autofill=True,
+                ),
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Number of entries modified per batch'),
+            minvalue=1,
+            default=BATCH_SIZE
+            ),
+        Flag('dry_run',
+             cli_name='dry_run',
+             label=_('Only report which changes would be applied'),
+             default=False
+             ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Bulk apply result')),
+    )
+
+    @instrument_command
+    def execute(self, file, **options):
+        path = mail_server_file(file)
+        self.check_access()
+
+        dry_run = options.get('dry_run', False)
+        bulk = MailBulkApply(self.api, counting_ldap(self.api.Backend.ldap2), path, options.get('format'))
+        with mail_server_file_errors():
+            result = bulk.run(dry_run, options.get('batch_size') or BATCH_SIZE, self.name)
+
+        counts = dict(lines=result['lines'], entries=result['entries'], failed=len(result['failed']))
+        summary = self.msg_summary_dry_run if dry_run else self.msg_summary
+
+        return dict(
+            summary=str(summary % counts),
+            result=result,
+        )
@@ -0,0 +1,190 @@
+"""
+Dovecot quota rule handling
+
+Parses and formats quota rules in Dovecot notation as stored in mailboxQuota and
+defaultMailboxQuota, e.g. ``*:storage=1G``, ``Trash:storage=+100M``, ``*:storage=10%:messages=1000``
+or ``Spam:ignore``. Several rules can be stored in one value separated by whitespace.
+
+The module only depends on the standard library so it can also be used outside of the IPA server.
+"""
+import functools
+import re
+from collections import namedtuple
+
+QuotaRule = namedtuple('QuotaRule', ['mailbox', 'limits'])
+QuotaLimit = namedtuple('QuotaLimit', ['name', 'value', 'relative', 'percent'])
+
+SIZE_UNITS = {
+    'b': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+}
+MB = SIZE_UNITS['m']
+
+SIZE_LIMITS = ('storage', 'bytes')
+COUNT_LIMITS = ('messages',)
+FLAG_LIMITS = ('ignore', 'noenforcing')
+
+_limit_re = re.compile(r'^(?P<relative>[+-]?)(?P<number>\d+)(?:(?P<percent>%)|(?P<unit>[bkmgt])b?)?$', re.IGNORECASE)
+
+
+def _parse_limit(setting):
+    name, sep, value = setting.partition('=')
+    name = name.lower()
+
+    if not sep:
+        if name not in FLAG_LIMITS:
+            raise ValueError('unknown quota setting: {}'.format(setting))
+        return QuotaLimit(name, None, '', False)
+
+    if name == 'backend':
+        return QuotaLimit(name, value, '', False)
+
+    if name not in SIZE_LIMITS + COUNT_LIMITS:
+        raise ValueError('unknown quota limit: {}'.format(setting))
+
+    match = _limit_re.match(value)
+    if match is None:
+        raise ValueError('invalid quota limit: {}'.format(setting))
+
+    number = int(match.group('number'))
+    percent = bool(match.group('percent'))
+    unit = match.group('unit')
+
+    if unit is not None:
+        if name in COUNT_LIMITS:
+            raise ValueError('message limits have no unit: {}'.format(setting))
+        number *= SIZE_UNITS[unit.lower()]
+
+    # bytes is the deprecated name of storage
+    if name == 'bytes':
+        name = 'storage'
+
+    return QuotaLimit(name, number, match.group('relative'), percent)
+
+
+def _parse_rule(rule):
+    mailbox, sep, settings = rule.partition(':')
+    if not sep or not mailbox:
+        raise ValueError('invalid quota rule: {}'.format(rule))
+
+    limits = tuple(_parse_limit(s) for s in settings.split(':') if s)
+    if not limits:
+        raise ValueError('quota rule without limits: {}'.format(rule))
+
+    return QuotaRule(mailbox, limits)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_quota_rules(value):
+    """
+    Parse a whitespace separated list of quota rules into a tuple of QuotaRule
+
+    Storage limits are returned in bytes. Raises ValueError for invalid rules.
+    The result is immutable and memoized as only few distinct rules occur in practice.
+    """
+    rules = tuple(_parse_rule(r) for r in value.split())
+    if not rules:
+        raise ValueError('empty quota rule')
+
+    return rules
+
+
+def _format_size(size):
+    for unit in ('T', 'G', 'M', 'k'):
+        factor = SIZE_UNITS[unit.lower()]
+        if size and size % factor == 0:
+            return '{}{}'.format(size // factor, unit)
+
+    return str(size)
+
+
+def _format_limit(limit):
+    if limit.value is None:
+        return limit.name
+    if limit.name == 'backend':
+        return 'backend={}'.format(limit.value)
+    if limit.percent:
+        value = '{}%'.format(limit.value)
+    elif limit.name in SIZE_LIMITS:
+        value = _format_size(limit.value)
+    else:
+        value = str(limit.value)
+
+    return '{}={}{}'.format(limit.name, limit.relative, value)
+
+
+def format_quota_rules(rules):
+    """
+    Format a sequence of QuotaRule in Dovecot notation
+    """
+    return ' '.join(
+        '{}:{}'.format(rule.mailbox, ':'.join(_format_limit(limit) for limit in rule.limits))
+        for rule in rules
+    )
+
+
+def storage_rule(mb):
+    """
+    Return the rule limiting the storage of all mailboxes to mb megabytes
+    """
+    return '*:storage={}M'.format(int(mb))
+
+
+def storage_limit_mb(rules):
+    """
+    Return the absolute storage limit of the default rule in whole megabytes
+
+    Returns None if the rules can't be represented by a single limit in megabytes.
+    """
+    if len(rules) != 1:
+        return None
+
+    rule = rules[0]
+    if rule.mailbox != '*' or len(rule.limits) != 1:
+        return None
+
+    limit = rule.limits[0]
+    if limit.name != 'storage' or limit.relative or limit.percent or limit.value % MB:
+        return None
+
+    return limit.value // MB
+
+
+def storage_limit(rules):
+    """
+    Return the absolute storage limit of the rule for all mailboxes in bytes
+
+    Returns None if there is no such limit, e.g. for relative or percentage limits or
+    storage=0, which means unlimited in Dovecot.
+    """
+    for rule in rules:
+        if rule.mailbox != '*':
+            continue
+        for limit in rule.limits:
+            if limit.name == 'storage' and not limit.relative and not limit.percent and limit.value:
+                return limit.value
+
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def quota_display_value(value):
+    """
+    Convert a stored quota rule to the value shown to the user
+
+    A plain storage limit is shown in megabytes, all other rules in canonical Dovecot notation.
+    Values which can't be parsed are returned unchanged.
+    """
+    try:
+        rules = parse_quota_rules(value)
+    except ValueError:
+        return value
+
+    limit = storage_limit_mb(rules)
+    if limit is None:
+        return format_quota_rules(rules)
+
+    return str(limit)
@@ -0,0 +1,162 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ipaserver.plugins')
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(TOPDIR, 'plugin'))
+
+from ipalib import errors  # noqa: E402
+
+import ipaserver.plugins  # noqa: E402
+
+# load the plugin from the source tree instead of an installed copy
+ipaserver.plugins.__path__.insert(0, os.path.join(TOPDIR, 'plugin', 'ipaserver', 'plugins'))
+from ipaserver.plugins import mailserver  # noqa: E402
+from ipaserver.plugins.mailserver import MailAddressValidator  # noqa: E402
+
+DOMAINS = frozenset(['example.test', 'example.org'])
+
+
+class FakeApi:
+    """
+    Stand-in for the API object dispatching postfixconfig_show and dovecotconfig_show
+    """
+
+    def __init__(self, show, dovecot_show=None):
+        self.Command = {'postfixconfig_show': show, 'dovecotconfig_show': dovecot_show}
+
+
+@pytest.fixture(autouse=True)
+def empty_config_cache():
+    mailserver.reset_request_cache()
+    mailserver.config_cache.invalidate()
+    yield
+    mailserver.reset_request_cache()
+
+
+def test_normalize():
+    validator = MailAddressValidator(DOMAINS, 'example.test')
+
+    assert validator.normalize('jdoe') == ('jdoe@example.test', None)
+    assert validator.normalize('jdoe@Example.ORG') == ('jdoe@Example.ORG', None)
+    assert validator.normalize('jdoe@other.test')[1] is not None
+    assert validator.normalize('jdoe@other.test', check_domain=False) == ('jdoe@other.test', None)
+    assert validator.normalize('not an address@')[1] is not None
+
+
+def test_empty_domains_disable_the_check():
+    assert MailAddressValidator(frozenset()).normalize('jdoe@other.test') == ('jdoe@other.test', None)
+
+
+def test_domains_are_loaded_lazily():
+    loaded = []
+
+    def load():
+        loaded.append(True)
+        return DOMAINS
+
+    validator = MailAddressValidator(load)
+    entry_attrs = {'primarymail': 'jdoe@other.test'}
+    validator.validate_entry(entry_attrs, domain_attrs=())
+    assert not loaded
+
+    with pytest.raises(errors.ValidationError):
+        validator.validate_entry({'alias': ['jd@other.test']})
+    validator.validate_entry({'alias': ['jd@example.test']})
+    assert loaded == [True]
+
+
+def test_validate_entry_reports_all_errors():
+    validator = MailAddressValidator(DOMAINS)
+
+    with pytest.raises(errors.ValidationError) as e:
+        validator.validate_entry({'alias': ['a@other.test', 'b@example.test'], 'sendalias': ['c@other.test']})
+
+    assert 'a@other.test' in str(e.value)
+    assert 'c@other.test' in str(e.value)
+    assert 'b@example.test' not in str(e.value)
+
+
+def test_validate_entry_keeps_existing_values():
+    validator = MailAddressValidator(DOMAINS)
+    entry_attrs = {'alias': ['Old@legacy.test', 'new@example.test']}
+
+    validator.validate_entry(entry_attrs, existing={'alias': ['old@legacy.test']})
+    assert entry_attrs == {'alias': ['Old@legacy.test', 'new@example.test']}
+
+    with pytest.raises(errors.ValidationError):
+        validator.validate_entry({'alias': ['new@legacy.test']}, existing={'alias': ['old@legacy.test']})
+
+
+def test_unreadable_domains_skip_the_check():
+    def show(**options):
+        raise errors.ACIError(info='no read access')
+
+    assert mailserver.get_validation_domains(FakeApi(show)) == frozenset()
+
+
+def test_readable_domains():
+    def show(**options):
+        return {'result': {'virtualdomain': ['Example.test']}}
+
+    assert mailserver.get_validation_domains(FakeApi(show)) == frozenset(['example.test'])
+
+
+def config_api(inherit):
+    def show(**options):
+        postfix_config = {'defaultmailboxtransport': ['lmtp:unix:private/dovecot-lmtp']}
+        if inherit:
+            postfix_config['inheritmaildefaults'] = ['TRUE']
+        return {'result': postfix_config}
+
+    def dovecot_show(**options):
+        return {'result': {'defaultmailboxquota': ['1024']}}
+
+    return FakeApi(show, dovecot_show)
+
+
+def test_defaults_are_copied_by_default():
+    entry_attrs = {'mailboxquota': '*:storage=2048M', 'mailboxtransport': None}
+    mailserver.copy_mail_defaults(config_api(False), entry_attrs)
+
+    assert entry_attrs == {'mailboxquota': '*:storage=2048M', 'mailboxtransport': 'lmtp:unix:private/dovecot-lmtp'}
+
+    entry_attrs = {}
+    mailserver.copy_mail_defaults(config_api(False), entry_attrs, ['mailboxquota'])
+    assert entry_attrs == {'mailboxquota': '*:storage=1024M'}
+
+
+def test_inherited_defaults_are_not_copied():
+    entry_attrs = {'mailboxtransport': None}
+    mailserver.copy_mail_defaults(config_api(True), entry_attrs)
+
+    assert entry_attrs == {'mailboxtransport': None}
+
+
+def test_changed_attrs_include_attribute_options():
+    options = {'setattr': ['PrimaryMail=jdoe@example.test'], 'delattr': ('mail=jdoe@old.test',), 'all': True}
+
+    assert {'primarymail', 'mail'} <= mailserver._changed_attrs(options)
+    assert 'primarymail' not in mailserver._changed_attrs({'addattr': ['alias=jd@example.test']})
+
+
+class FakeEntry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = dn
+
+
+def test_audit_without_virtual_domains_reports_no_foreign_domains():
+    entry = FakeEntry('uid=jdoe,cn=users,cn=accounts,dc=example,dc=test', objectclass=['posixaccount'],
+                      primarymail=['jdoe@other.test'])
+
+    audit = mailserver.MailAudit(frozenset())
+    audit.add(entry)
+    assert audit.result()['foreign_domains'] == []
+
+    audit = mailserver.MailAudit(DOMAINS)
+    audit.add(entry)
+    assert [f['domain'] for f in audit.result()['foreign_domains']] == ['other.test']
@@ -5,12 +5,13 @@ define([
         'freeipa/phases',
         'freeipa/menu',
         'freeipa/reg',
+        'freeipa/rpc',
         'freeipa/user',
         'freeipa/group',
         'freeipa/host',
         'freeipa/dialog'
     ],
-    function (builder, SpecMod, IPA, phases, menu, reg, user, group, host, dialogs) {
+    function (builder, SpecMod, IPA, phases, menu, reg, rpc, user, group, host, dialogs) {
         function get_item_by_attrval(array, attr, value) {
             for (let i = 0, l = array.length; i < l; i++) {
                 if (array[i][attr] === value) return array[i];
@@ -25,21 +26,214 @@ define([
             return null;
         }
 
+        function get_record(data) {
+            // batch results contain the entry directly, single command responses wrap it
+            return data.result.result || data.result;
+        }
+
         let mail_server = {};
 
+        /*
+         * Session cache of the Postfix and Dovecot configuration
+         *
+         * Both configurations are fetched on first use, either added to a batch request the facet
+         * sends anyway or with a batch request of their own. The config facets store every loaded or
+         * saved configuration, so the cache never outlives a change made in this session.
+         * invalidate() forces a reload on the next use.
+         */
+        mail_server.config = (function () {
+            let that = {};
+            let cache = {};
+            let waiting = null;
+            let entities = ['postfixconfig', 'dovecotconfig'];
+
+            function flush() {
+                let callbacks = waiting;
+                waiting = null;
+                callbacks.forEach(function (callback) {
+                    callback(cache);
+                });
+            }
+
+            function add_show_commands(batch) {
+                let missing = entities.filter(function (entity) {
+                    return !cache[entity];
+                });
+
+                missing.forEach(function (entity) {
+                    batch.add_command(rpc.command({
+                        entity: entity,
+                        method: 'show',
+                        on_success: function (data) {
+                            that.set(entity, get_record(data));
+                            if (waiting && that.loaded()) flush();
+                        },
+                        on_error: function () {
+                            waiting = null;
+                        }
+                    }));
+                });
+
+                return missing.length > 0;
+            }
+
+            that.set = function (entity, record) {
+                cache[entity] = record;
+            };
+
+            that.invalidate = function () {
+                cache = {};
+            };
+
+            that.loaded = function () {
+                return entities.every(function (entity) {
+                    return cache[entity];
+                });
+            };
+
+            /*
+             * Load the missing configurations with another request's batch, callbacks passed to
+             * get() meanwhile are called when its results arrive
+             */
+            that.add_to_batch = function (batch) {
+                if (add_show_commands(batch)) {
+                    waiting = waiting || [];
+                }
+            };
+
+            that.get = function (on_success) {
+                if (that.loaded()) {
+                    on_success(cache);
+                    return;
+                }
+
+                if (waiting) {
+                    waiting.push(on_success);
+                    return;
+                }
+                waiting = [on_success];
+
+                let batch = rpc.batch_command({
+                    name: 'mailserver_config'
+                });
+                add_show_commands(batch);
+                batch.execute();
+            };
+
+            return that;
+        })();
+
+        mail_server.config_facet_post_op = function (facet) {
+            let load = facet.load;
+            facet.load = function (data) {
+                load.call(facet, data);
+                mail_server.config.set(facet.entity.name, get_record(data));
+            };
+            return facet;
+        };
+
+        /*
+         * Show the configured defaults as placeholders of empty mail fields
+         *
+         * Facets which refresh with a batch request, like the user details, load the configuration
+         * in the same request.
+         */
+        mail_server.defaults_post_op = function (facet) {
+            let create_refresh_command = facet.create_refresh_command;
+            facet.create_refresh_command = function () {
+                let command = create_refresh_command.call(facet);
+                if (command.add_command) mail_server.config.add_to_batch(command);
+                return command;
+            };
+
+            facet.post_load.attach(function () {
+                mail_server.config.get(function (config) {
+                    let defaults = {
+                        mailboxquota: config.dovecotconfig.defaultmailboxquota,
+                        mailboxtransport: config.postfixconfig.defaultmailboxtransport
+                    };
+
+                    for (let name in defaults) {
+                        let widget = facet.widgets.get_widget('mail.' + name);
+                        if (widget && widget.input && defaults[name]) {
+                            widget.input.attr('placeholder', defaults[name][0]);
+                        }
+                    }
+                });
+            });
+            return facet;
+        };
+
+        /*
+         * Batch a command on the facet's entry with a show command, so the facet can be updated
+         * from the result with load_batch_result() instead of a second request
+         */
+        mail_server.batch_with_show = function (facet, command) {
+            let batch = rpc.batch_command({
+                name: facet.entity.name + '_' + command.method
+            });
+
+            batch.add_command(command);
+            batch.add_command(rpc.command({
+                entity: facet.entity.name,
+                method: 'show',
+                args: facet.get_pkeys(),
+                options: {all: true, rights: true}
+            }));
+
+            return batch;
+        };
+
+        mail_server.load_batch_result = function (facet, data) {
+            let results = data.result.results;
+            if (results[1].error) {
+                facet.refresh();
+            } else {
+                facet.load(results[1]);
+            }
+        };
+
+        mail_server.batch_action = function (spec) {
+            let that = IPA.action(spec);
+            that.method = spec.method;
+
+            that.execute_action = function (facet, on_success) {
+                let command = rpc.command({
+                    entity: facet.entity.name,
+                    method: that.method,
+                    args: facet.get_pkeys()
+                });
+                let batch = mail_server.batch_with_show(facet, command);
+                batch.on_success = function (data) {
+                    let result = data.result.results[0];
+                    if (!result.error) IPA.notify_success(result.summary);
+                    mail_server.load_batch_result(facet, data);
+                    if (on_success) on_success(data);
+                };
+                batch.on_error = function () {
+                    facet.refresh();
+                };
+                batch.execute();
+            };
+
+            return that;
+        };
+
         mail_server.postfixconfig_spec = {
             name: 'postfixconfig',
             defines_key: false,
             facets: [
                 {
                     $type: 'details',
+                    $post_ops: [mail_server.config_facet_post_op],
                     sections: [
                         {
                             name: 'postfix',
                             label: 'Postfix',
                             fields: [
                                 {$type: 'multivalued', name: 'virtualdomain'},
-                                'defaultmailboxtransport'
+                                'defaultmailboxtransport',
+                                {$type: 'checkbox', name: 'inheritmaildefaults'}
                             ]
                         }
                     ]
@@ -53,6 +247,7 @@ define([
             facets: [
                 {
                     $type: 'details',
+                    $post_ops: [mail_server.config_facet_post_op],
                     sections: [
                         {
                             name: 'dovecot',
@@ -66,6 +261,23 @@ define([
             ]
         };
 
+        mail_server.mail_spec = {
+            name: 'mail',
+            facets: [
+                {
+                    $type: 'search',
+                    no_update: true,
+                    search_all_entries: true,
+                    columns: [
+                        {name: 'address', link: false},
+                        'attribute',
+                        'type',
+                        'name'
+                    ]
+                }
+            ]
+        };
+
         mail_server.mod_user_spec = function (entity) {
             let facet = get_item_by_attrval(entity.facets, '$type', 'details');
             let contact_section = get_item_by_attrval(facet.sections, 'name', 'contact');
@@ -93,15 +305,26 @@ define([
                         name: 'cansendexternally',
                         $type: 'checkbox'
                     },
+                    {
+                        name: 'effectivecanreceiveexternally',
+                        $type: 'checkbox',
+                        read_only: true
+                    },
+                    {
+                        name: 'effectivecansendexternally',
+                        $type: 'checkbox',
+                        read_only: true
+                    },
                     'mailboxquota',
                     'mailboxtransport',
                 ]
             };
 
             facet.sections.push(mail_section);
+            facet.$post_ops = (facet.$post_ops || []).concat([mail_server.defaults_post_op]);
 
             facet.actions.push({
-                $factory: IPA.object_action,
+                $factory: mail_server.batch_action,
                 name: 'migrate_mail',
                 method: 'migrate_mail',
                 label: 'Migrate mail attributes',
@@ -114,6 +337,13 @@ define([
             mail_server.mod_user_spec(user.entity_spec);
         };
 
+        // a group policy can only deny, without a value the flags of the members apply unchanged
+        mail_server.policy_options = [
+            {label: 'No policy', value: ''},
+            {label: 'Allow', value: 'TRUE'},
+            {label: 'Deny', value: 'FALSE'},
+        ];
+
         mail_server.mod_group_spec = function (entity) {
             let facet = get_item_by_attrval(entity.facets, '$type', 'details');
 
@@ -125,6 +355,16 @@ define([
                         $type: 'multivalued',
                         name: 'alias'
                     },
+                    {
+                        $type: 'radio',
+                        name: 'canreceiveexternally',
+                        options: mail_server.policy_options
+                    },
+                    {
+                        $type: 'radio',
+                        name: 'cansendexternally',
+                        options: mail_server.policy_options
+                    },
                 ]
             }
 
@@ -156,6 +396,23 @@ define([
             return spec;
         }
 
+        /*
+         * Run group_enable_mail and the reload of the group in one batch request
+         */
+        mail_server.group_dialog_post_op = function (dialog, spec) {
+            let create_command = dialog.create_command;
+            if (!create_command || !spec.facet) return dialog;
+
+            dialog.create_command = function () {
+                return mail_server.batch_with_show(spec.facet, create_command.call(dialog));
+            };
+            dialog.succeeded.attach(function (data) {
+                mail_server.load_batch_result(spec.facet, data);
+            });
+            dialog.batched = true;
+            return dialog;
+        };
+
         mail_server.group_enable_mail_action = function (spec) {
             spec = spec || {};
             spec.name = spec.name || 'enable_mail';
@@ -166,12 +423,15 @@ define([
             that.execute_action = function (facet) {
                 let dialog = builder.build('dialog', {
                     $type: 'group_enable_mail',
-                    args: [facet.get_pkey()]
+                    args: [facet.get_pkey()],
+                    facet: facet
                 });
 
-                dialog.succeeded.attach(function () {
-                    facet.refresh();
-                })
+                if (!dialog.batched) {
+                    dialog.succeeded.attach(function () {
+                        facet.refresh();
+                    });
+                }
                 dialog.open();
             }
 
@@ -186,7 +446,7 @@ define([
             spec.needs_confirm = spec.needs_confirm !== undefined ? spec.needs_confirm : true;
             spec.enable_cond = spec.enable_cond || ['oc_mailenabledgroup'];
 
-            return IPA.object_action(spec);
+            return mail_server.batch_action(spec);
         };
 
         mail_server.mod_host_spec = function (entity) {
@@ -204,6 +464,11 @@ define([
                         $type: 'checkbox',
                         name: 'cansendexternally'
                     },
+                    {
+                        $type: 'checkbox',
+                        name: 'effectivecansendexternally',
+                        read_only: true
+                    },
                 ]
             }
 
@@ -211,7 +476,7 @@ define([
             facet.sections.splice(cert_sec_i + 1, 0, mail_section);
 
             facet.actions.push({
-                $factory: IPA.object_action,
+                $factory: mail_server.batch_action,
                 name: 'host_enable_mail',
                 method: 'enable_mail',
                 label: 'Enable mail sending',
@@ -220,7 +485,7 @@ define([
             facet.header_actions.push('host_enable_mail');
 
             facet.actions.push({
-                $factory: IPA.object_action,
+                $factory: mail_server.batch_action,
                 name: 'host_disable_mail',
                 method: 'disable_mail',
                 label: 'Disable mail sending',
@@ -247,6 +512,7 @@ define([
                         name: 'mailserver',
                         label: 'Mail Server',
                         children: [
+                            {entity: 'mail'},
                             {entity: 'postfixconfig'},
                             {entity: 'dovecotconfig'}
                         ]
@@ -260,6 +526,7 @@ define([
             let a = reg.action;
             let d = reg.dialog;
 
+            e.register({type: 'mail', spec: mail_server.mail_spec});
             e.register({type: 'postfixconfig', spec: mail_server.postfixconfig_spec});
             e.register({type: 'dovecotconfig', spec: mail_server.dovecot_config_spec});
 
@@ -270,7 +537,7 @@ define([
                 type: 'group_enable_mail',
                 factory: IPA.command_dialog,
                 pre_ops: [mail_server.group_dialog_pre_op],
-                post_ops: [dialogs.command_dialog_post_op]
+                post_ops: [dialogs.command_dialog_post_op, mail_server.group_dialog_post_op]
             });
         };
 